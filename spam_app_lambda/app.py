@@ -1,39 +1,114 @@
+import time
+import_start = time.perf_counter()
+import json
 from flask import Flask, request, render_template, jsonify 
-import pandas as pd
 import numpy as np
-import joblib 
-from datetime import datetime
 import os
+from email_date import DEFAULT_DAY, day_of_week as email_day_of_week
+from fast_model import CompiledSpamModel, combine_text, file_sha256, read_compact_source
+#pandas and joblib (which pulls in sklearn) are imported only when they are needed,
+#with the compact model neither is imported which keeps Lambda cold starts short
 
+
+def log_timing(stage, start, **fields):
+    '''Prints a structured (json) log line with how long a startup stage took'''
+    print(json.dumps({'event':'startup', 'stage':stage, 'ms':round((time.perf_counter() - start)*1000, 2), **fields}), flush=True)
+
+
+log_timing('import', import_start)
 print('Starting app')
 #initialize falsk app
 app = Flask(__name__)
 
+#model files, the compact export is preferred because it is memory mapped instead of unpickled
+models_dir = os.path.join(os.path.dirname(__file__), 'models')
+model_path = os.path.join(models_dir, 'spam_trained_model.joblib')
+compact_path = os.path.join(models_dir, 'spam_model_compact')
+
+load_start = time.perf_counter()
+pipeline = None
+engine = None
+if os.path.isdir(compact_path):
+    print('Loading compact model')
+    try:
+        #a compact export of an older joblib would silently serve stale weights
+        if os.path.exists(model_path) and read_compact_source(compact_path) != file_sha256(model_path):
+            raise ValueError('compact model was exported from a different joblib file, re-run fast_model.py')
+        engine = CompiledSpamModel.load_compact(compact_path)
+        print('Compact model loaded successfully')
+    except Exception as e:
+        print(f"Exact error:{type(e).__name__}:{e}\nCould not load the compact model")
+
 #load trained pipline, does it once when the app starts
-print('Importing new pipline')
-try:
-    model_path = os.path.join(os.path.dirname(__file__), 'models', 'spam_trained_model.joblib')
-    pipeline = joblib.load(model_path)
-    print('Pipeline imported successfully')
-except Exception as e:
-    pipeline = None
-    print(f"Exact error:{type(e).__name__}:{e}\nCould not load the pipeline")
+if engine is None:
+    print('Importing new pipline')
+    try:
+        import joblib
+        pipeline = joblib.load(model_path)
+        print('Pipeline imported successfully')
+    except Exception as e:
+        print(f"Exact error:{type(e).__name__}:{e}\nCould not load the pipeline")
+
+    #compile the fitted weights for the dataframe free fast path
+    try:
+        engine = CompiledSpamModel.from_pipeline(pipeline)
+        print('Fast path compiled successfully')
+    except Exception as e:
+        print(f"Exact error:{type(e).__name__}:{e}\nUsing the full pipeline for predictions")
 
+log_timing('model_load', load_start, model='compact' if pipeline is None and engine is not None else 'joblib')
 
-def process_user_input(subject, message):
+#largest number of emails accepted by /predict_batch in one request
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 10000))
+#day_of_week of emails without a usable date (0 is monday)
+DEFAULT_DAY_OF_WEEK = int(os.environ.get('DEFAULT_DAY_OF_WEEK', DEFAULT_DAY))
+
+
+def email_days(emails):
+    '''
+    day_of_week of each email from its 'date' or raw 'headers' (the Date header),
+    like in training, DEFAULT_DAY_OF_WEEK when it has neither or they do not parse
+    '''
+    days = [email_day_of_week(email.get('date'), email.get('headers'))[0] for email in emails]
+    return np.array([DEFAULT_DAY_OF_WEEK if day is None else day for day in days])
+
+def process_user_input(subject, message, date=None, headers=None):
     '''
     Receives subject and message from user input
     combines them into a dataframe with the same structure
     as the one used for training
+    day_of_week comes from the optional date or raw headers, DEFAULT_DAY_OF_WEEK without them
     '''
-    current_date = datetime.now()
+    import pandas as pd
     df = pd.DataFrame({
         'combined_with_stopwords': [f'{subject.strip()} {message.strip()}'],
-        'day_of_week':[current_date.weekday()],#today's date 
+        'day_of_week':email_days([{'date':date, 'headers':headers}]),
         'repeat_freq': [1] #frequency is 1
     })
     return df
 
+def process_batch_input(emails):
+    '''
+    Receives a list of emails, each a dict with a subject and message
+    combines them into one dataframe with the same structure
+    as the one used for training, one row per email in input order
+    '''
+    import pandas as pd
+    df = pd.DataFrame({
+        'combined_with_stopwords': [combine_text(email.get('subject') or '', email['message']) for email in emails],
+        'day_of_week': email_days(emails),
+        'repeat_freq': 1 #frequency is 1
+    }, index=range(len(emails)))
+    return df
+
+def email_error(email):
+    '''Why an item of a batch cannot be scored, None when it can'''
+    if not isinstance(email, dict) or not email.get('message'):
+        return 'message cannot be empty'
+    if not isinstance(email['message'], str) or not isinstance(email.get('subject') or '', str):
+        return 'subject and message must be strings'
+    return None
+
 def convert_score_to_prob(pred):
     """
     Convert LinearSVC decision function to probabilities
@@ -45,6 +120,51 @@ def convert_score_to_prob(pred):
     spam_prob = 1 / (1 + np.exp(-pred))
     return [1 - spam_prob, spam_prob] 
 
+def score_input(precessed_input):
+    '''
+    Scores processed input with a single pass through the pipeline
+    the preprocessor (tfidf + scaler) transforms the data once, the decision
+    score is computed once and the label and probabilities are derived from it
+    returns: labels, decision scores, [ham probabilities, spam probabilities]
+    '''
+    features = pipeline[:-1].transform(precessed_input)
+    model = pipeline[-1]
+    if hasattr(model, 'decision_function'):
+        predict_scores = model.decision_function(features)
+    else:
+        #models without a decision function (e.g. MultinomialNB), use the log odds of spam
+        spam_prob = np.clip(model.predict_proba(features)[:, 1], 1e-15, 1 - 1e-15)
+        predict_scores = np.log(spam_prob / (1 - spam_prob))
+    #same rule predict uses for binary linear models: positive score is the second class
+    labels = model.classes_[(predict_scores > 0).astype(int)]
+    return labels, predict_scores, convert_score_to_prob(predict_scores)
+
+def score_emails(emails):
+    '''
+    Scores a list of emails, each a dict with a subject and message
+    (and an optional date or raw headers for day_of_week)
+    uses the compiled fast path when the pipeline supports it,
+    otherwise builds a dataframe and goes through score_input
+    returns: labels, decision scores, [ham probabilities, spam probabilities]
+    '''
+    if engine is None:
+        return score_input(process_batch_input(emails))
+
+    texts = [combine_text(email.get('subject') or '', email['message']) for email in emails]
+    predict_scores = engine.decision_function(texts, day_of_week=email_days(emails), repeat_freq=1)
+    return engine.predict(predict_scores), predict_scores, convert_score_to_prob(predict_scores)
+
+#run one prediction at start up so the first real request does not pay for
+#lazy imports, regex compilation and page faults of the memory mapped model
+if os.environ.get('APP_WARMUP', '1') == '1':
+    warmup_start = time.perf_counter()
+    try:
+        score_emails([{'subject':'warm up', 'message':'warm up prediction'}])
+        log_timing('first_inference', warmup_start)
+    except Exception as e:
+        print(f"Exact error:{type(e).__name__}:{e}\nWarm up prediction failed")
+log_timing('ready', import_start)
+
 @app.route('/') #when the page is visited the flask app is run
 def home():
     '''Home page with the form'''
@@ -56,17 +176,15 @@ def predict():
     try:
         subject = request.form.get('subject','')
         message = request.form.get('message','')
+        date = request.form.get('date')
 
         if not message:
             return jsonify({'error':'message cannot be empty'})
         
-        #process user input
-        precessed_input = process_user_input(subject, message)
-        
         #make prediction
-        result = (pipeline.predict(precessed_input))[0] #0 for spam
-        predict_score = (pipeline.decision_function(precessed_input))[0]
-        predict_proba = convert_score_to_prob(predict_score)
+        labels, _, (ham_proba, spam_proba) = score_emails([{'subject':subject, 'message':message, 'date':date}])
+        result = labels[0] #1 for spam
+        predict_proba = [ham_proba[0], spam_proba[0]]
 
         prediction = "Spam" if result == 1 else "Not Spam"
 
@@ -93,13 +211,11 @@ def predict_api():
         if not message:
             return jsonify({'error':'message cannot be empty'})
         
-        #process user input
-        precessed_input = process_user_input(subject, message)
-        
-        #make prediction
-        result = (pipeline.predict(precessed_input))[0] #0 for spam
-        predict_score = (pipeline.decision_function(precessed_input))[0]
-        predict_proba = convert_score_to_prob(predict_score)
+        #make prediction, the optional date or raw headers give day_of_week
+        labels, _, (ham_proba, spam_proba) = score_emails([{'subject':subject, 'message':message,
+                                                            'date':data.get('date'), 'headers':data.get('headers')}])
+        result = labels[0] #1 for spam
+        predict_proba = [ham_proba[0], spam_proba[0]]
 
         prediction = "Spam" if result == 1 else "Not Spam"
 
@@ -115,6 +231,44 @@ def predict_api():
         print('Error in route')
         return jsonify({'error':str(e)}) 
     
+
+@app.route('/predict_batch', methods=['Post'])
+def predict_batch():
+    '''
+    API endpoint for scoring many emails in one request
+    expects a json array of {"subject":..., "message":...} objects,
+    each with an optional "date" or raw "headers" block for day_of_week
+    all valid emails go through the pipeline in a single call,
+    results are returned in the same order as the input
+    '''
+    try:
+        emails = request.get_json()
+        if not isinstance(emails, list):
+            return jsonify({'error':'expected a json array of emails'})
+        if len(emails) > MAX_BATCH_SIZE:
+            return jsonify({'error':f'batch is limited to {MAX_BATCH_SIZE} emails'})
+        print(f'batch of {len(emails)} emails received')
+
+        #emails without a message (or not made of strings) are reported in place instead of failing the batch
+        results = [{'error':email_error(email)} for email in emails]
+        valid = [i for i, result in enumerate(results) if result['error'] is None]
+        if not valid:
+            return jsonify({'results':results})
+
+        #one vectorization and one model call for the whole batch
+        labels, _, (ham_proba, spam_proba) = score_emails([emails[i] for i in valid])
+
+        for i, label, spam, ham in zip(valid, labels, spam_proba*100, ham_proba*100):
+            results[i] = {'Prediction':"Spam" if label == 1 else "Not Spam",
+                          'Spam probability':float(spam),
+                          'Ham probability':float(ham)
+                          }
+
+        return jsonify({'results':results})
+    except Exception as e:
+        print('Error in route')
+        return jsonify({'error':str(e)})
+
     
 if __name__=='__main__':
     #app.run(debug=True)
@@ -0,0 +1,87 @@
+'''
+Measures time to first prediction of the container entry point
+
+Each run starts the app the same way the Dockerfile does (gunicorn app:app),
+polls /predict_api until the first prediction comes back and stops the server.
+Results are appended to a csv so cold start times can be tracked over changes.
+
+    python benchmark_cold_start.py --runs 5
+    python benchmark_cold_start.py --command "docker run --rm -p 8080:8080 spam_detector_lambda"
+'''
+import argparse
+import json
+import os
+import shlex
+import statistics
+import subprocess
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+import pandas as pd
+
+EMAIL = {'subject': 'Cold start', 'message': 'Measuring the time to the first prediction'}
+
+
+def first_prediction_time(command, url, timeout):
+    '''
+    Starts the server with command and returns the seconds until
+    the first successful prediction, None if it did not answer in time
+    '''
+    start = time.perf_counter()
+    server = subprocess.Popen(shlex.split(command), cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    body = json.dumps(EMAIL).encode()
+    try:
+        while time.perf_counter() - start < timeout:
+            if server.poll() is not None:
+                return None #server exited before answering
+            request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+            try:
+                with urllib.request.urlopen(request, timeout=timeout) as response:
+                    if 'Prediction' in json.loads(response.read()):
+                        return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                pass #not listening yet
+            time.sleep(0.01)
+        return None
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark time to first prediction of the Lambda app')
+    parser.add_argument('--command', default='gunicorn -b 127.0.0.1:8080 app:app', help='command that starts the server')
+    parser.add_argument('--url', default='http://127.0.0.1:8080/predict_api')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for each run')
+    parser.add_argument('--output', default='cold_start_results.csv', help='csv the results are appended to')
+    args = parser.parse_args()
+
+    times = []
+    for run in range(args.runs):
+        seconds = first_prediction_time(args.command, args.url, args.timeout)
+        print(f'Run {run + 1}: ' + (f'{seconds:.3f}s' if seconds is not None else 'no prediction'))
+        if seconds is not None:
+            times.append(seconds)
+    if not times:
+        print('The server never returned a prediction, check the command and url')
+        return
+
+    summary = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'command': args.command,
+        'runs': len(times),
+        'median time to first prediction': round(statistics.median(times), 4),
+        'min time to first prediction': round(min(times), 4),
+        'max time to first prediction': round(max(times), 4),
+    }
+    print(summary)
+    results_df = pd.DataFrame([summary])
+    results_df.to_csv(args.output, mode='a', index=False, header=not os.path.exists(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''
+day_of_week of an email from its Date header
+
+Training takes day_of_week from the Date column of each email
+(pd.to_datetime(...).dt.dayofweek, the day in the sender's own time zone).
+At inference the date comes with the request, either as a date string or
+inside a raw header block, and is parsed here:
+    1. rfc 2822 dates ("Tue, 13 Oct 2026 10:00:00 +0000", day name optional),
+       iso dates ("2026-10-13", "2026-10-13T10:00:00Z") and month first
+       dates ("10/13/2026 10:00", like pd.to_datetime) are matched with one
+       regex each, only the day, month and year are read
+    2. anything else goes through email.utils.parsedate_to_datetime
+    3. values that still do not parse give None, the caller falls back to
+       DEFAULT_DAY (not today's date, a backlog scored again gets the same scores)
+Parsed values are cached, a backlog repeats the same dates many times.
+'''
+import re
+from datetime import date
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+
+MONTHS = {month: number for number, month in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], start=1)}
+
+RFC_DATE = re.compile(r'\s*(?:[A-Za-z]+,?\s*)?(\d{1,2})\s+([A-Za-z]{3})[a-z]*\s+(\d{2,4})\b')
+ISO_DATE = re.compile(r'\s*(\d{4})-(\d{2})-(\d{2})(?:[T\s]|$)')
+US_DATE = re.compile(r'\s*(\d{1,2})/(\d{1,2})/(\d{4})(?:\s|$)')
+#Date line of a header block, with its folded continuation lines
+DATE_HEADER = re.compile(r'^Date:[ \t]*(.*(?:\r?\n[ \t].*)*)', re.IGNORECASE | re.MULTILINE)
+
+#longer values are not dates, they are not parsed nor cached
+MAX_DATE_CHARS = 100
+
+#day_of_week of emails without a usable date, the most common day of the
+#training data (tuesday, see notebooks/01_data_analysis.ipynb)
+DEFAULT_DAY = 1
+
+
+@lru_cache(maxsize=10000)
+def parse_day_of_week(value):
+    '''Day of the week (0 is monday) of a date string, None when it cannot be parsed'''
+    try:
+        match = RFC_DATE.match(value)
+        if match:
+            day, month, year = match.groups()
+            year = int(year)
+            if year < 100:
+                #rfc 2822 two digit years
+                year += 2000 if year < 50 else 1900
+            return date(year, MONTHS[month.lower()], int(day)).weekday()
+        match = ISO_DATE.match(value)
+        if match:
+            return date(*map(int, match.groups())).weekday()
+        match = US_DATE.match(value)
+        if match:
+            month, day, year = map(int, match.groups())
+            return date(year, month, day).weekday()
+        return parsedate_to_datetime(value).weekday()
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return None
+
+
+def header_date(headers):
+    '''Value of the Date header of a raw header block, None when it has none'''
+    match = DATE_HEADER.search(headers)
+    return re.sub(r'\r?\n[ \t]+', ' ', match.group(1)).strip() if match else None
+
+
+def day_of_week(date_value=None, headers=None):
+    '''
+    day_of_week of one email from a date (string, date or datetime) or a raw header block
+    returns: day of the week or None, where it came from ('date', 'headers', 'missing' or 'invalid')
+    '''
+    invalid = False
+    for source, value in (('date', date_value), ('headers', header_date(headers) if isinstance(headers, str) else None)):
+        if isinstance(value, date):
+            return value.weekday(), source
+        if isinstance(value, str) and value.strip():
+            day = parse_day_of_week(value) if len(value) <= MAX_DATE_CHARS else None
+            if day is not None:
+                return day, source
+            invalid = True
+        elif value is not None:
+            invalid = True
+    return None, 'invalid' if invalid else 'missing'
@@ -0,0 +1,369 @@
+'''
+Fast path inference for the deployed tfidf + linear model pipeline
+
+The sklearn pipeline expects a dataframe which the ColumnTransformer then
+splits up again, for a single email that costs more than the model itself.
+CompiledSpamModel reads the fitted pieces out of the pipeline once
+(vocabulary, idf weights, scaler mean/scale, model coef/intercept) and
+scores the raw text directly: tokenize, sparse dot product, add the
+scaled numeric features. Scores match pipeline.decision_function.
+
+The compiled weights can also be exported to a compact directory of .npy
+files (a hashed string table for the vocabulary plus the weight arrays)
+which load with np.load(mmap_mode='r'), so gunicorn workers share the
+pages instead of each unpickling the 67k term vocabulary:
+
+    python fast_model.py models/spam_trained_model.joblib models/spam_model_compact
+'''
+import argparse
+import hashlib
+import json
+import os
+import re
+import zlib
+from collections import Counter
+import numpy as np
+
+#numeric columns the app can fill in at inference time
+NUMERIC_COLUMNS = ('day_of_week', 'repeat_freq')
+
+#file names inside a compact model directory
+COMPACT_ARRAYS = ('terms', 'offsets', 'slots', 'idf', 'text_coef')
+COMPACT_META = 'meta.json'
+
+
+def combine_text(subject, message):
+    '''Combines subject and message the same way process_user_input does'''
+    return f'{subject.strip()} {message.strip()}'
+
+
+def file_sha256(path):
+    '''Hash of a file, used to tie a compact export to the joblib it came from'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StringTable:
+    '''
+    Read only term -> index lookup stored in three flat arrays
+        terms: utf-8 bytes of all terms back to back, in feature index order
+        offsets: start of each term in terms, plus the end of the last one
+        slots: open addressing hash table (crc32, linear probing) of term indexes, -1 is empty
+    the arrays can be memory mapped, nothing is copied into python objects
+    '''
+    def __init__(self, terms, offsets, slots):
+        self.terms = terms
+        self.offsets = offsets
+        self.slots = slots
+        self.mask = len(slots) - 1
+
+    @classmethod
+    def from_vocabulary(cls, vocabulary):
+        '''Builds the table from a {term: index} dict such as TfidfVectorizer.vocabulary_'''
+        ordered = sorted(vocabulary, key=vocabulary.get)
+        encoded = [term.encode('utf-8') for term in ordered]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(term) for term in encoded])
+        terms = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        #power of two with a load factor of at most 0.5 keeps probe chains short
+        size = 1 << max(3, (2 * len(encoded) - 1).bit_length())
+        slots = np.full(size, -1, dtype=np.int32)
+        for index, term in enumerate(encoded):
+            slot = zlib.crc32(term) & (size - 1)
+            while slots[slot] >= 0:
+                slot = (slot + 1) & (size - 1)
+            slots[slot] = index
+        return cls(terms, offsets, slots)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, term, default=None):
+        key = term.encode('utf-8')
+        slot = zlib.crc32(key) & self.mask
+        while True:
+            index = int(self.slots[slot])
+            if index < 0:
+                return default
+            start, end = self.offsets[index], self.offsets[index + 1]
+            if end - start == len(key) and self.terms[start:end].tobytes() == key:
+                return index
+            slot = (slot + 1) & self.mask
+
+
+class CompiledSpamModel:
+    '''
+    Scores raw emails with the weights of a fitted
+    ColumnTransformer(TfidfVectorizer, StandardScaler) + linear model pipeline
+    without going through pandas or sklearn input validation
+
+    vocabulary can be any mapping with a .get(term) method returning
+    the feature index, the arrays can be in memory or memory mapped
+    '''
+    def __init__(self, vocabulary, idf, text_coef, numeric_coef, intercept,
+                 scaler_mean, scaler_scale, numeric_columns=NUMERIC_COLUMNS, classes=(0, 1),
+                 token_pattern=r"(?u)\b\w\w+\b", lowercase=True, ngram_range=(1, 1),
+                 binary=False, sublinear_tf=False, norm='l2', text_coef_scale=1.0):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.text_coef = text_coef
+        #quantized (int8) coefficients are stored as integers times this scale
+        self.text_coef_scale = float(text_coef_scale)
+        self.classes = np.asarray(classes)
+        self.numeric_columns = tuple(numeric_columns)
+        self.token_pattern = token_pattern
+        self.lowercase = lowercase
+        self.ngram_range = tuple(ngram_range)
+        self.binary = binary
+        self.sublinear_tf = sublinear_tf
+        self.norm = norm
+        self._tokenize = re.compile(token_pattern).findall
+
+        #fold the scaler into the coefficients: coef*(x-mean)/scale = (coef/scale)*x - coef*mean/scale
+        numeric_coef = np.asarray(numeric_coef, dtype=np.float64)
+        scaler_mean = np.zeros_like(numeric_coef) if scaler_mean is None else np.asarray(scaler_mean, dtype=np.float64)
+        scaler_scale = np.ones_like(numeric_coef) if scaler_scale is None else np.asarray(scaler_scale, dtype=np.float64)
+        self.numeric_weights = numeric_coef / scaler_scale
+        self.intercept = float(intercept) - float(np.dot(self.numeric_weights, scaler_mean))
+
+    @classmethod
+    def from_pipeline(cls, pipeline):
+        '''
+        Builds the compiled model from a fitted pipeline
+        raises ValueError when the pipeline is not a tfidf + scaler + linear model
+        '''
+        preprocessor, model = pipeline[0], pipeline[-1]
+        if len(pipeline) != 2 or not hasattr(preprocessor, 'transformers_'):
+            raise ValueError('expected a fitted Pipeline([ColumnTransformer, model])')
+        if preprocessor.remainder != 'drop':
+            raise ValueError('ColumnTransformer remainder must be dropped')
+
+        vectorizer = scaler = None
+        for name, transformer, columns in preprocessor.transformers_:
+            if name == 'remainder':
+                continue
+            kind = type(transformer).__name__
+            if kind == 'TfidfVectorizer' and isinstance(columns, str):
+                vectorizer, text_slice = transformer, preprocessor.output_indices_[name]
+            elif kind == 'StandardScaler' and set(columns) <= set(NUMERIC_COLUMNS):
+                scaler, numeric_slice, numeric_columns = transformer, preprocessor.output_indices_[name], list(columns)
+            else:
+                raise ValueError(f'unsupported transformer {name}: {kind} on {columns}')
+        if vectorizer is None:
+            raise ValueError('pipeline has no TfidfVectorizer')
+
+        if (vectorizer.analyzer != 'word' or vectorizer.tokenizer is not None or vectorizer.preprocessor is not None
+                or vectorizer.stop_words is not None or vectorizer.strip_accents is not None):
+            raise ValueError('only the default word analyzer of TfidfVectorizer is supported')
+        if not hasattr(model, 'coef_') or model.coef_.shape[0] != 1 or len(model.classes_) != 2:
+            raise ValueError(f'{type(model).__name__} is not a binary linear model')
+
+        coef = model.coef_[0]
+        if scaler is None:
+            numeric_slice, numeric_columns = slice(0, 0), []
+        idf = vectorizer.idf_ if vectorizer.use_idf else np.ones(len(vectorizer.vocabulary_))
+        return cls(
+            vocabulary=vectorizer.vocabulary_,
+            idf=np.asarray(idf, dtype=np.float64),
+            text_coef=np.asarray(coef[text_slice], dtype=np.float64),
+            numeric_coef=coef[numeric_slice],
+            intercept=model.intercept_[0],
+            scaler_mean=getattr(scaler, 'mean_', None),
+            scaler_scale=getattr(scaler, 'scale_', None),
+            numeric_columns=numeric_columns,
+            classes=model.classes_,
+            token_pattern=vectorizer.token_pattern,
+            lowercase=vectorizer.lowercase,
+            ngram_range=vectorizer.ngram_range,
+            binary=vectorizer.binary,
+            sublinear_tf=vectorizer.sublinear_tf,
+            norm=vectorizer.norm,
+        )
+
+    @classmethod
+    def load_compact(cls, path):
+        '''
+        Loads a model written by export_compact
+        the arrays are memory mapped read only so workers share the pages
+        '''
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in COMPACT_ARRAYS}
+        with open(os.path.join(path, COMPACT_META)) as f:
+            meta = json.load(f)
+        vocabulary = StringTable(arrays['terms'], arrays['offsets'], arrays['slots'])
+        return cls(vocabulary, arrays['idf'], arrays['text_coef'], **meta['params'])
+
+    def export_compact(self, path, source_sha256=None, coef_dtype='float64'):
+        '''
+        Writes the model to a directory of .npy arrays plus a meta.json
+        with the scalar parameters, see load_compact
+        coef_dtype: 'float16' or 'int8' store the text coefficients quantized (lossy
+        unless they were quantized the same way before, see src/compress_model.py)
+        '''
+        vocabulary = self.vocabulary
+        if not isinstance(vocabulary, StringTable):
+            vocabulary = StringTable.from_vocabulary(vocabulary)
+        os.makedirs(path, exist_ok=True)
+        text_coef, text_coef_scale = np.asarray(self.text_coef), self.text_coef_scale
+        if coef_dtype == 'int8':
+            step = float(np.abs(text_coef).max()) / 127 if len(text_coef) else 0.0
+            step = step or 1.0
+            text_coef, text_coef_scale = np.round(text_coef / step).astype(np.int8), text_coef_scale * step
+        elif coef_dtype != 'float64':
+            text_coef = text_coef.astype(coef_dtype)
+        arrays = {'terms': vocabulary.terms, 'offsets': vocabulary.offsets, 'slots': vocabulary.slots,
+                  'idf': self.idf, 'text_coef': text_coef}
+        for name in COMPACT_ARRAYS:
+            np.save(os.path.join(path, f'{name}.npy'), np.ascontiguousarray(arrays[name]))
+
+        #the scaler is already folded into numeric_weights and intercept
+        params = {
+            'numeric_coef': self.numeric_weights.tolist(),
+            'intercept': self.intercept,
+            'scaler_mean': None,
+            'scaler_scale': None,
+            'numeric_columns': list(self.numeric_columns),
+            'classes': self.classes.tolist(),
+            'token_pattern': self.token_pattern,
+            'lowercase': self.lowercase,
+            'ngram_range': list(self.ngram_range),
+            'binary': self.binary,
+            'sublinear_tf': self.sublinear_tf,
+            'norm': self.norm,
+            'text_coef_scale': text_coef_scale,
+        }
+        with open(os.path.join(path, COMPACT_META), 'w') as f:
+            json.dump({'source_sha256': source_sha256, 'params': params}, f, indent=2)
+
+    def analyze(self, text):
+        '''Splits text into the terms TfidfVectorizer would produce'''
+        if self.lowercase:
+            text = text.lower()
+        tokens = self._tokenize(text)
+        min_n, max_n = self.ngram_range
+        if max_n == 1:
+            return tokens
+        #same ngram order as sklearn's _word_ngrams
+        terms = list(tokens) if min_n == 1 else []
+        for n in range(max(min_n, 2), min(max_n, len(tokens)) + 1):
+            terms.extend(' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+        return terms
+
+    def text_score(self, text):
+        '''Dot product of the normalized tfidf vector of text with the model coefficients'''
+        counts = {}
+        get = self.vocabulary.get
+        for term, count in Counter(self.analyze(text)).items():
+            index = get(term)
+            if index is not None:
+                counts[int(index)] = count
+        if not counts:
+            return 0.0
+
+        index = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        tf = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+        if self.binary:
+            tf[:] = 1.0
+        elif self.sublinear_tf:
+            tf = np.log(tf) + 1
+        weights = tf * self.idf[index]
+        score = float(np.dot(weights, self.text_coef[index])) * self.text_coef_scale
+        if self.norm == 'l2':
+            score /= np.sqrt(np.dot(weights, weights))
+        elif self.norm == 'l1':
+            score /= np.abs(weights).sum()
+        return score
+
+    def score(self, subject, message, day_of_week, repeat_freq=1):
+        '''Decision score of a single email'''
+        return self.text_score(combine_text(subject, message)) + float(self.numeric_score(day_of_week, repeat_freq))
+
+    def text_scores(self, texts):
+        '''Text part of the decision scores for a list of combined texts'''
+        return np.fromiter((self.text_score(text) for text in texts), dtype=np.float64, count=len(texts))
+
+    def numeric_score(self, day_of_week, repeat_freq=1):
+        '''
+        Intercept plus the scaled numeric features part of the decision score
+        day_of_week and repeat_freq are scalars or arrays
+        '''
+        numeric = {'day_of_week': day_of_week, 'repeat_freq': repeat_freq}
+        score = self.intercept
+        for column, weight in zip(self.numeric_columns, self.numeric_weights):
+            score = score + weight * np.asarray(numeric[column], dtype=np.float64)
+        return score
+
+    def decision_function(self, texts, day_of_week, repeat_freq=1):
+        '''
+        Decision scores for a list of combined texts
+        day_of_week and repeat_freq are scalars or one value per text
+        '''
+        return self.text_scores(texts) + self.numeric_score(day_of_week, repeat_freq)
+
+    def predict(self, scores):
+        '''Labels for decision scores, positive scores are the second class'''
+        return self.classes[(np.asarray(scores) > 0).astype(int)]
+
+
+def read_compact_source(path):
+    '''Returns the sha256 of the joblib file a compact model was exported from'''
+    with open(os.path.join(path, COMPACT_META)) as f:
+        return json.load(f).get('source_sha256')
+
+
+def check_parity(pipeline, engine, texts, day_of_week=0, repeat_freq=1, tolerance=1e-9):
+    '''
+    Compares engine scores with pipeline.decision_function on the same texts
+    returns the largest absolute difference, raises ValueError above tolerance
+    '''
+    import pandas as pd
+    df = pd.DataFrame({
+        'combined_with_stopwords': texts,
+        'day_of_week': day_of_week,
+        'repeat_freq': repeat_freq
+    }, index=range(len(texts)))
+    expected = pipeline.decision_function(df)
+    scores = engine.decision_function(texts, day_of_week=day_of_week, repeat_freq=repeat_freq)
+    max_diff = float(np.max(np.abs(expected - scores))) if len(texts) else 0.0
+    if max_diff > tolerance:
+        raise ValueError(f'compact model differs from the pipeline by {max_diff}')
+    return max_diff
+
+
+#emails used for the parity check when no csv is given
+PARITY_EMAILS = [
+    ("URGENT: You've Won $1,000,000!!!", "Congratulations! You have been selected as our GRAND PRIZE WINNER! Click here NOW to claim your prize!"),
+    ("Meeting tomorrow at 3pm", "Hi, just confirming our project meeting scheduled for tomorrow at 3pm in conference room B."),
+    ("FREE PILLS! VIAGRA! NO PRESCRIPTION NEEDED!", "Get FREE pills delivered to your door! Order now and save 90%!"),
+    ("", "Quick question about the presentation"),
+    ("Test", "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 50),
+]
+
+
+def main():
+    import joblib
+    parser = argparse.ArgumentParser(description='Export the joblib pipeline to a compact memory mapped model')
+    parser.add_argument('model', help='path to spam_trained_model.joblib')
+    parser.add_argument('output', help='directory to write the compact model to')
+    parser.add_argument('--csv', help='csv with Subject and Message columns to use for the parity check')
+    args = parser.parse_args()
+
+    pipeline = joblib.load(args.model)
+    CompiledSpamModel.from_pipeline(pipeline).export_compact(args.output, source_sha256=file_sha256(args.model))
+    engine = CompiledSpamModel.load_compact(args.output)
+
+    emails = PARITY_EMAILS
+    if args.csv:
+        import pandas as pd
+        data = pd.read_csv(args.csv, usecols=['Subject', 'Message']).fillna('')
+        emails = list(zip(data['Subject'], data['Message']))
+    texts = [combine_text(subject, message) for subject, message in emails]
+    max_diff = max(check_parity(pipeline, engine, texts, day_of_week=day) for day in range(7))
+    print(f'Exported {len(engine.vocabulary)} terms to {args.output}, max score difference {max_diff:.2e} on {len(texts)} emails')
+
+
+if __name__ == '__main__':
+    main()
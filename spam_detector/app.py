@@ -1,50 +1,420 @@
-from flask import Flask, request, render_template, jsonify 
+from flask import Flask, request, render_template, jsonify, Response
 import pandas as pd
 import numpy as np
+import hmac
 import joblib 
-from datetime import datetime
+import json
 import os
+import tempfile
+import threading
+import time
+from contextlib import nullcontext
+from calibration import DEFAULT_THRESHOLD, Calibrator
+from cascade import Cascade
+from email_date import DEFAULT_DAY, day_of_week as email_day_of_week
+from fast_model import PARITY_EMAILS, CompiledSpamModel, combine_text
+from input_guard import InputGuard
+from metrics import Metrics
+from model_registry import CANARY_FILE, MODEL_FILE, ModelRegistry, ModelWatcher, load_model, run_canary
+from online_learning import FeedbackLog, OnlineUpdater, RateLimiter, parse_label
+from prediction_cache import PredictionCache
+from repeat_counter import RepeatCounter
+from request_profiler import from_environ as request_profiler
 
 print('Starting app')
 #initialize falsk app
 app = Flask(__name__)
 
-#load trained pipline, does it once when the app starts
-print('Importing new pipline')
-try:
-    model_path = os.path.join(os.path.dirname(__file__), 'models', 'spam_trained_model.joblib')
-    pipeline = joblib.load(model_path)
-    print('Pipeline imported successfully')
-except Exception as e:
-    pipeline = None
-    print(f"Exact error:{type(e).__name__}:{e}\nCould not load the pipeline")
+#bundled model files, used when the registry has no version to serve
+models_dir = os.path.join(os.path.dirname(__file__), 'models')
+registry = ModelRegistry(os.environ.get('MODEL_REGISTRY', os.path.join(models_dir, 'registry')))
 
+pipeline = None
+engine = None
+active_version = None
+active_dir = None
+loaded_at = None
+#the registry's version goes through the same canary as a hot reload before it is served
+version = registry.target()
+if version is not None:
+    try:
+        pipeline, engine = load_model(registry.version_dir(version))
+        run_canary(registry.version_dir(version), pipeline, engine)
+        active_version, active_dir = version, registry.version_dir(version)
+    except Exception as e:
+        pipeline = engine = None
+        print(f"Exact error:{type(e).__name__}:{e}\nCould not load model version {version}")
+if active_version is None:
+    try:
+        pipeline, engine = load_model(models_dir)
+        active_version, active_dir = 'bundled', models_dir
+    except Exception as e:
+        print(f"Exact error:{type(e).__name__}:{e}\nNo model loaded, waiting for a registry version")
+loaded_at = time.time() if active_version is not None else None
+
+def load_calibrator(directory):
+    '''calibration.json of a model directory, None falls back to the plain sigmoid'''
+    try:
+        return Calibrator.load(directory) if directory is not None else None
+    except Exception as e:
+        print(f"Exact error:{type(e).__name__}:{e}\nUsing uncalibrated probabilities")
+        return None
+
+calibrator = load_calibrator(active_dir)
+
+def load_cascade(directory):
+    '''cascade.json of a model directory, None sends every email to the full model (CASCADE=0 turns it off)'''
+    if directory is None or os.environ.get('CASCADE', '1') != '1':
+        return None
+    try:
+        return Cascade.load(directory)
+    except Exception as e:
+        print(f"Exact error:{type(e).__name__}:{e}\nScoring every email with the full model")
+        return None
+
+cascade = load_cascade(active_dir)
+#widens (>1) or narrows (<1) the uncertainty band of cascade.json
+CASCADE_BAND_SCALE = float(os.environ.get('CASCADE_BAND_SCALE', 1.0))
+#spam probability at which an email is labelled spam, overrides the threshold of calibration.json
+SPAM_THRESHOLD = float(os.environ['SPAM_THRESHOLD']) if os.environ.get('SPAM_THRESHOLD') else None
+
+#day_of_week of emails without a usable date (0 is monday)
+DEFAULT_DAY_OF_WEEK = int(os.environ.get('DEFAULT_DAY_OF_WEEK', DEFAULT_DAY))
+#largest number of emails accepted by /predict_batch in one request
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 10000))
+#larger request bodies are refused before they are parsed
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_REQUEST_BYTES', 32 * 1024 * 1024)) or None
+#bounded cost per email: characters kept, encoded blobs removed, tokens kept (0 turns a limit off)
+input_guard = InputGuard(max_chars=int(os.environ.get('MAX_EMAIL_CHARS', 200000)),
+                         max_tokens=int(os.environ.get('MAX_EMAIL_TOKENS', 10000)),
+                         strip_blobs=os.environ.get('STRIP_BLOBS', '1') == '1')
+
+#scores of recently seen emails, CACHE_SIZE=0 turns the cache off
+prediction_cache = PredictionCache(capacity=int(os.environ.get('CACHE_SIZE', 10000)),
+                                   ttl=float(os.environ.get('CACHE_TTL', 3600)))
+
+#request counters and per stage latency histograms, served on /metrics
+metrics = Metrics()
+
+#off unless PROFILE_SAMPLE_EVERY or PROFILE_SECRET is set, see request_profiler.py
+profiler = request_profiler()
+
+#streaming repeat_freq shared by the workers through a memory mapped file,
+#REPEAT_COUNTER=0 goes back to a constant repeat_freq of 1
+repeat_counter = None
+if os.environ.get('REPEAT_COUNTER', '1') == '1':
+    try:
+        repeat_counter = RepeatCounter(
+            path=os.environ.get('REPEAT_COUNTER_PATH', os.path.join(tempfile.gettempdir(), 'spam_repeat_counter.bin')) or None,
+            half_life=float(os.environ.get('REPEAT_HALF_LIFE', 86400)))
+    except Exception as e:
+        print(f"Exact error:{type(e).__name__}:{e}\nUsing a constant repeat_freq of 1")
+
+#the feedback updater and the registry watcher swap in new models, requests read
+#pipeline, engine and model_version together under model_lock so they never mix two models
+model_lock = threading.Lock()
+model_version = 0
+
+
+def current_model():
+    '''pipeline, engine, calibrator, cascade and version of the model being served'''
+    with model_lock:
+        return pipeline, engine, calibrator, cascade, model_version
+
+def swap_model(new_pipeline):
+    '''Serves new_pipeline from now on, called by the feedback updater thread'''
+    global pipeline, engine, model_version
+    try:
+        new_engine = CompiledSpamModel.from_pipeline(new_pipeline)
+    except ValueError:
+        new_engine = None
+    with model_lock:
+        pipeline, engine, model_version = new_pipeline, new_engine, model_version + 1
+    #cached scores are keyed on the version, clearing just frees the old entries
+    prediction_cache.clear()
+
+def switch_version(version, directory, new_pipeline, new_engine):
+    '''
+    Serves a registry version from now on, called by the registry watcher
+    once the version passed its canary, feedback is then replayed on top of it
+    '''
+    global pipeline, engine, calibrator, cascade, model_version, active_version, active_dir, loaded_at
+    new_calibrator, new_cascade = load_calibrator(directory), load_cascade(directory)
+    #the updater lock keeps a feedback pass on the old version from being swapped in afterwards
+    with (online_updater.lock if online_updater is not None else nullcontext()):
+        with model_lock:
+            pipeline, engine, calibrator, cascade = new_pipeline, new_engine, new_calibrator, new_cascade
+            model_version += 1
+            active_version, active_dir, loaded_at = version, directory, time.time()
+        prediction_cache.clear()
+        if online_updater is not None:
+            online_updater.reset()
+    if online_updater is not None:
+        online_updater.update()
+
+def load_pipeline():
+    '''Fitted pipeline the feedback updates start from, the compact model has no sklearn pipeline'''
+    return pipeline if pipeline is not None else joblib.load(os.path.join(active_dir, MODEL_FILE))
 
-def process_user_input(subject, message):
+def feedback_holdout():
+    '''
+    Held-out emails a feedback update may not move too much: the parity emails,
+    canary.json of the version served and the json list of FEEDBACK_HOLDOUT
+    '''
+    emails = [{'subject': subject, 'message': message} for subject, message in PARITY_EMAILS]
+    for path in (os.path.join(active_dir, CANARY_FILE), os.environ.get('FEEDBACK_HOLDOUT')):
+        if path and os.path.exists(path):
+            with open(path) as f:
+                emails = emails + json.load(f)
+    texts = [input_guard.limit(combine_text(email.get('subject') or '', email['message']))[0] for email in emails]
+    return process_texts(texts, DEFAULT_DAY_OF_WEEK)
+
+#user corrections, FEEDBACK_UPDATES=0 only records them without updating the model
+feedback_log = FeedbackLog(os.environ.get('FEEDBACK_LOG', os.path.join(tempfile.gettempdir(), 'spam_feedback.jsonl')))
+#shared secret of /feedback (X-Feedback-Token header), anyone can send feedback without it
+FEEDBACK_TOKEN = os.environ.get('FEEDBACK_TOKEN')
+#feedback requests per client and minute, 0 turns the limit off
+FEEDBACK_RATE_LIMIT = int(os.environ.get('FEEDBACK_RATE_LIMIT', 60))
+feedback_limiter = RateLimiter(FEEDBACK_RATE_LIMIT) if FEEDBACK_RATE_LIMIT > 0 else None
+online_updater = None
+if os.environ.get('FEEDBACK_UPDATES', '1') == '1' and (pipeline is not None or engine is not None):
+    online_updater = OnlineUpdater(feedback_log, load_pipeline, swap_model,
+                                   interval=float(os.environ.get('FEEDBACK_INTERVAL', 300)),
+                                   learning_rate=float(os.environ.get('FEEDBACK_LEARNING_RATE', 0.1)),
+                                   load_holdout=feedback_holdout,
+                                   max_duplicates=int(os.environ.get('FEEDBACK_MAX_DUPLICATES', 3)),
+                                   max_flips=float(os.environ.get('FEEDBACK_MAX_FLIPS', 0.05))).start()
+
+#hot reload of new registry versions, MODEL_WATCH=0 keeps the version loaded at start
+model_watcher = None
+if os.environ.get('MODEL_WATCH', '1') == '1':
+    model_watcher = ModelWatcher(registry, switch_version, active=active_version,
+                                 interval=float(os.environ.get('MODEL_POLL_INTERVAL', 30))).start()
+
+metrics.add_gauge('spam_cache_hits', 'Prediction cache hits', lambda: {(): prediction_cache.stats()['hits']})
+metrics.add_gauge('spam_cache_misses', 'Prediction cache misses', lambda: {(): prediction_cache.stats()['misses']})
+metrics.add_gauge('spam_cache_size', 'Scores held in the prediction cache', lambda: {(): prediction_cache.stats()['size']})
+metrics.add_gauge('spam_model_info', 'Registry version being served', lambda: {(str(active_version),): 1}, ('version',))
+metrics.add_gauge('spam_feedback_applied', 'Feedback records applied to the model',
+                  lambda: {(): online_updater.stats()['applied'] if online_updater is not None else 0})
+
+
+def process_user_input(subject, message, date=None, headers=None):
     '''
     Receives subject and message from user input
     combines them into a dataframe with the same structure
     as the one used for training
+    day_of_week comes from the optional date or raw headers, DEFAULT_DAY_OF_WEEK without them
     '''
-    current_date = datetime.now()
+    day_of_week = email_day_of_week(date, headers)[0]
     df = pd.DataFrame({
         'combined_with_stopwords': [f'{subject.strip()} {message.strip()}'],
-        'day_of_week':[current_date.weekday()],#today's date 
+        'day_of_week':[DEFAULT_DAY_OF_WEEK if day_of_week is None else day_of_week],
         'repeat_freq': [1] #frequency is 1
     })
     return df
 
-def convert_score_to_prob(pred):
+def process_texts(texts, day_of_week, repeat_freq=1):
+    '''
+    Receives combined subject + message texts
+    puts them into one dataframe with the same structure
+    as the one used for training, one row per text in input order
+    '''
+    df = pd.DataFrame({
+        'combined_with_stopwords': texts,
+        'day_of_week': day_of_week,
+        'repeat_freq': repeat_freq
+    }, index=range(len(texts)))
+    return df
+
+def convert_score_to_prob(pred, model_calibrator=None):
     """
     Convert LinearSVC decision function to probabilities
     Args:
         pred (array): Decision function scores from LinearSVC
+        model_calibrator (Calibrator): fitted calibration of the model, None uses a plain sigmoid
         Returns:
         array: probability of ham, probability of spam 
         """
-    spam_prob = 1 / (1 + np.exp(-pred))
+    if model_calibrator is not None:
+        spam_prob = model_calibrator.predict(pred)
+    else:
+        spam_prob = 1 / (1 + np.exp(-pred))
     return [1 - spam_prob, spam_prob] 
 
+def decision_threshold(model_calibrator=None):
+    """
+    Spam probability at which an email is labelled spam: SPAM_THRESHOLD, else the
+    threshold of calibration.json (0.5 when it has none), else None without a
+    calibration (positive decision scores are spam)
+    """
+    if SPAM_THRESHOLD is not None:
+        return SPAM_THRESHOLD
+    return model_calibrator.decision_threshold() if model_calibrator is not None else None
+
+def score_input(precessed_input, model_pipeline=None):
+    '''
+    Scores processed input with a single pass through the pipeline
+    the preprocessor (tfidf + scaler) transforms the data once, the decision
+    score is computed once and the label and probabilities are derived from it
+    model_pipeline defaults to the pipeline being served
+    returns: labels, decision scores, [ham probabilities, spam probabilities]
+    '''
+    if model_pipeline is None:
+        model_pipeline = current_model()[0]
+    with metrics.time_stage('tfidf'):
+        features = model_pipeline[:-1].transform(precessed_input)
+    model = model_pipeline[-1]
+    with metrics.time_stage('model'):
+        if hasattr(model, 'decision_function'):
+            predict_scores = model.decision_function(features)
+        else:
+            #models without a decision function (e.g. MultinomialNB), use the log odds of spam
+            spam_prob = np.clip(model.predict_proba(features)[:, 1], 1e-15, 1 - 1e-15)
+            predict_scores = np.log(spam_prob / (1 - spam_prob))
+    #same rule predict uses for binary linear models: positive score is the second class
+    labels = model.classes_[(predict_scores > 0).astype(int)]
+    return labels, predict_scores, convert_score_to_prob(predict_scores)
+
+def scores_to_labels(predict_scores, model_pipeline=None, model_engine=None, spam_prob=None, threshold=None):
+    '''
+    Labels for decision scores, positive scores are the second class
+    with a threshold, emails whose spam_prob reaches it are the second class instead
+    '''
+    if model_pipeline is None and model_engine is None:
+        model_pipeline, model_engine, _, _, _ = current_model()
+    classes = model_engine.classes if model_engine is not None else model_pipeline[-1].classes_
+    if threshold is not None:
+        return classes[(np.asarray(spam_prob) >= threshold).astype(int)]
+    return classes[(np.asarray(predict_scores) > 0).astype(int)]
+
+def email_error(email):
+    '''Why an item of a batch cannot be scored, None when it can'''
+    if not isinstance(email, dict) or not email.get('message'):
+        return 'message cannot be empty'
+    if not isinstance(email['message'], str) or not isinstance(email.get('subject') or '', str):
+        return 'subject and message must be strings'
+    return None
+
+def email_text(subject, message):
+    '''Combined subject + message within the input size limits'''
+    text, reasons = input_guard.limit(combine_text(subject, message))
+    for reason in reasons:
+        metrics.truncations.inc(reason)
+    return text
+
+def email_days(emails):
+    '''
+    day_of_week of each email from its 'date' or raw 'headers' (the Date header),
+    like in training, DEFAULT_DAY_OF_WEEK when it has neither or they do not parse
+    '''
+    days = np.empty(len(emails), dtype=np.int64)
+    for i, email in enumerate(emails):
+        day, source = email_day_of_week(email.get('date'), email.get('headers'))
+        metrics.dates.inc(source)
+        days[i] = DEFAULT_DAY_OF_WEEK if day is None else day
+    return days
+
+def count_repeats(emails):
+    '''repeat_freq of each email from the streaming counter, 1 when it is turned off'''
+    if repeat_counter is None:
+        return np.ones(len(emails))
+    return repeat_counter.add([RepeatCounter.fingerprint(email.get('subject') or '', email['message']) for email in emails])
+
+def cached_scores(keys, score_rows):
+    '''
+    Looks the keys up in prediction_cache, the missing rows are scored
+    with one call to score_rows(rows) and added to the cache
+    duplicates inside the batch are scored once as well
+    '''
+    predict_scores = np.array([prediction_cache.get(key, np.nan) for key in keys], dtype=np.float64)
+    missing = {}
+    for i in np.flatnonzero(np.isnan(predict_scores)):
+        missing.setdefault(keys[i], []).append(i)
+    if missing:
+        new_scores = score_rows([rows[0] for rows in missing.values()])
+        for (key, rows), score in zip(missing.items(), new_scores):
+            predict_scores[rows] = score
+            prediction_cache.put(key, score)
+    return predict_scores
+
+def score_emails(emails):
+    '''
+    Scores a list of emails, each a dict with a subject and message
+    uses the compiled fast path when the pipeline supports it,
+    otherwise builds a dataframe and goes through score_input
+    emails already in prediction_cache are answered from it
+    with a cascade, emails outside its uncertainty band are decided by its first
+    pass and their score is its naive bayes log odds (not on the scale of the
+    full model's scores) with its calibrated probability, only the others reach the full model
+    returns: labels, decision scores, [ham probabilities, spam probabilities]
+    '''
+    #one model for the whole batch even if it is swapped meanwhile
+    model_pipeline, model_engine, model_calibrator, model_cascade, version = current_model()
+    if model_pipeline is None and model_engine is None:
+        raise ValueError('no model is loaded')
+    day_of_week = email_days(emails)
+    with metrics.time_stage('repeat_count'):
+        repeat_freq = count_repeats(emails)
+    texts = [email_text(email.get('subject') or '', email['message']) for email in emails]
+
+    predict_scores = np.zeros(len(texts))
+    decided = np.zeros(len(texts), dtype=bool)
+    if model_cascade is not None:
+        with metrics.time_stage('cascade'):
+            first_scores = model_cascade.scores(texts)
+            decided = ~model_cascade.uncertain(first_scores, CASCADE_BAND_SCALE)
+        predict_scores[decided] = first_scores[decided]
+        metrics.cascade.inc('first_pass', amount=int(decided.sum()))
+        metrics.cascade.inc('full_model', amount=int(len(texts) - decided.sum()))
+    full = np.flatnonzero(~decided)
+    full_texts, full_freq, full_days = ([texts[i] for i in full], repeat_freq[full], day_of_week[full]) if decided.any() \
+        else (texts, repeat_freq, day_of_week)
+
+    if len(full) and model_engine is not None:
+        def score_rows(rows):
+            #tokenize, tfidf and model in one go, there is no separate tfidf stage on the fast path
+            with metrics.time_stage('fast_path'):
+                return model_engine.text_scores([full_texts[i] for i in rows])
+        #the text part of the score does not depend on day_of_week or repeat_freq, caching it on
+        #its own keeps a campaign email cached while its repeat_freq keeps growing
+        keys = [prediction_cache.make_key(text, version) for text in full_texts]
+        predict_scores[full] = cached_scores(keys, score_rows) + model_engine.numeric_score(full_days, full_freq)
+    elif len(full):
+        def score_rows(rows):
+            with metrics.time_stage('dataframe'):
+                df = process_texts([full_texts[i] for i in rows], full_days[rows], full_freq[rows])
+            return score_input(df, model_pipeline)[1]
+        keys = [prediction_cache.make_key(text, version, int(day), freq) for text, day, freq in zip(full_texts, full_days, full_freq)]
+        predict_scores[full] = cached_scores(keys, score_rows)
+    predict_proba = convert_score_to_prob(predict_scores, model_calibrator)
+    if decided.any():
+        #first pass log odds have their own calibration, fitted by cascade.py fit
+        predict_proba[1][decided] = model_cascade.probability(predict_scores[decided])
+        predict_proba[0][decided] = 1 - predict_proba[1][decided]
+    threshold = decision_threshold(model_calibrator)
+    labels = scores_to_labels(predict_scores, model_pipeline, model_engine, predict_proba[1], threshold)
+    if decided.any() and threshold is None:
+        #log odds and svc scores are not on the same scale, decided emails follow their calibrated probability
+        labels[decided] = scores_to_labels(predict_scores[decided], model_pipeline, model_engine,
+                                           predict_proba[1][decided], DEFAULT_THRESHOLD)
+    n_spam = int(np.count_nonzero(labels == 1))
+    metrics.predictions.inc('spam', amount=n_spam)
+    metrics.predictions.inc('ham', amount=len(labels) - n_spam)
+    return labels, predict_scores, predict_proba
+
+@app.before_request
+def start_timer():
+    request.start_time = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    '''Counts every request and adds its latency to the endpoint histogram'''
+    endpoint = request.endpoint or 'unknown'
+    metrics.requests.inc(endpoint)
+    metrics.request_seconds.observe(time.perf_counter() - request.start_time, endpoint)
+    return response
+
 @app.route('/') #when the page is visited the flask app is run
 def home():
     '''Home page with the form'''
@@ -54,67 +424,187 @@ def home():
 def predict():
     '''Gets data from http form and Handles the prediction'''
     try:
-        subject = request.form.get('subject','')
-        message = request.form.get('message','')
+        with metrics.time_stage('parse'):
+            subject = request.form.get('subject','')
+            message = request.form.get('message','')
+            date = request.form.get('date')
 
         if not message:
             return jsonify({'error':'message cannot be empty'})
         
-        #process user input
-        precessed_input = process_user_input(subject, message)
-        
         #make prediction
-        result = (pipeline.predict(precessed_input))[0] #0 for spam
-        predict_score = (pipeline.decision_function(precessed_input))[0]
-        predict_proba = convert_score_to_prob(predict_score)
+        labels, _, (ham_proba, spam_proba) = score_emails([{'subject':subject, 'message':message, 'date':date}])
+        result = labels[0] #1 for spam
+        predict_proba = [ham_proba[0], spam_proba[0]]
 
         prediction = "Spam" if result == 1 else "Not Spam"
 
-        return jsonify(
-            {'prediction':prediction,
-             'Spam_probability':f'{round(predict_proba[1]*100,2)}', 
-             'Ham_probability':f'{round(predict_proba[0]*100,2)}'
-             }
-        )
+        with metrics.time_stage('serialize'):
+            return jsonify(
+                {'prediction':prediction,
+                 'Spam_probability':f'{round(predict_proba[1]*100,2)}', 
+                 'Ham_probability':f'{round(predict_proba[0]*100,2)}'
+                 }
+            )
     except Exception as e:
         print('Error in route')
+        metrics.errors.inc(request.endpoint)
         return jsonify({'error':str(e)})
     
 print('finished')
 
 @app.route('/predict_api', methods=['Get','Post'])#localhost\predict_api
+@profiler.profiled_view
 def predict_api():
     '''API endpoint for programmatic access'''
     try:    
-        data = request.get_json()
-        subject = data.get('subject','')
-        message = data.get('message','')
+        with metrics.time_stage('parse'):
+            data = request.get_json()
+            subject = data.get('subject','')
+            message = data.get('message','')
         print('message received')
         if not message:
             return jsonify({'error':'message cannot be empty'})
         
-        #process user input
-        precessed_input = process_user_input(subject, message)
-        
-        #make prediction
-        result = (pipeline.predict(precessed_input))[0] #0 for spam
-        predict_score = (pipeline.decision_function(precessed_input))[0]
-        predict_proba = convert_score_to_prob(predict_score)
+        #make prediction, the optional date or raw headers give day_of_week
+        labels, _, (ham_proba, spam_proba) = score_emails([{'subject':subject, 'message':message,
+                                                            'date':data.get('date'), 'headers':data.get('headers')}])
+        result = labels[0] #1 for spam
+        predict_proba = [ham_proba[0], spam_proba[0]]
 
         prediction = "Spam" if result == 1 else "Not Spam"
 
-        return jsonify(
-          
-            {'Prediction':prediction,
-             'Spam probability':predict_proba[1]*100,
-             'Ham probability':predict_proba[0]*100
-             }
-             
-        )
+        with metrics.time_stage('serialize'):
+            return jsonify(
+              
+                {'Prediction':prediction,
+                 'Spam probability':predict_proba[1]*100,
+                 'Ham probability':predict_proba[0]*100,
+                 'Threshold':decision_threshold(current_model()[2])
+                 }
+                 
+            )
     except Exception as e:
         print('Error in route')
+        metrics.errors.inc(request.endpoint)
         return jsonify({'error':str(e)}) 
     
+
+@app.route('/predict_batch', methods=['Post'])
+@profiler.profiled_view
+def predict_batch():
+    '''
+    API endpoint for scoring many emails in one request
+    expects a json array of {"subject":..., "message":...} objects,
+    each with an optional "date" or raw "headers" block for day_of_week
+    all valid emails go through the pipeline in a single call,
+    results are returned in the same order as the input
+    '''
+    try:
+        with metrics.time_stage('parse'):
+            emails = request.get_json()
+        if not isinstance(emails, list):
+            return jsonify({'error':'expected a json array of emails'})
+        if len(emails) > MAX_BATCH_SIZE:
+            return jsonify({'error':f'batch is limited to {MAX_BATCH_SIZE} emails'})
+        print(f'batch of {len(emails)} emails received')
+
+        #emails without a message (or not made of strings) are reported in place instead of failing the batch
+        results = [{'error':email_error(email)} for email in emails]
+        valid = [i for i, result in enumerate(results) if result['error'] is None]
+        if not valid:
+            return jsonify({'results':results})
+
+        #one vectorization and one model call for the whole batch
+        labels, _, (ham_proba, spam_proba) = score_emails([emails[i] for i in valid])
+
+        for i, label, spam, ham in zip(valid, labels, spam_proba*100, ham_proba*100):
+            results[i] = {'Prediction':"Spam" if label == 1 else "Not Spam",
+                          'Spam probability':float(spam),
+                          'Ham probability':float(ham)
+                          }
+
+        with metrics.time_stage('serialize'):
+            return jsonify({'results':results, 'threshold':decision_threshold(current_model()[2])})
+    except Exception as e:
+        print('Error in route')
+        metrics.errors.inc(request.endpoint)
+        return jsonify({'error':str(e)})
+
+
+@app.route('/cache_stats', methods=['Get'])
+def cache_stats():
+    '''Hit/miss counters and size of the prediction cache'''
+    return jsonify(prediction_cache.stats())
+
+
+@app.route('/feedback', methods=['Post'])
+def feedback():
+    '''
+    Records the true label of an email
+    expects {"subject":..., "message":..., "label":"spam" or "ham"}, optionally a "date" or raw "headers"
+    the model learns from it on the next pass of the feedback updater
+    with FEEDBACK_TOKEN set the request needs it in the X-Feedback-Token header
+    '''
+    if FEEDBACK_TOKEN and not hmac.compare_digest(request.headers.get('X-Feedback-Token', '').encode(), FEEDBACK_TOKEN.encode()):
+        return jsonify({'error':'missing or invalid X-Feedback-Token'}), 401
+    if feedback_limiter is not None and not feedback_limiter.allow(request.remote_addr):
+        return jsonify({'error':'too many feedback requests, try again later'}), 429
+    try:
+        data = request.get_json()
+        if not isinstance(data, dict):
+            return jsonify({'error':'expected a json object'})
+        subject = data.get('subject') or ''
+        message = data.get('message','')
+        if not message:
+            return jsonify({'error':'message cannot be empty'})
+        label = parse_label(data.get('label'))
+
+        feedback_log.append({'time':time.time(),
+                             'text':email_text(subject, message),
+                             'day_of_week':int(email_days([data])[0]),
+                             'label':label
+                             })
+        return jsonify({'status':'recorded'})
+    except Exception as e:
+        print('Error in route')
+        metrics.errors.inc(request.endpoint)
+        return jsonify({'error':str(e)})
+
+
+@app.route('/feedback_stats', methods=['Get'])
+def feedback_stats():
+    '''Feedback applied so far and the version of the model being served'''
+    stats = online_updater.stats() if online_updater is not None else {'applied': 0, 'last_update': None}
+    return jsonify({**stats, 'model_version': current_model()[4], 'updates_enabled': online_updater is not None})
+
+
+@app.route('/metrics', methods=['Get'])
+def metrics_endpoint():
+    '''Counters and latency histograms in the Prometheus text format'''
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/model_info', methods=['Get'])
+def model_info():
+    '''Version being served and the state of the registry'''
+    with model_lock:
+        info = {'version':active_version,
+                'path':active_dir,
+                'loaded_at':loaded_at,
+                'fast_path':engine is not None,
+                'calibration':calibrator.method if calibrator is not None else None,
+                'threshold':decision_threshold(calibrator),
+                'cascade_band':[cascade.low * CASCADE_BAND_SCALE, cascade.high * CASCADE_BAND_SCALE] if cascade is not None else None,
+                'model_version':model_version
+                }
+    info.update({'registry':registry.path,
+                 'registry_target':registry.target(),
+                 'failed_versions':model_watcher.failed if model_watcher is not None else {},
+                 'feedback_applied':online_updater.applied if online_updater is not None else 0
+                 })
+    return jsonify(info)
+
     
 if __name__=='__main__':
     #app.run(debug=True)
@@ -0,0 +1,126 @@
+'''
+ASGI serving mode with request micro-batching
+
+Under gunicorn's sync workers every /predict_api request is scored on its own.
+This serves the prediction endpoints from an asyncio event loop instead:
+concurrent requests are queued for a few milliseconds and scored together
+with one call to score_emails (one vectorization pass), see micro_batcher.py.
+The model, the prediction cache, the repeat counter, the registry watcher and
+the feedback updater are the ones of app.py, only the request handling differs.
+
+    uvicorn asgi_app:app --port 5000
+    gunicorn -k uvicorn.workers.UvicornWorker -w 2 asgi_app:app
+
+Served here: POST /predict_api, POST /predict_batch and GET /batcher_stats,
+the web form, /feedback and the other endpoints stay on app.py.
+Configuration:
+    BATCH_MAX_SIZE: largest number of emails scored together (default 64)
+    BATCH_MAX_WAIT_MS: milliseconds the first email of a batch waits for more (default 5)
+'''
+import asyncio
+import json
+import os
+
+import app as spam_app
+from micro_batcher import MicroBatcher
+
+
+def score_batch(emails):
+    '''Scores queued emails together, one /predict_api result per email'''
+    labels, _, (ham_proba, spam_proba) = spam_app.score_emails(emails)
+    threshold = spam_app.decision_threshold(spam_app.current_model()[2])
+    return [{'Prediction':"Spam" if label == 1 else "Not Spam",
+             'Spam probability':float(spam),
+             'Ham probability':float(ham),
+             'Threshold':threshold
+             } for label, spam, ham in zip(labels, spam_proba*100, ham_proba*100)]
+
+
+batcher = MicroBatcher(score_batch,
+                       max_batch_size=int(os.environ.get('BATCH_MAX_SIZE', 64)),
+                       max_wait=float(os.environ.get('BATCH_MAX_WAIT_MS', 5)) / 1000)
+
+
+async def predict_api(data):
+    '''Same request and response as /predict_api of app.py'''
+    subject = data.get('subject','')
+    message = data.get('message','')
+    #checked here, a bad email would otherwise fail the whole batch it is scored with
+    error = spam_app.email_error(data)
+    if error is not None:
+        return {'error':error}
+    return await batcher.submit({'subject':subject, 'message':message,
+                                 'date':data.get('date'), 'headers':data.get('headers')})
+
+
+async def predict_batch(emails):
+    '''
+    Same request and response as /predict_batch of app.py
+    the request is already a batch, it is scored in one call on the batcher's thread
+    '''
+    if not isinstance(emails, list):
+        return {'error':'expected a json array of emails'}
+    if len(emails) > spam_app.MAX_BATCH_SIZE:
+        return {'error':f'batch is limited to {spam_app.MAX_BATCH_SIZE} emails'}
+    results = [{'error':spam_app.email_error(email)} for email in emails]
+    valid = [i for i, result in enumerate(results) if result['error'] is None]
+    scored = await asyncio.get_running_loop().run_in_executor(batcher.executor, score_batch, [emails[i] for i in valid]) if valid else []
+    for i, result in zip(valid, scored):
+        result.pop('Threshold')
+        results[i] = result
+    return {'results':results, 'threshold':spam_app.decision_threshold(spam_app.current_model()[2])}
+
+
+async def read_json(receive):
+    '''Request body as json, bodies over MAX_REQUEST_BYTES are refused while they are read'''
+    limit = spam_app.app.config['MAX_CONTENT_LENGTH']
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if limit and len(body) > limit:
+            raise ValueError(f'request body is limited to {limit} bytes')
+        if not message.get('more_body'):
+            break
+    return json.loads(body) if body else None
+
+
+async def send_json(send, data, status=200):
+    body = json.dumps(data).encode('utf-8')
+    await send({'type':'http.response.start',
+                'status':status,
+                'headers':[(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type':'http.response.body', 'body':body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            batcher.start()
+            await send({'type':'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await batcher.stop()
+            await send({'type':'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    '''ASGI entry point'''
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    route = (scope['method'], scope['path'])
+    try:
+        if route == ('POST', '/predict_api'):
+            return await send_json(send, await predict_api(await read_json(receive)))
+        if route == ('POST', '/predict_batch'):
+            return await send_json(send, await predict_batch(await read_json(receive)))
+        if route == ('GET', '/batcher_stats'):
+            return await send_json(send, batcher.stats())
+    except Exception as e:
+        print('Error in route')
+        return await send_json(send, {'error':str(e)})
+    await send_json(send, {'error':f'{scope["path"]} is not served in the asgi mode, use app.py'}, status=404)
@@ -0,0 +1,173 @@
+'''
+In-process micro-benchmarks of the preprocessing and inference stages
+
+Times every stage on its own (no HTTP) over synthetic emails and, optionally,
+a real corpus at several sizes, records the peak memory of each stage with
+tracemalloc and compares the result with a stored baseline:
+
+    python benchmark_stages.py --save-baseline benchmark_baseline.json
+    python benchmark_stages.py --baseline benchmark_baseline.json --threshold 0.2
+    python benchmark_stages.py --corpus ../data/X_test.csv --labels ../data/y_test.csv --sizes 1000
+
+Stages: clean_text (src/clean_email.py), clean_data + add_new_features +
+combine_data (src/preprocessor.py), process_user_input, process_texts, input_guard,
+pipeline.predict + decision_function, score_input, the compiled fast path,
+the cascade first pass (when the model has one)
+and convert_score_to_prob (app.py). Times are the median of --repeat runs.
+With --baseline the exit code is 1 when a stage got slower (or used more
+memory) than the baseline by more than --threshold.
+'''
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+#benchmarks load the model but must not start the background threads of the app
+for name in ('MODEL_WATCH', 'FEEDBACK_UPDATES', 'REPEAT_COUNTER'):
+    os.environ.setdefault(name, '0')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import app
+import preprocessor
+
+#words the synthetic emails are drawn from, mixes spam and ham vocabulary
+WORDS = ('meeting project report schedule tomorrow attached thanks regards team review '
+         'free offer winner click now prize money urgent account verify limited cash '
+         'deal save order shipping invoice password update call friday weekend lunch').split()
+
+
+def synthetic_corpus(size, seed=0):
+    '''Raw emails like X_train.csv / y_train.csv: Subject, Message, Date and Spam/Ham'''
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(20, 300, size)
+    messages = [' '.join(rng.choice(WORDS, n)) + '!' for n in lengths]
+    X = pd.DataFrame({
+        'Subject': [' '.join(rng.choice(WORDS, 4)).title() for _ in range(size)],
+        'Message': messages,
+        'Date': pd.Timestamp('2026-01-01') + pd.to_timedelta(rng.integers(0, 365, size), unit='D'),
+    })
+    y = pd.DataFrame({'Spam/Ham': rng.choice(['spam', 'ham'], size)})
+    return X, y
+
+
+def real_corpus(corpus, labels, size):
+    '''First size emails of a raw csv, the labels default to ham when no label csv is given'''
+    X = pd.read_csv(corpus, nrows=size)
+    y = pd.read_csv(labels, nrows=size) if labels else pd.DataFrame({'Spam/Ham': ['ham'] * len(X)})
+    #cleaned together so every label stays with its email when rows are dropped
+    X, y = preprocessor.clean_data(X, y)
+    y = pd.DataFrame({'Spam/Ham': y.map({0: 'ham', 1: 'spam'}).to_numpy()})
+    return X.reset_index(drop=True), y
+
+
+def stages(X, y):
+    '''
+    The functions to time, each takes no arguments and works on copies of
+    its input so every repeat does the same work
+    '''
+    subjects, messages = list(X['Subject'].fillna('')), list(X['Message'])
+    texts = [app.combine_text(subject, message) for subject, message in zip(subjects, messages)]
+    frame = app.process_texts(texts, 0, 1)
+    model_pipeline, engine, _, model_cascade, _ = app.current_model()
+    scores = np.linspace(-3, 3, len(texts))
+
+    result = {
+        'preprocess': lambda: preprocessor.combine_data(preprocessor.add_new_features(
+            preprocessor.clean_data(X.copy(), y.copy())[0])),
+        'process_user_input': lambda: [app.process_user_input(subject, message) for subject, message in zip(subjects, messages)],
+        'process_texts': lambda: app.process_texts(texts, 0, 1),
+        'input_guard': lambda: [app.input_guard.limit(text) for text in texts],
+        'convert_score_to_prob': lambda: app.convert_score_to_prob(scores),
+    }
+    try:
+        from clean_email import clean_text
+        result['clean_text'] = lambda: [clean_text(message) for message in messages]
+    except Exception as e:
+        print(f"Exact error:{type(e).__name__}:{e}\nSkipping clean_text (nltk stopwords are needed)")
+    if model_pipeline is not None:
+        result['predict+decision_function'] = lambda: (model_pipeline.predict(frame), model_pipeline.decision_function(frame))
+        result['score_input'] = lambda: app.score_input(frame, model_pipeline)
+    if engine is not None:
+        result['fast_path'] = lambda: engine.decision_function(texts, 0, 1)
+    if model_cascade is not None:
+        result['cascade_first_pass'] = lambda: model_cascade.scores(texts)
+    return result
+
+
+def measure(function, repeat):
+    '''Median and min seconds over repeat runs, then the peak traced memory of one more run'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'median_s': statistics.median(times), 'min_s': min(times), 'peak_kb': peak / 1024}
+
+
+def run(sizes, repeat, corpus=None, labels=None):
+    '''Results keyed on "stage/corpus/size"'''
+    results = {}
+    corpora = [('synthetic', lambda size: synthetic_corpus(size))]
+    if corpus:
+        corpora.append(('real', lambda size: real_corpus(corpus, labels, size)))
+    for corpus_name, load in corpora:
+        for size in sizes:
+            X, y = load(size)
+            for stage, function in stages(X, y).items():
+                result = measure(function, repeat)
+                result['per_email_us'] = result['median_s'] / len(X) * 1e6
+                results[f'{stage}/{corpus_name}/{size}'] = result
+                print(f"{stage:>26} {corpus_name:>9} {size:>6}: {result['median_s'] * 1000:9.2f}ms "
+                      f"({result['per_email_us']:8.1f}us/email) peak {result['peak_kb']:9.0f}KB")
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''Stages slower or heavier than the baseline by more than threshold (a fraction)'''
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric in ('median_s', 'peak_kb'):
+            before, after = baseline[key][metric], result[metric]
+            if before > 0 and after > before * (1 + threshold):
+                regressions.append(f'{key} {metric}: {before:.4g} -> {after:.4g} (+{after / before - 1:.0%})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the preprocessing and inference stages')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='emails per corpus')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per stage, the median is kept')
+    parser.add_argument('--corpus', help='raw csv with Subject, Message and Date columns (e.g. X_test.csv)')
+    parser.add_argument('--labels', help='Spam/Ham csv of the corpus (e.g. y_test.csv)')
+    parser.add_argument('--baseline', help='baseline json to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown, 0.2 is 20%%')
+    parser.add_argument('--save-baseline', help='write the results as the new baseline json')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.repeat, args.corpus, args.labels)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'Saved baseline to {args.save_baseline}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print('Regressions:\n' + '\n'.join(regressions))
+            sys.exit(1)
+        print(f'No stage regressed more than {args.threshold:.0%}')
+
+
+if __name__ == '__main__':
+    main()
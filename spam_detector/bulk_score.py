@@ -0,0 +1,292 @@
+'''
+Offline scoring of mail archives without going through HTTP
+
+Streams emails from an mbox file, a maildir or a csv with the project's
+layout (Subject, Message, Date), scores them in batches across a process
+pool (every worker loads the model once) and writes one row per email, in
+input order, to csv or parquet:
+
+    python bulk_score.py archive.mbox predictions.parquet
+    python bulk_score.py ~/Maildir predictions.csv --workers 8 --batch-size 2000
+    python bulk_score.py ../data/X_test.csv predictions.csv --model-dir models/registry/20261018-090000
+
+Memory stays constant whatever the archive size: one email is parsed at a
+time, at most 2 batches per worker are in flight and finished batches are
+written as soon as every batch before them is. The model directory is laid
+out like models/ (joblib, compact export, calibration.json), the scores are
+the ones the app gives: same input size limits, fast path when available,
+calibrated probabilities when the model has a calibration.
+An email without a Subject gets the one training gives it (NO_SUBJECT of
+src/preprocessor.py). day_of_week comes from the Date of each email, read by email_date.py like
+in the app (--default-day, the most common day in training, when it has
+none or it does not parse, so scoring an archive again gives the same
+scores). An email that
+cannot be parsed gets a row with its error instead of stopping the run.
+repeat_freq, like in training, is the number of times the same subject and
+message appear in the archive, counted with a count-min sketch in a first
+pass over the input (--repeat-freq running counts only the emails seen so
+far in a single pass, one uses 1).
+'''
+import argparse
+import csv
+import email
+import email.policy
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from email.header import decode_header, make_header
+import numpy as np
+
+from calibration import Calibrator, sigmoid
+from email_date import DEFAULT_DAY, day_of_week as email_day_of_week
+from fast_model import combine_text
+from input_guard import InputGuard
+from model_registry import load_model
+from repeat_counter import RepeatCounter
+#missing subjects are filled like in training
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from preprocessor import NO_SUBJECT
+
+OUTPUT_COLUMNS = ['id', 'Subject', 'Date', 'Prediction', 'score', 'Spam probability', 'error']
+QUOTED_FROM = re.compile(rb'>+From ').match
+
+
+def message_text(message):
+    '''Text of the first text/plain part, else of the first text/html part'''
+    parts = {}
+    for part in message.walk():
+        content_type = part.get_content_type()
+        if content_type in ('text/plain', 'text/html') and content_type not in parts and part.get_content_disposition() != 'attachment':
+            parts[content_type] = decode_payload(part.get_payload(decode=True) or b'', part.get_content_charset())
+    return parts.get('text/plain', parts.get('text/html', ''))
+
+
+def decode_payload(payload, charset):
+    '''Text of a part, charsets python does not know (unknown-8bit, x-user-defined) are read as utf-8, else latin-1'''
+    try:
+        return payload.decode(charset or 'utf-8', errors='replace')
+    except LookupError:
+        try:
+            return payload.decode('utf-8')
+        except UnicodeDecodeError:
+            return payload.decode('latin-1')
+
+
+def parse_email(raw, id):
+    '''
+    Subject, message and Date (the raw header) of a raw rfc 822 email
+    an email that cannot be parsed is returned empty with its error
+    '''
+    try:
+        message = email.message_from_bytes(raw, policy=email.policy.compat32)
+        try:
+            subject = str(make_header(decode_header(message.get('Subject', '') or '')))
+        except (LookupError, UnicodeError, ValueError):
+            #unknown charset, keep the encoded header
+            subject = str(message.get('Subject', ''))
+        return {'id': str(message.get('Message-ID') or id), 'subject': subject if subject.strip() else NO_SUBJECT, 'message': message_text(message),
+                'date': str(message.get('Date') or '')}
+    except Exception as e:
+        print(f"Exact error:{type(e).__name__}:{e}\nCould not parse email {id}", file=sys.stderr)
+        return {'id': str(id), 'subject': '', 'message': '', 'date': '', 'error': f'{type(e).__name__}: {e}'}
+
+
+def read_mbox(path):
+    '''Emails of an mbox file, split on the "From " lines without indexing the whole file'''
+    lines, number = None, 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'From '):
+                #envelope line starting the next email
+                if lines is not None:
+                    yield parse_email(b''.join(lines), number)
+                    number += 1
+                lines = []
+            elif lines is not None:
+                #body lines starting with "From " are quoted as ">From " (">>From " in mboxrd)
+                lines.append(line[1:] if QUOTED_FROM(line) else line)
+        if lines is not None:
+            yield parse_email(b''.join(lines), number)
+
+
+def read_maildir(path):
+    '''Emails of the cur and new folders of a maildir, in file name order'''
+    for folder in ('cur', 'new'):
+        directory = os.path.join(path, folder)
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name), 'rb') as f:
+                yield parse_email(f.read(), name)
+
+
+def read_csv(path, chunksize=10000):
+    '''Emails of a csv with Subject, Message and Date columns, read in chunks'''
+    import pandas as pd
+    number = 0
+    for chunk in pd.read_csv(path, chunksize=chunksize, dtype={'Date': str}):
+        #dates stay strings, a chunk mixing time zones cannot be one datetime column
+        dates = chunk['Date'].fillna('') if 'Date' in chunk else [''] * len(chunk)
+        for subject, message, date in zip(chunk['Subject'].fillna(NO_SUBJECT), chunk['Message'].fillna(''), dates):
+            yield {'id': number, 'subject': str(subject), 'message': str(message), 'date': date}
+            number += 1
+
+
+def read_emails(path):
+    if os.path.isdir(path):
+        return read_maildir(path)
+    if path.endswith('.csv'):
+        return read_csv(path)
+    return read_mbox(path)
+
+
+def batches(emails, batch_size, repeat_freq):
+    '''Lists of emails with their repeat_freq, repeat_freq is a function of (subject, message)'''
+    batch = []
+    for mail in emails:
+        mail['repeat_freq'] = repeat_freq(mail['subject'], mail['message'])
+        batch.append(mail)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+#model of each worker process, loaded once by init_worker
+worker = {}
+
+
+def init_worker(model_dir, max_chars, max_tokens, default_day=DEFAULT_DAY):
+    pipeline, engine = load_model(model_dir)
+    worker.update(pipeline=pipeline, engine=engine, calibrator=Calibrator.load(model_dir),
+                  guard=InputGuard(max_chars=max_chars, max_tokens=max_tokens), default_day=default_day)
+
+
+def score_batch(batch):
+    '''Output rows of a batch, scored the way the app scores them, emails that failed to parse get an error row'''
+    rows = [[mail['id'], '', mail['date'], 'Error', None, None, mail['error']] if 'error' in mail else None for mail in batch]
+    valid = [i for i, row in enumerate(rows) if row is None]
+    if not valid:
+        return rows
+    mails = [batch[i] for i in valid]
+    texts = [worker['guard'].limit(combine_text(mail['subject'], mail['message']))[0] for mail in mails]
+    days = [email_day_of_week(mail['date'])[0] for mail in mails]
+    day_of_week = np.array([worker['default_day'] if day is None else day for day in days])
+    repeat_freq = np.array([mail['repeat_freq'] for mail in mails], dtype=np.float64)
+    if worker['engine'] is not None:
+        scores = worker['engine'].decision_function(texts, day_of_week, repeat_freq)
+    else:
+        import pandas as pd
+        frame = pd.DataFrame({'combined_with_stopwords': texts, 'day_of_week': day_of_week, 'repeat_freq': repeat_freq})
+        scores = worker['pipeline'].decision_function(frame)
+    calibrator = worker['calibrator']
+    spam_prob = calibrator.predict(scores) if calibrator is not None else sigmoid(scores)
+    threshold = calibrator.decision_threshold() if calibrator is not None else None
+    spam = spam_prob >= threshold if threshold is not None else scores > 0
+    for i, mail, is_spam, score, prob in zip(valid, mails, spam, scores, spam_prob):
+        rows[i] = [mail['id'], mail['subject'], mail['date'], 'Spam' if is_spam else 'Not Spam', float(score), float(prob) * 100, '']
+    return rows
+
+
+class CsvWriter:
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(OUTPUT_COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    '''One row group per batch'''
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema([('id', pa.string()), ('Subject', pa.string()), ('Date', pa.string()),
+                                 ('Prediction', pa.string()), ('score', pa.float64()), ('Spam probability', pa.float64()),
+                                 ('error', pa.string())])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        columns[0] = [str(value) for value in columns[0]]
+        self.writer.write_table(self.pa.Table.from_arrays([self.pa.array(column, type=field.type) for column, field in zip(columns, self.schema)], schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def repeat_counter(path, mode):
+    '''Function of (subject, message) giving repeat_freq, see the module docstring'''
+    if mode == 'one':
+        return lambda subject, message: 1.0
+    #no time decay, archives are counted as a whole
+    counter = RepeatCounter(half_life=float('inf'))
+    if mode == 'running':
+        return lambda subject, message: float(counter.add([RepeatCounter.fingerprint(subject, message)])[0])
+    start = time.perf_counter()
+    for mail in read_emails(path):
+        counter.add([RepeatCounter.fingerprint(mail['subject'], mail['message'])])
+    print(f'Counted repeats in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+    return lambda subject, message: float(counter.estimate([RepeatCounter.fingerprint(subject, message)])[0])
+
+
+def run(args):
+    writer = ParquetWriter(args.output) if args.output.endswith('.parquet') else CsvWriter(args.output)
+    pending, done = deque(), 0
+    start = last_report = time.perf_counter()
+    with ProcessPoolExecutor(args.workers, initializer=init_worker,
+                             initargs=(args.model_dir, args.max_chars, args.max_tokens, args.default_day)) as pool:
+        source = batches(read_emails(args.input), args.batch_size, repeat_counter(args.input, args.repeat_freq))
+        exhausted = False
+        while not exhausted or pending:
+            #keep at most 2 batches per worker in flight so memory does not grow with the archive
+            while not exhausted and len(pending) < 2 * args.workers:
+                batch = next(source, None)
+                if batch is None:
+                    exhausted = True
+                else:
+                    pending.append(pool.submit(score_batch, batch))
+            #the oldest batch is written first so the output is in input order
+            if pending:
+                rows = pending.popleft().result()
+                writer.write(rows)
+                done += len(rows)
+            now = time.perf_counter()
+            if now - last_report >= args.progress_every:
+                print(f'{done} emails scored, {done / (now - start):.0f} emails/s', file=sys.stderr)
+                last_report = now
+    writer.close()
+    elapsed = time.perf_counter() - start
+    print(f'Scored {done} emails in {elapsed:.1f}s ({done / elapsed if elapsed else 0:.0f} emails/s), wrote {args.output}', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score an mbox, maildir or csv archive offline')
+    parser.add_argument('input', help='mbox file, maildir directory or csv with Subject, Message and Date columns')
+    parser.add_argument('output', help='.csv or .parquet file of the predictions')
+    parser.add_argument('--model-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models'),
+                        help='directory laid out like models/ (or a registry version)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--repeat-freq', choices=['total', 'running', 'one'], default='total',
+                        help='total needs a first pass over the input, see the module docstring')
+    parser.add_argument('--max-chars', type=int, default=200000, help='characters kept per email, as MAX_EMAIL_CHARS')
+    parser.add_argument('--max-tokens', type=int, default=10000, help='tokens kept per email, as MAX_EMAIL_TOKENS')
+    parser.add_argument('--default-day', type=int, choices=range(7), default=DEFAULT_DAY,
+                        help='day_of_week (0 is monday) of emails without a usable Date, defaults to the most common day in training')
+    parser.add_argument('--progress-every', type=float, default=10, help='seconds between progress lines')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
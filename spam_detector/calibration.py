@@ -0,0 +1,154 @@
+'''
+Calibrated spam probabilities for the decision scores of the model
+
+The LinearSVC decision score is not a probability, 1/(1+exp(-score)) gives
+numbers that do not match how often mail with that score really is spam.
+A Calibrator maps scores to probabilities with Platt scaling (a sigmoid with
+a fitted slope and offset, closed form) or isotonic regression (a monotone
+step function, evaluated with np.interp), both fitted offline on held out
+data and stored as calibration.json next to the model files:
+
+    python calibration.py models/spam_trained_model.joblib --test-x ../data/X_test.csv --test-y ../data/y_test.csv
+    python calibration.py models/spam_trained_model.joblib --test-x ../data/X_test.csv --test-y ../data/y_test.csv --method isotonic --threshold 0.7
+
+The test set is split in two (stratified): the calibration is fitted on one
+part and the Brier score and expected calibration error of the old sigmoid
+and the new calibration are reported on the other part. The optional
+threshold is the spam probability at which an email is labelled spam (0.5
+without it, so labels follow the calibrated probability).
+'''
+import argparse
+import json
+import os
+import sys
+import numpy as np
+
+CALIBRATION_FILE = 'calibration.json'
+#spam probability labelled spam when calibration.json sets no threshold
+DEFAULT_THRESHOLD = 0.5
+METHODS = ('platt', 'isotonic')
+
+
+def sigmoid(scores):
+    return 1 / (1 + np.exp(-scores))
+
+
+class Calibrator:
+    '''
+    Maps decision scores to spam probabilities
+        method: 'platt' (params a, b: sigmoid(a*score + b)) or 'isotonic' (params x, y: interpolation points)
+        threshold: spam probability at which an email is labelled spam, None uses DEFAULT_THRESHOLD
+                   so the label always agrees with the calibrated probability
+    '''
+    def __init__(self, method, params, threshold=None):
+        if method not in METHODS:
+            raise ValueError(f'unknown calibration method {method}')
+        self.method = method
+        self.params = params
+        self.threshold = threshold
+        if method == 'isotonic':
+            self._x = np.asarray(params['x'], dtype=np.float64)
+            self._y = np.asarray(params['y'], dtype=np.float64)
+
+    @classmethod
+    def fit(cls, scores, y, method='platt', threshold=None):
+        '''Fits the calibration on decision scores and their true labels (1 for spam)'''
+        scores = np.asarray(scores, dtype=np.float64)
+        if method == 'platt':
+            from sklearn.linear_model import LogisticRegression
+            model = LogisticRegression(C=1e10).fit(scores.reshape(-1, 1), y)
+            params = {'a': float(model.coef_[0, 0]), 'b': float(model.intercept_[0])}
+        elif method == 'isotonic':
+            from sklearn.isotonic import IsotonicRegression
+            model = IsotonicRegression(y_min=0, y_max=1, out_of_bounds='clip').fit(scores, y)
+            params = {'x': model.X_thresholds_.tolist(), 'y': model.y_thresholds_.tolist()}
+        else:
+            raise ValueError(f'unknown calibration method {method}')
+        return cls(method, params, threshold)
+
+    def predict(self, scores):
+        '''Spam probability of each decision score'''
+        scores = np.asarray(scores, dtype=np.float64)
+        if self.method == 'platt':
+            return sigmoid(self.params['a'] * scores + self.params['b'])
+        return np.interp(scores, self._x, self._y)
+
+    def decision_threshold(self):
+        return self.threshold if self.threshold is not None else DEFAULT_THRESHOLD
+
+    def to_dict(self):
+        return {'method': self.method, 'params': self.params, 'threshold': self.threshold}
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, CALIBRATION_FILE)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(f'{path}.tmp', path)
+        return path
+
+    @classmethod
+    def load(cls, directory):
+        '''Calibration stored in a model directory, None when it has none'''
+        path = os.path.join(directory, CALIBRATION_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['method'], data['params'], data.get('threshold'))
+
+
+def calibration_error(prob, y, bins=10):
+    '''Expected calibration error: mean gap between predicted and observed spam rate over equal width bins'''
+    prob, y = np.asarray(prob), np.asarray(y)
+    index = np.minimum((prob * bins).astype(int), bins - 1)
+    error = 0.0
+    for b in range(bins):
+        mask = index == b
+        if mask.any():
+            error += mask.sum() * abs(prob[mask].mean() - y[mask].mean())
+    return error / len(prob)
+
+
+def report(name, prob, y):
+    from sklearn.metrics import brier_score_loss
+    print(f'{name:>10}: brier {brier_score_loss(y, prob):.4f}  ece {calibration_error(prob, y):.4f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit the probability calibration of a model on held out data')
+    parser.add_argument('model', help='spam_trained_model.joblib')
+    parser.add_argument('--test-x', required=True, help='raw X_test.csv')
+    parser.add_argument('--test-y', required=True, help='raw y_test.csv')
+    parser.add_argument('--method', choices=METHODS, default='platt')
+    parser.add_argument('--holdout', type=float, default=0.5, help='part of the test set kept to evaluate the calibration')
+    parser.add_argument('--threshold', type=float, help='spam probability at which an email is labelled spam')
+    parser.add_argument('--output', help='directory of calibration.json, defaults to the directory of the model')
+    args = parser.parse_args()
+
+    import joblib
+    import pandas as pd
+    from sklearn.model_selection import train_test_split
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+    import preprocessor
+
+    X_test, y_test = preprocessor.clean_data(pd.read_csv(args.test_x), pd.read_csv(args.test_y))
+    X_test = preprocessor.combine_data(preprocessor.add_new_features(X_test))
+    pipeline = joblib.load(args.model)
+    if hasattr(pipeline, 'decision_function'):
+        scores = pipeline.decision_function(X_test)
+    else:
+        spam_prob = np.clip(pipeline.predict_proba(X_test)[:, 1], 1e-15, 1 - 1e-15)
+        scores = np.log(spam_prob / (1 - spam_prob))
+    y = y_test.to_numpy()
+
+    fit_scores, eval_scores, fit_y, eval_y = train_test_split(scores, y, test_size=args.holdout, stratify=y, random_state=42)
+    calibrator = Calibrator.fit(fit_scores, fit_y, args.method, args.threshold)
+    print(f'Fitted {args.method} calibration on {len(fit_y)} emails, evaluated on {len(eval_y)}')
+    report('sigmoid', sigmoid(eval_scores), eval_y)
+    report(args.method, calibrator.predict(eval_scores), eval_y)
+    print(f'Saved {calibrator.save(args.output or os.path.dirname(os.path.abspath(args.model)))}')
+
+
+if __name__ == '__main__':
+    main()
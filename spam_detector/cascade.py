@@ -0,0 +1,287 @@
+'''
+Two tier cascade: a cheap first pass decides the obvious emails
+
+Most mail is obviously spam or obviously ham. The first pass is a
+multinomial naive bayes over a small vocabulary that only reads the start
+of the email (subject + first prefix_chars characters): its score is the
+log odds of spam, a sum of per term weights. Emails scoring at or above
+high are spam, at or below low are ham, only the emails in between (the
+uncertainty band) go to the full model. low <= 0 <= high so the first pass
+never contradicts its own log odds. Naive bayes log odds are far too
+confident (scores of -20 or +50), so fit also fits a Platt calibration of
+the first pass scores on the validation part: decided emails get a
+calibrated spam probability like the ones of the full model. The band is
+widened to include the score of probability 0.5, so an email the first pass
+labels spam never gets a spam probability under 0.5 (and the other way).
+
+    python cascade.py fit models/spam_trained_model.joblib --train-x ../data/X_train.csv --train-y ../data/y_train.csv
+    python cascade.py evaluate models/spam_trained_model.joblib --test-x ../data/X_test.csv --test-y ../data/y_test.csv
+
+fit trains the first pass on the training set and picks the band on a
+validation part of it: the widest band edges at which the first pass still
+agrees with the full model on --agreement of the emails it decides (no
+labels are needed for that). The first pass is stored as cascade.json next
+to the model. evaluate scales the band on the test set and reports the
+share of emails the full model no longer sees, the measured time per email
+and the accuracy and F1 lost against the full model alone. It labels emails
+like the app: texts go through the same InputGuard limits, decided emails
+are spam when their calibrated probability reaches the decision threshold
+and the agreement on the decided emails is checked against --agreement.
+'''
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import numpy as np
+
+from calibration import DEFAULT_THRESHOLD, Calibrator, calibration_error, sigmoid
+
+CASCADE_FILE = 'cascade.json'
+
+#TfidfVectorizer's default token_pattern, the one of the deployed pipeline
+TOKEN_PATTERN = r"(?u)\b\w\w+\b"
+
+
+class Cascade:
+    '''
+    First pass of the cascade, see the module docstring
+        weights: {term: log odds weight}
+        bias: log odds of the class priors
+        low, high: edges of the uncertainty band on the first pass score
+        prefix_chars: characters of the email the first pass reads
+        calibration: Calibrator of the first pass scores, None uses a plain sigmoid
+    '''
+    def __init__(self, weights, bias, low, high, prefix_chars=1000, token_pattern=TOKEN_PATTERN, calibration=None):
+        self.weights = weights
+        self.calibration = calibration
+        self.bias = bias
+        self.low = min(low, 0.0)
+        self.high = max(high, 0.0)
+        self.prefix_chars = prefix_chars
+        self.token_pattern = token_pattern
+        self._tokenize = re.compile(token_pattern).findall
+
+    @classmethod
+    def fit(cls, texts, y, max_features=5000, prefix_chars=1000, token_pattern=TOKEN_PATTERN):
+        '''Trains the naive bayes first pass on combined texts and labels (1 for spam), the band starts closed'''
+        from sklearn.feature_extraction.text import CountVectorizer
+        from sklearn.naive_bayes import MultinomialNB
+        vectorizer = CountVectorizer(max_features=max_features, token_pattern=token_pattern)
+        counts = vectorizer.fit_transform([text[:prefix_chars] for text in texts])
+        model = MultinomialNB().fit(counts, y)
+        spam = list(model.classes_).index(1)
+        log_odds = model.feature_log_prob_[spam] - model.feature_log_prob_[1 - spam]
+        weights = {term: float(log_odds[index]) for term, index in vectorizer.vocabulary_.items()}
+        bias = float(model.class_log_prior_[spam] - model.class_log_prior_[1 - spam])
+        return cls(weights, bias, 0.0, 0.0, prefix_chars, token_pattern)
+
+    def score(self, text):
+        '''Log odds of spam of one combined text'''
+        get = self.weights.get
+        return self.bias + sum(get(token, 0.0) for token in self._tokenize(text[:self.prefix_chars].lower()))
+
+    def scores(self, texts):
+        return np.fromiter((self.score(text) for text in texts), dtype=np.float64, count=len(texts))
+
+    def probability(self, scores):
+        '''Spam probability of first pass scores'''
+        return self.calibration.predict(scores) if self.calibration is not None else sigmoid(np.asarray(scores))
+
+    def uncertain(self, scores, scale=1.0):
+        '''Emails the first pass leaves to the full model, scale widens (>1) or narrows (<1) the band'''
+        scores = np.asarray(scores)
+        return (scores > self.low * scale) & (scores < self.high * scale)
+
+    def choose_band(self, scores, full_labels, agreement=0.995):
+        '''
+        Sets the band edges to the ones deciding the most emails while agreeing
+        with the full model's labels on at least agreement of the emails decided
+        an edge no candidate reaches stays infinite, that side is never decided by the first pass
+        '''
+        scores, full_labels = np.asarray(scores), np.asarray(full_labels)
+        candidates = np.unique(np.quantile(scores, np.linspace(0, 1, 201)))
+        #the smallest high (largest low) that still agrees decides the most emails
+        spam_edges = [edge for edge in candidates[candidates >= 0] if (full_labels[scores >= edge] == 1).mean() >= agreement]
+        ham_edges = [edge for edge in candidates[candidates <= 0] if (full_labels[scores <= edge] == 0).mean() >= agreement]
+        self.high = float(min(spam_edges)) if spam_edges else float('inf')
+        self.low = float(max(ham_edges)) if ham_edges else float('-inf')
+        return self.low, self.high
+
+    def to_dict(self):
+        calibration = {'method': self.calibration.method, 'params': self.calibration.params} if self.calibration is not None else None
+        return {'bias': self.bias, 'low': self.low, 'high': self.high, 'prefix_chars': self.prefix_chars,
+                'token_pattern': self.token_pattern, 'calibration': calibration, 'weights': self.weights}
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, CASCADE_FILE)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(f'{path}.tmp', path)
+        return path
+
+    @classmethod
+    def load(cls, directory):
+        '''First pass stored in a model directory, None when it has none'''
+        path = os.path.join(directory, CASCADE_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        calibration = data.get('calibration')
+        if calibration is not None:
+            calibration = Calibrator(calibration['method'], calibration['params'])
+        return cls(data['weights'], data['bias'], data['low'], data['high'], data['prefix_chars'], data['token_pattern'], calibration)
+
+
+def load_emails(x_path, y_path):
+    '''Raw csv files through the training preprocessing, returns the features and the labels'''
+    import pandas as pd
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+    import preprocessor
+    X, y = preprocessor.clean_data(pd.read_csv(x_path), pd.read_csv(y_path))
+    X = preprocessor.combine_data(preprocessor.add_new_features(X)).reset_index(drop=True)
+    return X, y.to_numpy()
+
+
+def full_model_scorer(pipeline, X):
+    '''
+    Scores rows of X with the full model the way the app does:
+    the compiled fast path when the pipeline supports it, else the pipeline
+    '''
+    from fast_model import CompiledSpamModel
+    try:
+        engine = CompiledSpamModel.from_pipeline(pipeline)
+    except ValueError:
+        engine = None
+    texts = X['combined_with_stopwords'].tolist()
+    day_of_week, repeat_freq = X['day_of_week'].to_numpy(), X['repeat_freq'].to_numpy()
+
+    def score(rows):
+        if engine is not None:
+            return engine.decision_function([texts[i] for i in rows], day_of_week[rows], repeat_freq[rows])
+        return pipeline.decision_function(X.iloc[rows])
+    return score
+
+
+def fit(args):
+    import joblib
+    from sklearn.model_selection import train_test_split
+    X, y = load_emails(args.train_x, args.train_y)
+    texts = X['combined_with_stopwords'].tolist()
+    train_rows, valid_rows = train_test_split(np.arange(len(X)), test_size=args.validation, stratify=y, random_state=42)
+    cascade = Cascade.fit([texts[i] for i in train_rows], y[train_rows], args.max_features, args.prefix_chars)
+
+    full_labels = (full_model_scorer(joblib.load(args.model), X)(valid_rows) > 0).astype(int)
+    valid_scores = cascade.scores([texts[i] for i in valid_rows])
+    cascade.choose_band(valid_scores, full_labels, args.agreement)
+    cascade.calibration = Calibrator.fit(valid_scores, y[valid_rows], 'platt')
+    #the first pass only decides emails whose calibrated probability agrees with its decision
+    even_odds = -cascade.calibration.params['b'] / cascade.calibration.params['a']
+    cascade.low, cascade.high = min(cascade.low, even_odds), max(cascade.high, even_odds)
+    decided = ~cascade.uncertain(valid_scores)
+    print(f'Band [{cascade.low:.3f}, {cascade.high:.3f}], the first pass decides {decided.mean():.1%} of the validation emails')
+    if decided.any():
+        print(f'Expected calibration error of the decided emails: sigmoid {calibration_error(sigmoid(valid_scores[decided]), y[valid_rows][decided]):.4f}, '
+              f'platt {calibration_error(cascade.probability(valid_scores[decided]), y[valid_rows][decided]):.4f}')
+    print(f'Saved {cascade.save(args.output or os.path.dirname(os.path.abspath(args.model)))}')
+
+
+def evaluate(args):
+    import joblib
+    import pandas as pd
+    from sklearn.metrics import accuracy_score, f1_score
+    from input_guard import InputGuard
+    model_dir = os.path.dirname(os.path.abspath(args.model))
+    cascade = Cascade.load(args.cascade or model_dir)
+    if cascade is None:
+        raise SystemExit('no cascade.json, run cascade.py fit first')
+    X, y = load_emails(args.test_x, args.test_y)
+    #same size limits as the app, long emails are cut before either model reads them
+    guard = InputGuard(max_chars=args.max_chars, max_tokens=args.max_tokens)
+    X['combined_with_stopwords'] = [guard.limit(text)[0] for text in X['combined_with_stopwords']]
+    texts = X['combined_with_stopwords'].tolist()
+    score_full = full_model_scorer(joblib.load(args.model), X)
+    all_rows = np.arange(len(X))
+
+    #labels the way the app does: calibrated probability against the threshold when the
+    #model has a calibration, its own decision otherwise, decided emails always use their probability
+    calibrator = Calibrator.load(model_dir)
+    threshold = args.threshold if args.threshold is not None else calibrator.decision_threshold() if calibrator is not None else None
+
+    def full_model_labels(scores):
+        if threshold is None:
+            return (scores > 0).astype(int)
+        return ((calibrator.predict(scores) if calibrator is not None else sigmoid(scores)) >= threshold).astype(int)
+
+    start = time.perf_counter()
+    full_scores = score_full(all_rows)
+    full_time = time.perf_counter() - start
+    full_labels = full_model_labels(full_scores)
+    rows = [{'band_scale': 'full model', 'first_pass_share': 0.0, 'us_per_email': full_time / len(X) * 1e6,
+             'compute_saved': 0.0, 'accuracy': accuracy_score(y, full_labels), 'F1': f1_score(y, full_labels),
+             'agreement': 1.0, 'decided_agreement': 1.0}]
+
+    for scale in args.scales:
+        start = time.perf_counter()
+        first_scores = cascade.scores(texts)
+        uncertain = cascade.uncertain(first_scores, scale)
+        labels = (cascade.probability(first_scores) >= (threshold if threshold is not None else DEFAULT_THRESHOLD)).astype(int)
+        if uncertain.any():
+            labels[uncertain] = full_model_labels(score_full(np.flatnonzero(uncertain)))
+        elapsed = time.perf_counter() - start
+        decided = ~uncertain
+        rows.append({'band_scale': scale, 'first_pass_share': decided.mean(), 'us_per_email': elapsed / len(X) * 1e6,
+                     'compute_saved': 1 - elapsed / full_time, 'accuracy': accuracy_score(y, labels),
+                     'F1': f1_score(y, labels), 'agreement': (labels == full_labels).mean(),
+                     'decided_agreement': (labels[decided] == full_labels[decided]).mean() if decided.any() else 1.0})
+
+    results = pd.DataFrame(rows).set_index('band_scale')
+    results['accuracy_loss'] = results.loc['full model', 'accuracy'] - results['accuracy']
+    results['F1_loss'] = results.loc['full model', 'F1'] - results['F1']
+    #agreement target of fit, measured on the emails the first pass decides
+    results['below_target'] = results['decided_agreement'] < args.agreement
+    print(results.round(4).to_string())
+    for scale in results.index[results['below_target']]:
+        print(f"WARNING: band scale {scale} agrees with the full model on {results.loc[scale, 'decided_agreement']:.4f} "
+              f"of the decided emails, under the {args.agreement} target", file=sys.stderr)
+    if args.output:
+        results.to_csv(args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit and evaluate the cascade first pass')
+    commands = parser.add_subparsers(dest='command', required=True)
+    fit_parser = commands.add_parser('fit', help='train the first pass and pick its band')
+    fit_parser.add_argument('model', help='spam_trained_model.joblib the cascade falls back to')
+    fit_parser.add_argument('--train-x', required=True, help='raw X_train.csv')
+    fit_parser.add_argument('--train-y', required=True, help='raw y_train.csv')
+    fit_parser.add_argument('--validation', type=float, default=0.2, help='part of the training set used to pick the band')
+    fit_parser.add_argument('--agreement', type=float, default=0.995, help='least agreement with the full model on the decided emails')
+    fit_parser.add_argument('--max-features', type=int, default=5000, help='vocabulary of the first pass')
+    fit_parser.add_argument('--prefix-chars', type=int, default=1000, help='characters of each email the first pass reads')
+    fit_parser.add_argument('--output', help='directory of cascade.json, defaults to the directory of the model')
+    evaluate_parser = commands.add_parser('evaluate', help='accuracy lost against compute saved on the test set')
+    evaluate_parser.add_argument('model', help='spam_trained_model.joblib')
+    evaluate_parser.add_argument('--cascade', help='directory of cascade.json, defaults to the directory of the model')
+    evaluate_parser.add_argument('--test-x', required=True, help='raw X_test.csv')
+    evaluate_parser.add_argument('--test-y', required=True, help='raw y_test.csv')
+    evaluate_parser.add_argument('--scales', type=float, nargs='+', default=[0.5, 1.0, 1.5, 2.0, 3.0],
+                                 help='band sizes to try, relative to the fitted band')
+    evaluate_parser.add_argument('--agreement', type=float, default=0.995,
+                                 help='least agreement with the full model on the decided emails, scales under it are flagged')
+    evaluate_parser.add_argument('--threshold', type=float, help='decision threshold, as SPAM_THRESHOLD, defaults to the calibration of the model')
+    evaluate_parser.add_argument('--max-chars', type=int, default=200000, help='characters kept per email, as MAX_EMAIL_CHARS')
+    evaluate_parser.add_argument('--max-tokens', type=int, default=10000, help='tokens kept per email, as MAX_EMAIL_TOKENS')
+    evaluate_parser.add_argument('--output', help='csv of the results')
+    args = parser.parse_args()
+    if args.command == 'fit':
+        fit(args)
+    else:
+        evaluate(args)
+
+
+if __name__ == '__main__':
+    main()
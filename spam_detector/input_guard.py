@@ -0,0 +1,82 @@
+'''
+Size limits on the email text before it is vectorized
+
+Real mail has multi megabyte bodies, base64 attachments and inline images.
+TfidfVectorizer tokenizes all of it, so one huge email can hold a worker for
+seconds. InputGuard bounds the work per email:
+    1. encoded blobs (data uris, base64 lines, long hex ids) are removed,
+       their tokens are not in the vocabulary so the tfidf vector barely
+       changes, they only cost tokenizing time; removing them first keeps
+       the real text of emails whose attachments fill the first max_chars
+    2. the text is cut to max_chars characters
+    3. the text is cut after max_tokens tokens, read lazily with finditer
+       so the part past the budget is never tokenized
+A run of base64 characters only counts as a blob when it has the length
+of base64 (a multiple of 4) and mixes digits, upper and lower case letters,
+so urls and words joined by slashes (account/verify/login, the phishing
+signals the model scores) are left alone.
+HTML tags are kept, the model was trained on raw bodies.
+'''
+import re
+
+#TfidfVectorizer's default token_pattern, the one of the deployed pipeline
+TOKEN_PATTERN = r"(?u)\b\w\w+\b"
+
+#data uris, and runs of 40+ base64 characters that do not continue a url or a word
+BLOB_PATTERN = r'data:[\w/+.-]+;base64,[A-Za-z0-9+/=]*|(?<![\w+/=.:@%-])[A-Za-z0-9+/]{40,}={0,2}(?![\w+/=])'
+
+
+HEX = re.compile(r'[0-9a-fA-F]+').fullmatch
+MIXED = re.compile(r'(?=[^0-9]*[0-9])(?=[^A-Z]*[A-Z])[^a-z]*[a-z]').match
+
+
+def is_blob(run):
+    '''data uris, long hex strings and base64 runs: length a multiple of 4, digits, upper and lower case'''
+    if run.startswith('data:') or HEX(run):
+        return True
+    return len(run) % 4 == 0 and MIXED(run) is not None
+
+
+class InputGuard:
+    '''
+    Bounds the size of each email text
+        max_chars: characters kept, 0 means no limit
+        max_tokens: tokens kept after the blobs are removed, 0 means no limit
+        strip_blobs: remove encoded blobs
+    '''
+    def __init__(self, max_chars=200000, max_tokens=10000, strip_blobs=True, token_pattern=TOKEN_PATTERN):
+        self.max_chars = max_chars
+        self.max_tokens = max_tokens
+        self.strip_blobs = strip_blobs
+        self._tokens = re.compile(token_pattern).finditer
+        self._blobs = re.compile(BLOB_PATTERN).finditer
+
+    def limit(self, text):
+        '''
+        returns: the bounded text, the limits that changed it
+        ('chars', 'blobs' and/or 'tokens', empty when it was left alone)
+        '''
+        reasons = []
+        if self.strip_blobs:
+            blobs = [match.span() for match in self._blobs(text) if is_blob(match.group())]
+            if blobs:
+                parts, end = [], 0
+                for blob_start, blob_end in blobs:
+                    #only whitespace between two blobs (the lines of one attachment) is dropped with them
+                    if end == 0 or text[end:blob_start].strip():
+                        parts.append(text[end:blob_start])
+                    end = blob_end
+                parts.append(text[end:])
+                text = ' '.join(parts)
+                reasons.append('blobs')
+        if self.max_chars and len(text) > self.max_chars:
+            text = text[:self.max_chars]
+            reasons.append('chars')
+        if self.max_tokens and len(text) > 2 * self.max_tokens:
+            #every token is at least 2 characters, shorter texts cannot go over the budget
+            for count, match in enumerate(self._tokens(text)):
+                if count == self.max_tokens:
+                    text = text[:match.start()]
+                    reasons.append('tokens')
+                    break
+        return text, reasons
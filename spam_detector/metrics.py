@@ -0,0 +1,144 @@
+'''
+Counters and latency histograms in the Prometheus text exposition format
+
+Kept dependency free and cheap enough to leave on: recording a value is a
+bisect over the bucket bounds and a few additions under a lock. Each gunicorn
+worker keeps its own numbers, a scrape of /metrics returns the worker that
+answered it, every sample has a pid label to tell them apart.
+'''
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+#seconds, from the fast path of a single email up to a large batch
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    '''{name="value",...} part of a sample line'''
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def add_label(line, name, value):
+    '''Sample line with one more label'''
+    sample, number = line.rsplit(' ', 1)
+    pair = f'{name}="{escape(value)}"'
+    sample = f'{sample[:-1]},{pair}}}' if sample.endswith('}') else f'{sample}{{{pair}}}'
+    return f'{sample} {number}'
+
+
+class Counter:
+    '''Monotonic count per label values'''
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    '''Cumulative bucket counts, sum and count per label values'''
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                #per bucket counts (the last one is +Inf), sum, count
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        names = self.labelnames + ('le',)
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {total}')
+                lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+class Gauge:
+    '''Value read when /metrics is rendered, function returns {label values: value}'''
+    def __init__(self, name, help, function, labelnames=()):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        for labels, value in sorted(self.function().items()):
+            lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Metrics:
+    '''The metrics of the app'''
+    def __init__(self):
+        self.requests = Counter('spam_requests_total', 'Requests per endpoint', ('endpoint',))
+        self.errors = Counter('spam_errors_total', 'Requests answered with an error per endpoint', ('endpoint',))
+        self.predictions = Counter('spam_predictions_total', 'Emails scored per predicted label', ('label',))
+        self.cascade = Counter('spam_cascade_emails_total', 'Emails decided by the cascade first pass or the full model', ('tier',))
+        self.truncations = Counter('spam_input_truncated_total', 'Emails cut or cleaned by the input size limits per limit', ('reason',))
+        self.dates = Counter('spam_email_dates_total', 'Where the day_of_week of each email came from', ('source',))
+        self.request_seconds = Histogram('spam_request_seconds', 'Request latency per endpoint', ('endpoint',))
+        self.stage_seconds = Histogram('spam_stage_seconds', 'Latency of each stage of a request', ('stage',))
+        self.gauges = []
+
+    def add_gauge(self, name, help, function, labelnames=()):
+        self.gauges.append(Gauge(name, help, function, labelnames))
+
+    @contextmanager
+    def time_stage(self, stage):
+        '''Adds the time spent inside the with block to the stage histogram'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds.observe(time.perf_counter() - start, stage)
+
+    def render(self):
+        '''Text exposition format of every metric'''
+        lines = []
+        pid = os.getpid()
+        for metric in (self.requests, self.errors, self.predictions, self.cascade, self.truncations, self.dates, self.request_seconds, self.stage_seconds, *self.gauges):
+            #every sample carries the pid of the worker, so scrapes of different workers do not mix
+            lines.extend(line if line.startswith('#') else add_label(line, 'pid', pid) for line in metric.render())
+        lines.extend(['# HELP spam_worker_info Process answering this scrape', '# TYPE spam_worker_info gauge',
+                      f'spam_worker_info{{pid="{pid}"}} 1'])
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,130 @@
+'''
+Request micro-batching for the asyncio serving mode (asgi_app.py)
+
+Concurrent requests each put their email on a queue and wait on a future.
+A single batcher task takes whatever is queued, waits at most max_wait
+seconds for more (up to max_batch_size emails), scores the batch with one
+call in a worker thread and resolves every future with its own result.
+When the batch call fails, its items are scored one by one so the error
+only reaches the request that caused it.
+While a batch is being scored new requests keep queuing, so under load the
+batches grow on their own and the wait is only paid when traffic is light.
+'''
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ItemError:
+    '''Exception of one item of a batch that was rescored item by item'''
+    def __init__(self, error):
+        self.error = error
+
+
+class MicroBatcher:
+    '''
+    Groups concurrent submit() calls into batches
+        score_batch: function of a list of items returning one result per item,
+                     runs in a worker thread so the event loop keeps accepting requests
+        max_batch_size: largest number of items scored together
+        max_wait: seconds the first item of a batch waits for more to arrive
+    '''
+    def __init__(self, score_batch, max_batch_size=64, max_wait=0.005):
+        self.score_batch = score_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.task = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='micro-batcher')
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+
+    def start(self):
+        '''Starts the batcher task on the running event loop'''
+        if self.task is None or self.task.done():
+            self.queue = asyncio.Queue()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        return self
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.executor.shutdown(wait=False)
+
+    async def submit(self, item):
+        '''Queues one item and returns its result once its batch is scored'''
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def next_batch(self):
+        '''Waits for the first item, then collects more until the batch is full or max_wait is up'''
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            #requests that gave up (client disconnected) are not scored
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+            try:
+                results = await loop.run_in_executor(self.executor, self.score_batch, [item for item, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    if not batch[0][1].done():
+                        batch[0][1].set_exception(e)
+                    continue
+                #one bad item must not fail the requests batched with it, each is scored on its own
+                results = [await self.score_alone(item) for item, _ in batch]
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, ItemError):
+                    future.set_exception(result.error)
+                else:
+                    future.set_result(result)
+            with self.lock:
+                self.batches += 1
+                self.items += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+
+    async def score_alone(self, item):
+        '''Result of a batch of one item, its exception wrapped in ItemError'''
+        try:
+            return (await asyncio.get_running_loop().run_in_executor(self.executor, self.score_batch, [item]))[0]
+        except Exception as e:
+            return ItemError(e)
+
+    def stats(self):
+        with self.lock:
+            return {'batches': self.batches,
+                    'items': self.items,
+                    'mean_batch_size': self.items / self.batches if self.batches else 0.0,
+                    'largest_batch': self.largest_batch,
+                    'max_batch_size': self.max_batch_size,
+                    'max_wait': self.max_wait,
+                    'queued': self.queue.qsize() if self.queue is not None else 0}
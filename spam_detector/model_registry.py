@@ -0,0 +1,285 @@
+'''
+Versioned model registry with hot reload
+
+A registry is a directory with one sub directory per model version, laid out
+like models/ (spam_trained_model.joblib and optionally spam_model_compact):
+
+    models/registry/
+        20261018-090000/spam_trained_model.joblib
+        20261019-090000/spam_trained_model.joblib
+                        spam_model_compact/
+                        canary.json         optional emails with their expected label
+                        calibration.json    optional, see calibration.py
+                        cascade.json        optional, see cascade.py
+        ACTIVE                              optional, pins a version (rollback)
+
+The newest version (by name) is served unless ACTIVE names another one.
+ModelWatcher polls the registry from a background thread of every worker,
+loads a new version next to the one being served, runs the canary emails
+through it and only then hands it to the app, which switches atomically.
+Requests keep being answered by the old version the whole time.
+
+    python model_registry.py publish ../src/models/spam_trained_model.joblib --compact
+    python model_registry.py list
+    python model_registry.py activate 20261018-090000
+'''
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+import joblib
+import numpy as np
+
+from calibration import CALIBRATION_FILE, Calibrator
+from cascade import CASCADE_FILE, Cascade
+from fast_model import PARITY_EMAILS, CompiledSpamModel, check_parity, combine_text, file_sha256, read_compact_source
+
+MODEL_FILE = 'spam_trained_model.joblib'
+COMPACT_DIR = 'spam_model_compact'
+CANARY_FILE = 'canary.json'
+ACTIVE_FILE = 'ACTIVE'
+
+
+def load_model(directory):
+    '''
+    Loads the model files of a directory (models/ or a registry version)
+    the compact export is preferred because it is memory mapped instead of unpickled
+    returns: pipeline (None when the compact model is used), engine (None without a fast path)
+    raises ValueError when neither can be loaded
+    '''
+    model_path = os.path.join(directory, MODEL_FILE)
+    compact_path = os.path.join(directory, COMPACT_DIR)
+    pipeline = engine = None
+    if os.path.isdir(compact_path):
+        print('Loading compact model')
+        try:
+            #a compact export of an older joblib would silently serve stale weights
+            if os.path.exists(model_path) and read_compact_source(compact_path) != file_sha256(model_path):
+                raise ValueError('compact model was exported from a different joblib file, re-run fast_model.py')
+            engine = CompiledSpamModel.load_compact(compact_path)
+            print('Compact model loaded successfully')
+        except Exception as e:
+            print(f"Exact error:{type(e).__name__}:{e}\nCould not load the compact model")
+
+    if engine is None:
+        print('Importing new pipline')
+        try:
+            pipeline = joblib.load(model_path)
+            print('Pipeline imported successfully')
+        except Exception as e:
+            print(f"Exact error:{type(e).__name__}:{e}\nCould not load the pipeline")
+
+        #compile the fitted weights for the dataframe free fast path
+        try:
+            engine = CompiledSpamModel.from_pipeline(pipeline)
+            print('Fast path compiled successfully')
+        except Exception as e:
+            print(f"Exact error:{type(e).__name__}:{e}\nUsing the full pipeline for predictions")
+
+    if pipeline is None and engine is None:
+        raise ValueError(f'no loadable model in {directory}')
+    return pipeline, engine
+
+
+def run_canary(directory, pipeline, engine):
+    '''
+    Scores the canary emails with a freshly loaded model before it is served
+    the scores must be finite, the fast path must agree with the pipeline,
+    the calibration (if the version has one) must give probabilities, the
+    cascade first pass (if the version has one) must load and score and
+    the emails of canary.json (if the version has one) must get their label
+    raises ValueError when the model fails
+    '''
+    import pandas as pd
+    emails = [{'subject': subject, 'message': message} for subject, message in PARITY_EMAILS]
+    canary_path = os.path.join(directory, CANARY_FILE)
+    if os.path.exists(canary_path):
+        with open(canary_path) as f:
+            emails = emails + json.load(f)
+    texts = [combine_text(email.get('subject') or '', email['message']) for email in emails]
+
+    if engine is not None:
+        if pipeline is not None:
+            check_parity(pipeline, engine, texts)
+        scores = engine.decision_function(texts, day_of_week=0)
+        labels = engine.predict(scores)
+    else:
+        frame = pd.DataFrame({
+            'combined_with_stopwords': texts,
+            'day_of_week': 0,
+            'repeat_freq': 1
+        }, index=range(len(texts)))
+        labels = pipeline.predict(frame)
+        scores = pipeline.decision_function(frame) if hasattr(pipeline, 'decision_function') else pipeline.predict_proba(frame)
+    if not np.all(np.isfinite(scores)):
+        raise ValueError('canary scores are not finite')
+    calibrator = Calibrator.load(directory)
+    if calibrator is not None:
+        spam_prob = calibrator.predict(scores)
+        if not np.all((spam_prob >= 0) & (spam_prob <= 1)):
+            raise ValueError('calibrated canary probabilities are not between 0 and 1')
+    cascade = Cascade.load(directory)
+    if cascade is not None and not np.all(np.isfinite(cascade.scores(texts))):
+        raise ValueError('cascade canary scores are not finite')
+
+    for email, label in zip(emails, labels):
+        if 'label' in email and int(label) != int(email['label']):
+            raise ValueError(f'canary email {email.get("subject")!r} predicted {label}, expected {email["label"]}')
+
+
+class ModelRegistry:
+    '''Versions of a registry directory, see the module docstring'''
+    def __init__(self, path):
+        self.path = path
+
+    def versions(self):
+        '''Published versions, oldest first (dot directories are publishes in progress)'''
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path)
+                      if not name.startswith('.') and os.path.isdir(os.path.join(self.path, name)))
+
+    def pinned(self):
+        active_path = os.path.join(self.path, ACTIVE_FILE)
+        if not os.path.exists(active_path):
+            return None
+        with open(active_path) as f:
+            return f.read().strip() or None
+
+    def target(self):
+        '''Version that should be served: the pinned one, else the newest'''
+        versions = self.versions()
+        pinned = self.pinned()
+        if pinned in versions:
+            return pinned
+        return versions[-1] if versions else None
+
+    def version_dir(self, version):
+        return os.path.join(self.path, version)
+
+    def publish(self, model_path, version=None, compact=False, canary=None, calibration=None, cascade=None):
+        '''
+        Copies a joblib model into a new version, the version directory is
+        written under a temporary name and renamed so watchers never see it half written
+        '''
+        version = version or datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')
+        final_dir = self.version_dir(version)
+        if os.path.exists(final_dir):
+            raise ValueError(f'version {version} already exists')
+        tmp_dir = os.path.join(self.path, f'.{version}.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        shutil.copyfile(model_path, os.path.join(tmp_dir, MODEL_FILE))
+        if compact:
+            CompiledSpamModel.from_pipeline(joblib.load(model_path)).export_compact(
+                os.path.join(tmp_dir, COMPACT_DIR), source_sha256=file_sha256(model_path))
+        if canary:
+            shutil.copyfile(canary, os.path.join(tmp_dir, CANARY_FILE))
+        if calibration:
+            shutil.copyfile(calibration, os.path.join(tmp_dir, CALIBRATION_FILE))
+        if cascade:
+            shutil.copyfile(cascade, os.path.join(tmp_dir, CASCADE_FILE))
+        os.rename(tmp_dir, final_dir)
+        return version
+
+    def activate(self, version=None):
+        '''Pins version, None goes back to serving the newest one'''
+        active_path = os.path.join(self.path, ACTIVE_FILE)
+        if version is None:
+            if os.path.exists(active_path):
+                os.remove(active_path)
+            return
+        if version not in self.versions():
+            raise ValueError(f'unknown version {version}')
+        with open(f'{active_path}.tmp', 'w') as f:
+            f.write(version)
+        os.replace(f'{active_path}.tmp', active_path)
+
+
+class ModelWatcher:
+    '''
+    Background thread switching the app to the registry's target version
+        registry: ModelRegistry to watch
+        on_switch: called with (version, directory, pipeline, engine) once a version passed its canary
+        active: version already being served
+        interval: seconds between polls
+    a version that fails to load or fails its canary is not retried
+    '''
+    def __init__(self, registry, on_switch, active=None, interval=30):
+        self.registry = registry
+        self.on_switch = on_switch
+        self.active = active
+        self.interval = interval
+        self.failed = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='model-watcher', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Exact error:{type(e).__name__}:{e}\nCould not check the model registry")
+
+    def check(self):
+        '''Loads, validates and switches to the target version if it changed, returns True on a switch'''
+        version = self.registry.target()
+        if version is None or version == self.active or version in self.failed:
+            return False
+        directory = self.registry.version_dir(version)
+        print(f'Loading model version {version}')
+        start = time.perf_counter()
+        try:
+            pipeline, engine = load_model(directory)
+            run_canary(directory, pipeline, engine)
+        except Exception as e:
+            self.failed[version] = f'{type(e).__name__}: {e}'
+            print(f"Exact error:{type(e).__name__}:{e}\nKeeping model version {self.active}")
+            return False
+        self.on_switch(version, directory, pipeline, engine)
+        self.active = version
+        print(f'Switched to model version {version} in {time.perf_counter() - start:.2f}s')
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the versioned model registry')
+    parser.add_argument('--registry', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'registry'))
+    commands = parser.add_subparsers(dest='command', required=True)
+    publish = commands.add_parser('publish', help='add a joblib model as a new version')
+    publish.add_argument('model', help='path to a spam_trained_model.joblib')
+    publish.add_argument('--version', help='version name, defaults to the utc time (versions sort by name)')
+    publish.add_argument('--compact', action='store_true', help='also export the compact memory mapped model')
+    publish.add_argument('--canary', help='json list of {"subject", "message", "label"} the version must get right')
+    publish.add_argument('--calibration', help='calibration.json written by calibration.py for this model')
+    publish.add_argument('--cascade', help='cascade.json written by cascade.py fit for this model')
+    commands.add_parser('list', help='show the versions')
+    activate = commands.add_parser('activate', help='pin a version, without one the newest is served again')
+    activate.add_argument('version', nargs='?')
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.registry)
+    if args.command == 'publish':
+        os.makedirs(args.registry, exist_ok=True)
+        print(f'Published version {registry.publish(args.model, args.version, args.compact, args.canary, args.calibration, args.cascade)}')
+    elif args.command == 'activate':
+        registry.activate(args.version)
+        print(f'Serving version {registry.target()}')
+    else:
+        target = registry.target()
+        for version in registry.versions():
+            print(f'{version}{" (active)" if version == target else ""}')
+
+
+if __name__ == '__main__':
+    main()
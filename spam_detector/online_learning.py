@@ -0,0 +1,254 @@
+'''
+Online updates of the served model from user feedback
+
+/feedback appends (email, true label) records to an append-only json lines
+file. OnlineUpdater runs in a background thread of every worker: it reads the
+records added since its last pass, takes one SGD (hinge loss) step per record
+starting from the current weights, builds a new pipeline and hands it to the
+app, which swaps it in. Request threads never wait for an update.
+
+The update only touches the linear model, the tfidf vocabulary and the scaler
+stay as they were fitted. Records are applied in log order without shuffling
+and with a constant learning rate, so the result does not depend on how the
+log was split into passes: every gunicorn worker reading the same log ends up
+with the same weights, and a restarted worker gets them back by replaying it.
+
+Feedback is user input, so it is bounded before it reaches the weights:
+    - the same email counts at most max_duplicates times in the whole log,
+      sending one email many times does not outweigh everything else
+    - a pass whose update flips more than max_flips of the labels of the
+      held-out emails (against the version it started from) is rejected,
+      its records are skipped and the served model stays as it was
+The endpoint itself is guarded in app.py (shared secret and RateLimiter).
+'''
+import copy
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter, deque
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import Pipeline
+
+#labels accepted by /feedback, the app answers with "Spam"/"Not Spam"
+LABELS = {'spam': 1, 'ham': 0, 'not spam': 0, '1': 1, '0': 0}
+
+
+def parse_label(label):
+    '''0/1 for a feedback label, raises ValueError for anything else'''
+    key = str(label).strip().lower()
+    if key not in LABELS:
+        raise ValueError('label must be "spam" or "ham"')
+    return LABELS[key]
+
+
+class FeedbackLog:
+    '''
+    Append-only json lines file of feedback records
+    appends are locked so several workers can write to the same file
+    '''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def append(self, record):
+        line = json.dumps(record) + '\n'
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read_new(self, offset=0):
+        '''
+        Records written after byte offset
+        returns: records, offset to pass next time (a half written last line is left for later)
+        '''
+        if not os.path.exists(self.path):
+            return [], offset
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        records = [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+        return records, offset + end
+
+
+class RateLimiter:
+    '''
+    At most limit requests per client in any window of seconds,
+    kept in memory so every worker counts the requests it receives
+    '''
+    #clients whose requests are all older than the window are dropped past this many
+    MAX_CLIENTS = 10000
+
+    def __init__(self, limit, window=60):
+        self.limit = limit
+        self.window = window
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def allow(self, client):
+        now = time.monotonic()
+        with self.lock:
+            if len(self.requests) > self.MAX_CLIENTS:
+                self.requests = {key: times for key, times in self.requests.items() if times[-1] > now - self.window}
+            times = self.requests.setdefault(client, deque())
+            while times and times[0] <= now - self.window:
+                times.popleft()
+            if len(times) >= self.limit:
+                return False
+            times.append(now)
+            return True
+
+
+def to_sgd(model, learning_rate=0.1, alpha=1e-6):
+    '''
+    SGDClassifier that starts from the weights of a fitted binary linear model
+    (the LinearSVC of the notebook or the SGDClassifier of incremental_train.py)
+    '''
+    if not hasattr(model, 'coef_') or model.coef_.shape[0] != 1:
+        raise ValueError(f'{type(model).__name__} is not a binary linear model')
+    sgd = SGDClassifier(loss='hinge', alpha=alpha, learning_rate='constant', eta0=learning_rate,
+                        shuffle=False, max_iter=1, tol=None)
+    #partial_fit sets up classes_ and the fitted state, the weights it learned from the two
+    #empty rows are then replaced (without averaging partial_fit keeps updating coef_ itself)
+    sgd.partial_fit(csr_matrix((2, model.coef_.shape[1])), model.classes_, classes=model.classes_)
+    sgd.coef_ = np.array(model.coef_, dtype=np.float64, order='C')
+    sgd.intercept_ = np.array(model.intercept_, dtype=np.float64).reshape(1)
+    return sgd
+
+
+def feedback_frame(records):
+    '''Feedback records as the dataframe the pipeline was trained on'''
+    return pd.DataFrame({
+        'combined_with_stopwords': [record['text'] for record in records],
+        'day_of_week': [record['day_of_week'] for record in records],
+        'repeat_freq': [record.get('repeat_freq', 1) for record in records]
+    }, index=range(len(records)))
+
+
+class OnlineUpdater:
+    '''
+    Background thread applying feedback to the served model
+        log: FeedbackLog to read
+        load_pipeline: returns the fitted pipeline to start from (called once)
+        on_update: called with each new pipeline, swaps it into the app
+        interval: seconds between passes over the log
+        learning_rate, alpha: SGD step size and regularization of the updates
+        load_holdout: returns the held-out emails as a training dataframe (called with load_pipeline), None skips the check
+        max_duplicates: times the same email is applied at most
+        max_flips: share of the held-out labels an update may change
+    '''
+    def __init__(self, log, load_pipeline, on_update, interval=300, learning_rate=0.1, alpha=1e-6,
+                 load_holdout=None, max_duplicates=3, max_flips=0.05):
+        self.log = log
+        self.load_pipeline = load_pipeline
+        self.on_update = on_update
+        self.interval = interval
+        self.learning_rate = learning_rate
+        self.alpha = alpha
+        self.load_holdout = load_holdout
+        self.max_duplicates = max_duplicates
+        self.max_flips = max_flips
+        self.offset = 0
+        self.pipeline = None
+        self.holdout = None
+        self.holdout_labels = None
+        self.seen = Counter()
+        self.applied = 0
+        self.rejected = 0
+        self.last_update = None
+        #held for a whole pass, so a reset never interleaves with an update
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='online-updater', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        #the first pass replays the feedback recorded before this worker started
+        while not self.stopped.is_set():
+            try:
+                self.update()
+            except Exception as e:
+                print(f"Exact error:{type(e).__name__}:{e}\nCould not apply feedback")
+            self.stopped.wait(self.interval)
+
+    def reset(self):
+        '''
+        Starts over from load_pipeline with the whole log on the next pass,
+        used when a new model version is deployed
+        '''
+        with self.lock:
+            self.pipeline = None
+            self.offset = 0
+            self.seen.clear()
+            self.applied = 0
+            self.rejected = 0
+
+    def update(self):
+        '''One pass: applies the new records, returns the number applied'''
+        with self.lock:
+            return self.apply_new()
+
+    def apply_new(self):
+        records, offset = self.log.read_new(self.offset)
+        if not records:
+            return 0
+        if self.pipeline is None:
+            base = self.load_pipeline()
+            model = to_sgd(base[-1], self.learning_rate, self.alpha)
+            self.pipeline = Pipeline([*base[:-1].steps, ('model', model)])
+            self.holdout = self.load_holdout() if self.load_holdout is not None else None
+            self.holdout_labels = self.pipeline.predict(self.holdout) if self.holdout is not None and len(self.holdout) else None
+        self.offset = offset
+
+        records = [record for record in records if self.count(record) <= self.max_duplicates]
+        if not records:
+            return 0
+        features = self.pipeline[:-1].transform(feedback_frame(records))
+        labels = np.array([record['label'] for record in records])
+        #train a copy, the pipeline being served is never modified in place
+        model = copy.deepcopy(self.pipeline[-1])
+        model.partial_fit(features, labels)
+        candidate = Pipeline([*self.pipeline[:-1].steps, ('model', model)])
+        flips = self.flip_share(candidate)
+        if flips > self.max_flips:
+            self.rejected += len(records)
+            print(f'Rejected {len(records)} feedback records, they change {flips:.1%} of the held-out labels')
+            return 0
+        self.pipeline = candidate
+        self.applied += len(records)
+        self.last_update = time.time()
+        self.on_update(self.pipeline)
+        print(f'Applied {len(records)} feedback records ({self.applied} in total)')
+        return len(records)
+
+    def count(self, record):
+        '''Times the email of a record was seen since the last reset, this one included'''
+        key = hashlib.sha256(record['text'].encode()).digest()
+        self.seen[key] += 1
+        return self.seen[key]
+
+    def flip_share(self, candidate):
+        '''Share of the held-out labels of the starting version that candidate changes'''
+        if self.holdout_labels is None:
+            return 0.0
+        return float(np.mean(candidate.predict(self.holdout) != self.holdout_labels))
+
+    def stats(self):
+        return {'applied': self.applied, 'rejected': self.rejected, 'last_update': self.last_update, 'interval': self.interval}
@@ -0,0 +1,83 @@
+'''
+Bounded cache of decision scores keyed on normalized email content
+
+Bulk mail campaigns send the same (or nearly the same) email many times,
+a repeated email is answered from the cache and skips vectorization and scoring.
+'''
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    '''
+    Lowercases and collapses whitespace, the tfidf tokenizer ignores
+    both so emails that only differ in them get the same score
+    '''
+    return ' '.join(text.lower().split())
+
+
+class PredictionCache:
+    '''
+    LRU cache with an optional time to live
+        capacity: largest number of entries kept, 0 turns the cache off
+        ttl: seconds an entry stays valid, 0 means entries never expire
+    least recently used entries are evicted first once the cache is full
+    '''
+    def __init__(self, capacity=10000, ttl=0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(text, *features):
+        '''Key of an email: hash of the normalized combined text plus the numeric features'''
+        digest = hashlib.blake2b(normalize_text(text).encode('utf-8'), digest_size=16).digest()
+        return (digest, *features)
+
+    def get(self, key, default=None):
+        if not self.capacity:
+            return default
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (self.ttl and time.monotonic() - entry[1] > self.ttl):
+                if entry is not None:
+                    del self.entries[key] #expired
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        if not self.capacity:
+            return
+        with self.lock:
+            self.entries[key] = (value, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        '''Drops every entry, used when the model changes'''
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'capacity': self.capacity,
+                'ttl': self.ttl,
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
@@ -0,0 +1,107 @@
+'''
+Streaming estimate of repeat_freq for live traffic
+
+At training time repeat_freq is the number of times the same subject + message
+shows up in the data (add_new_features in src/preprocessor.py). At serve time
+RepeatCounter keeps a count-min sketch of recently seen subject + message
+fingerprints with exponential time decay, so memory stays constant whatever
+the mail volume is and each email costs O(depth).
+
+When a path is given the sketch lives in a memory mapped file and every
+gunicorn worker that opens the same file shares (and updates) the same counts.
+'''
+import fcntl
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+
+#counts are stored scaled by 2**(age/half_life), rescale before float32 runs out of range
+MAX_EXPONENT = 60
+
+
+class RepeatCounter:
+    '''
+    Count-min sketch of email fingerprints with time decay
+        width: counters per row, more counters means fewer hash collisions
+        depth: number of rows (independent hashes), the estimate is the row minimum
+        half_life: seconds after which a sighting only counts for half
+        path: file to share the sketch between processes, None keeps it in memory
+    '''
+    def __init__(self, path=None, width=2**18, depth=4, half_life=86400):
+        self.width = width
+        self.depth = depth
+        self.half_life = half_life
+        self.path = path
+        self.thread_lock = threading.Lock()
+        self.rows = np.arange(depth)
+
+        if path is None:
+            self.header = np.array([time.time()], dtype=np.float64)
+            self.counts = np.zeros((depth, width), dtype=np.float32)
+            return
+
+        #file layout: float64 reference time followed by the float32 counters
+        size = 8 + 4 * depth * width
+        self.file = open(path, 'a+b')
+        with self.locked():
+            if os.path.getsize(path) != size:
+                self.file.truncate(0)
+                self.file.truncate(size)
+                np.memmap(path, dtype=np.float64, mode='r+', shape=(1,))[0] = time.time()
+        self.header = np.memmap(path, dtype=np.float64, mode='r+', shape=(1,))
+        self.counts = np.memmap(path, dtype=np.float32, mode='r+', offset=8, shape=(depth, width))
+
+    @contextmanager
+    def locked(self):
+        '''Lock across threads, and across processes when the sketch is in a file'''
+        with self.thread_lock:
+            if self.path is None:
+                yield
+                return
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def fingerprint(subject, message):
+        '''Same grouping as training: the exact subject and message'''
+        return f'{subject.strip()}\0{message.strip()}'.encode('utf-8')
+
+    def indexes(self, key):
+        '''One counter index per row from a single hash of the key'''
+        digest = hashlib.blake2b(key, digest_size=8 * self.depth).digest()
+        return np.frombuffer(digest, dtype=np.uint64) % np.uint64(self.width)
+
+    def estimate(self, keys):
+        '''Decayed count of every key without recording a sighting, at least 1'''
+        indexes = [self.indexes(key) for key in keys]
+        estimates = np.empty(len(indexes), dtype=np.float64)
+        with self.locked():
+            weight = 2.0 ** ((time.time() - self.header[0]) / self.half_life)
+            for i, columns in enumerate(indexes):
+                estimates[i] = self.counts[self.rows, columns].min()
+        return np.maximum(estimates / weight, 1.0)
+
+    def add(self, keys):
+        '''
+        Records one sighting of every key and returns
+        the decayed count of each (including this sighting), at least 1
+        '''
+        indexes = [self.indexes(key) for key in keys]
+        estimates = np.empty(len(indexes), dtype=np.float64)
+        with self.locked():
+            exponent = (time.time() - self.header[0]) / self.half_life
+            if exponent > MAX_EXPONENT:
+                self.counts *= np.float32(2.0 ** -exponent)
+                self.header[0] = time.time()
+                exponent = 0.0
+            weight = 2.0 ** exponent
+            for i, columns in enumerate(indexes):
+                self.counts[self.rows, columns] += np.float32(weight)
+                estimates[i] = self.counts[self.rows, columns].min()
+        return np.maximum(estimates / weight, 1.0)
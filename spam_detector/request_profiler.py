@@ -0,0 +1,221 @@
+'''
+Per request profiling of the prediction endpoints, off by default
+
+A profiled request runs under a call tracer (sys.setprofile, the hook cProfile
+uses) that records the time spent in every call stack, python and C functions
+alike, and writes the result as collapsed stacks, one
+"frame;frame;frame microseconds" line per stack, ready for flamegraph.pl or
+speedscope. Nothing is traced for the other requests.
+
+A request is profiled when:
+    PROFILE_SAMPLE_EVERY=N: every Nth request of each worker, the stacks are
+        added up in aggregate-<pid>.collapsed (production shaped hot spots)
+    the request carries a valid X-Spam-Profile header (needs PROFILE_SECRET),
+        written to its own file named in the X-Spam-Profile-File response header
+
+    PROFILE_DIR: where the profiles are written (default spam_profiles in the temp directory)
+    PROFILE_SECRET: key of the signed header, the header is ignored without it
+
+The header value is "<unix time>.<hex hmac sha256 of the time>" and is valid
+for PROFILE_MAX_AGE seconds (default 300):
+
+    curl -H "X-Spam-Profile: $(python request_profiler.py sign)" ...
+'''
+import argparse
+import functools
+import hashlib
+import hmac
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+HEADER = 'X-Spam-Profile'
+
+
+def sign(secret, timestamp=None):
+    '''Header value allowing one to profile requests for the next max_age seconds'''
+    timestamp = str(int(time.time() if timestamp is None else timestamp))
+    return f'{timestamp}.{hmac.new(secret.encode(), timestamp.encode(), hashlib.sha256).hexdigest()}'
+
+
+def verify(secret, value, max_age=300):
+    '''True when value was signed with secret less than max_age seconds ago'''
+    if not secret or not value or '.' not in value:
+        return False
+    timestamp, _ = value.split('.', 1)
+    try:
+        age = time.time() - int(timestamp)
+    except ValueError:
+        return False
+    return 0 <= age <= max_age and hmac.compare_digest(value, sign(secret, timestamp))
+
+
+def frame_name(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def builtin_name(function):
+    module = getattr(function, '__module__', None) or type(getattr(function, '__self__', None)).__name__
+    return f'{module}.{getattr(function, "__qualname__", function.__name__)}'
+
+
+class CallTracer:
+    '''
+    Self time of every call stack of the thread it runs on, in microseconds
+    frames are only pushed for calls made after start(), so the stacks start at the profiled function
+    '''
+    def __init__(self):
+        self.stacks = {}
+        self.frames = []
+        self.clock = time.perf_counter
+
+    def start(self):
+        sys.setprofile(self.trace)
+
+    def stop(self):
+        sys.setprofile(None)
+        #frames still open (the function calling stop) get the time up to now
+        now = self.clock()
+        while self.frames:
+            self.pop(now)
+
+    def trace(self, frame, event, arg):
+        now = self.clock()
+        if event == 'call':
+            self.push(frame_name(frame.f_code), now)
+        elif event == 'c_call':
+            self.push(builtin_name(arg), now)
+        elif self.frames:
+            #return, c_return and c_exception, a return of a frame entered before start() has nothing to pop
+            self.pop(now)
+
+    def push(self, name, now):
+        path = f'{self.frames[-1][0]};{name}' if self.frames else name
+        #stack path, start time, time spent in callees
+        self.frames.append([path, now, 0.0])
+
+    def pop(self, now):
+        path, start, children = self.frames.pop()
+        elapsed = now - start
+        self.stacks[path] = self.stacks.get(path, 0.0) + (elapsed - children) * 1e6
+        if self.frames:
+            self.frames[-1][2] += elapsed
+
+
+def write_collapsed(stacks, path):
+    '''Writes the stacks in the collapsed format, the file is replaced atomically'''
+    with open(f'{path}.tmp', 'w') as f:
+        for stack, micros in sorted(stacks.items()):
+            if micros >= 1:
+                f.write(f'{stack} {int(micros)}\n')
+    os.replace(f'{path}.tmp', path)
+
+
+class RequestProfiler:
+    '''
+    Decides which requests are profiled and writes their stacks
+        directory: where the collapsed stack files go
+        sample_every: profile every Nth request into the aggregate file, 0 turns sampling off
+        secret: key of the signed header, None turns the header off
+        max_age: seconds a signed header stays valid
+    '''
+    def __init__(self, directory, sample_every=0, secret=None, max_age=300):
+        self.directory = directory
+        self.sample_every = sample_every
+        self.secret = secret
+        self.max_age = max_age
+        self.requests = 0
+        self.profiled = 0
+        self.aggregate = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.sample_every > 0 or bool(self.secret)
+
+    def sampled(self):
+        '''True for every sample_every-th request of this worker'''
+        if self.sample_every <= 0:
+            return False
+        with self.lock:
+            self.requests += 1
+            return self.requests % self.sample_every == 0
+
+    def save_request(self, stacks, endpoint):
+        '''Writes the stacks of one request to their own file, returns its name'''
+        os.makedirs(self.directory, exist_ok=True)
+        #the random suffix keeps two requests of the same thread within a second from sharing a file
+        name = f'{endpoint}-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{uuid.uuid4().hex[:8]}.collapsed'
+        write_collapsed(stacks, os.path.join(self.directory, name))
+        return name
+
+    def save_sample(self, stacks):
+        '''Adds the stacks to the aggregate of this worker and rewrites its file'''
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            self.profiled += 1
+            for stack, micros in stacks.items():
+                self.aggregate[stack] = self.aggregate.get(stack, 0.0) + micros
+            write_collapsed(self.aggregate, os.path.join(self.directory, f'aggregate-{os.getpid()}.collapsed'))
+
+    def profiled_view(self, view):
+        '''Decorator for a flask view, profiles the requests selected by the header or the sampling'''
+        if not self.enabled:
+            return view
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            from flask import make_response, request
+            requested = bool(self.secret) and verify(self.secret, request.headers.get(HEADER), self.max_age)
+            sampled = self.sampled()
+            if not requested and not sampled:
+                return view(*args, **kwargs)
+
+            tracer = CallTracer()
+            tracer.start()
+            try:
+                response = make_response(view(*args, **kwargs))
+            finally:
+                tracer.stop()
+            try:
+                if sampled:
+                    self.save_sample(tracer.stacks)
+                if requested:
+                    response.headers[f'{HEADER}-File'] = self.save_request(tracer.stacks, request.endpoint)
+            except Exception as e:
+                print(f"Exact error:{type(e).__name__}:{e}\nCould not save the profile")
+            return response
+        return wrapper
+
+    def stats(self):
+        with self.lock:
+            return {'directory': self.directory,
+                    'sample_every': self.sample_every,
+                    'signed_header': bool(self.secret),
+                    'requests': self.requests,
+                    'sampled': self.profiled}
+
+
+def from_environ():
+    '''Profiler configured by the PROFILE_* environment variables'''
+    return RequestProfiler(os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'spam_profiles')),
+                           sample_every=int(os.environ.get('PROFILE_SAMPLE_EVERY', 0)),
+                           secret=os.environ.get('PROFILE_SECRET') or None,
+                           max_age=float(os.environ.get('PROFILE_MAX_AGE', 300)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Signed header value for profiling requests')
+    parser.add_argument('command', choices=['sign'])
+    parser.add_argument('--secret', default=os.environ.get('PROFILE_SECRET'), help='defaults to PROFILE_SECRET')
+    args = parser.parse_args()
+    if not args.secret:
+        parser.error('no secret, set PROFILE_SECRET or pass --secret')
+    print(sign(args.secret))
+
+
+if __name__ == '__main__':
+    main()
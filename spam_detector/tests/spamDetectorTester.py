@@ -1,7 +1,11 @@
 import requests
 import pandas as pd
+import numpy as np
 import time
 import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 class SpamDetectorTester:
     '''
@@ -15,18 +19,18 @@ class SpamDetectorTester:
         self.api_url = f"{url}/predict_api"
         self.results = []
     
-    def test_single_email(self, subject:str, message:str,expected:str)-> dict:
-        '''Tests a single email'''
+    def test_single_email(self, subject:str, message:str,expected:str, session=None)-> dict:
+        '''Tests a single email, session is a requests.Session to reuse its connection'''
         email = { 'subject':subject, 
                  'message':message
                  }
                
         #time how long it takes
-        start_time = time.time()
+        start_time = time.perf_counter()
 
         try:
-            response = requests.post(self.api_url, json=email)#sends email to app.py and process it, then sends prediction, and percentages
-            response_time = time.time() - start_time
+            response = (session or requests).post(self.api_url, json=email)#sends email to app.py and process it, then sends prediction, and percentages
+            response_time = time.perf_counter() - start_time
 
             if response.status_code == 200: #went through
                 result = response.json()
@@ -37,7 +41,7 @@ class SpamDetectorTester:
                         'status': 'error',
                         'error': result['error'],
                         'response time': response_time,
-                        'expected': expected,
+                        'expected prediction': expected,
                         'email subject': subject[:50] + "..." if len(subject) > 50 else subject
                         } 
                     self.results.append(error_result)    
@@ -62,9 +66,9 @@ class SpamDetectorTester:
                 error_result = {
                     'status': 'error',
                     'error': f"HTTP:{response.status_code}",
-                    'response_time': response_time,
-                    'expected': expected,
-                    'test_subject': subject[:50] + "..." if len(subject) > 50 else subject
+                    'response time': response_time,
+                    'expected prediction': expected,
+                    'email subject': subject[:50] + "..." if len(subject) > 50 else subject
                 }
                 self.results.append(error_result)
                 return error_result
@@ -72,9 +76,9 @@ class SpamDetectorTester:
             error_result = {
                     'status': 'error',
                     'error': str(e),
-                    'response_time': time.time() - start_time,
-                    'expected': expected,
-                    'test_subject': subject[:50] + "..." if len(subject) > 50 else subject
+                    'response time': time.perf_counter() - start_time,
+                    'expected prediction': expected,
+                    'email subject': subject[:50] + "..." if len(subject) > 50 else subject
             }
             self.results.append(error_result)
             
@@ -349,9 +353,109 @@ class SpamDetectorTester:
         results_df.to_csv('results_dataframe.csv', index=False)
         print(results_df)
 
+    def load_corpus(self, corpus:str, labels:str=None, limit:int=None)-> list:
+        '''
+        Emails to replay in the benchmark from a csv with Subject and Message
+        columns (like X_test.csv), labels is the matching Spam/Ham csv (like y_test.csv)
+        emails without a message are skipped, the app would reject them anyway
+        '''
+        X = pd.read_csv(corpus, usecols=['Subject','Message'])
+        expected = [None] * len(X)
+        if labels:
+            y = pd.read_csv(labels)['Spam/Ham'].str.strip()
+            expected = list(y.map({'spam':'Spam','ham':'Not Spam'}))
+        emails = [{'subject': subject if isinstance(subject, str) else '', 'message': message, 'expected': label}
+                  for subject, message, label in zip(X['Subject'], X['Message'], expected)
+                  if isinstance(message, str) and message.strip()]
+        return emails[:limit] if limit else emails
+
+    def benchmark(self, emails:list, concurrency:int=8, n_requests:int=None, warmup:int=10)-> dict:
+        '''
+        Replays emails against the api with concurrency parallel clients
+        each client thread keeps its own requests.Session so connections are reused
+        n_requests defaults to one request per email (emails are cycled when it is larger)
+        warmup requests are sent first and not measured
+        returns a summary with the latency percentiles, requests/s and error rate
+        '''
+        local = threading.local()
+        def send(email):
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            return self.test_single_email(email['subject'], email['message'], email.get('expected'), session=local.session)
+
+        n_requests = n_requests or len(emails)
+        replay = [emails[i % len(emails)] for i in range(n_requests)]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(send, replay[:warmup]))
+            self.results = []
+            start_time = time.perf_counter()
+            list(executor.map(send, replay))
+            total_time = time.perf_counter() - start_time
+
+        latencies = np.array([r['response time'] for r in self.results]) * 1000
+        errors = len([r for r in self.results if r['status'] != 'success'])
+        tests_with_label = [r for r in self.results if r.get('status') == 'success' and r.get('expected prediction')]
+        summary = {
+            'url': self.api_url,
+            'concurrency': concurrency,
+            'requests': len(self.results),
+            'requests/s': round(len(self.results) / total_time, 2),
+            'error rate': round(errors / len(self.results), 4),
+            'p50 ms': round(float(np.percentile(latencies, 50)), 2),
+            'p95 ms': round(float(np.percentile(latencies, 95)), 2),
+            'p99 ms': round(float(np.percentile(latencies, 99)), 2),
+            'max ms': round(float(latencies.max()), 2),
+            'accuracy': round(len([r for r in tests_with_label if r.get('correctly_predicted')]) / len(tests_with_label), 4) if tests_with_label else None,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        print(f"concurrency {concurrency}: {summary['requests/s']} requests/s, p50 {summary['p50 ms']}ms, "
+              f"p95 {summary['p95 ms']}ms, p99 {summary['p99 ms']}ms, error rate {summary['error rate']:.2%}")
+        return summary
+
+    def save_benchmark(self, summaries:list, results_path:str='benchmark_results.csv', summary_path:str='benchmark_summary.csv'):
+        '''
+        Writes the requests of the last benchmark run in the results_dataframe.csv
+        format and appends the summaries to summary_path, so runs can be compared over time
+        '''
+        results_df = pd.DataFrame(self.results)
+        col_order = ['email subject','status','expected prediction','Prediction','correctly_predicted', 'Ham probability', 'Spam probability','confidence', 'response time', 'error']
+        results_df.reindex(columns=col_order).to_csv(results_path, index=False)
+        summary_df = pd.DataFrame(summaries)
+        try:
+            summary_df = pd.concat([pd.read_csv(summary_path), summary_df], ignore_index=True)
+        except FileNotFoundError:
+            pass
+        summary_df.to_csv(summary_path, index=False)
+        print(summary_df.tail(len(summaries)))
+
 def main():
-    
-    tester = SpamDetectorTester()
+    '''
+    Runs the test cases, or with --benchmark load tests the api:
+        python spamDetectorTester.py --benchmark --corpus ../../data/X_test.csv --labels ../../data/y_test.csv
+    '''
+    parser = argparse.ArgumentParser(description='Tests or load tests the spam detector api')
+    parser.add_argument('--benchmark', action='store_true', help='replay a corpus at a given concurrency instead of the test cases')
+    parser.add_argument('--url', default='http://127.0.0.1:5001', help='url of the running app')
+    parser.add_argument('--corpus', default='../../data/X_test.csv', help='csv with Subject and Message columns')
+    parser.add_argument('--labels', help='csv with the Spam/Ham label of each corpus email')
+    parser.add_argument('--limit', type=int, help='only use the first emails of the corpus')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], help='parallel clients, one run per value')
+    parser.add_argument('--requests', type=int, help='requests per run, defaults to one per corpus email')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests before each run')
+    parser.add_argument('--results', default='benchmark_results.csv', help='requests of the last run')
+    parser.add_argument('--summary', default='benchmark_summary.csv', help='summaries, appended to')
+    args = parser.parse_args()
+
+    tester = SpamDetectorTester(args.url)
+    if not args.benchmark:
+        return run_tests(tester)
+    emails = tester.load_corpus(args.corpus, args.labels, args.limit)
+    print(f'Replaying {len(emails)} emails against {tester.api_url}')
+    summaries = [tester.benchmark(emails, concurrency, args.requests, args.warmup) for concurrency in args.concurrency]
+    tester.save_benchmark(summaries, args.results, args.summary)
+
+def run_tests(tester):
+    '''Runs the test cases against a running app and saves results_dataframe.csv'''
 
     #check if API is available
     print(f'Testing {tester.api_url}')
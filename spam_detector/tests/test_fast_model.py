@@ -0,0 +1,104 @@
+'''
+Parity of the compiled fast path with the sklearn pipeline it is built from
+
+Fits a small tfidf + scaler + linear model pipeline for each vectorizer
+option the fast path reproduces (ngram_range, sublinear_tf, binary) and
+checks that CompiledSpamModel, a compact export loaded back and the
+float16/int8 exports score like the pipeline. The quantized exports are
+lossy, their scores must stay within the error of rounding the coefficients.
+Both copies of fast_model.py (spam_detector and spam_app_lambda) are tested.
+
+    python -m pytest tests/test_fast_model.py
+'''
+import importlib.util
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.compose import ColumnTransformer
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import LinearSVC
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+SPAM = ["URGENT you have won a FREE prize, click here now to claim your cash",
+        "Cheap pills, no prescription needed, order now and save 90%",
+        "Congratulations winner! Claim your free gift card today",
+        "Make money fast from home, limited offer, act now",
+        "You have been selected for a cash reward, reply with your bank details"]
+HAM = ["Hi, just confirming our project meeting tomorrow at 3pm in room B",
+       "Can you send me the slides for the presentation before Friday?",
+       "Thanks for lunch today, see you at the team review next week",
+       "The quarterly report is attached, let me know if anything is missing",
+       "Reminder: the build is broken on main, please check your last commit"]
+#emails the model has not seen, with words out of the vocabulary and repeated terms
+EMAILS = ["Claim your FREE prize now now now", "Meeting moved to Friday, same room",
+          "", "winner winner cash cash cash reply today", "Lorem ipsum dolor sit amet " * 20,
+          "Re: slides for the review, thanks!", "ÜBER günstig: free pills çà et là"]
+
+VECTORIZERS = [{}, {'ngram_range': (1, 2)}, {'ngram_range': (2, 3)}, {'sublinear_tf': True},
+               {'binary': True}, {'ngram_range': (1, 2), 'sublinear_tf': True}, {'binary': True, 'norm': None}]
+
+
+def load_module(*path):
+    '''One of the copies of fast_model.py, loaded under its own name'''
+    spec = importlib.util.spec_from_file_location('fast_model_' + path[0], os.path.join(ROOT, *path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(params=[('spam_detector', 'fast_model.py'), ('spam_app_lambda', 'fast_model.py')], ids=lambda path: path[0])
+def fast_model(request):
+    return load_module(*request.param)
+
+
+def fit_pipeline(vectorizer_params, model):
+    texts = [text for pair in zip(SPAM, HAM) for text in pair] * 3
+    labels = [label for _ in range(len(SPAM)) for label in (1, 0)] * 3
+    data = pd.DataFrame({'combined_with_stopwords': texts,
+                         'day_of_week': np.arange(len(texts)) % 7,
+                         'repeat_freq': np.arange(len(texts)) % 4 + 1})
+    preprocessor = ColumnTransformer([
+        ('tfidf', TfidfVectorizer(**vectorizer_params), 'combined_with_stopwords'),
+        ('scaled_features', StandardScaler(), ['day_of_week', 'repeat_freq'])])
+    return Pipeline([('preprocessor', preprocessor), ('model', model)]).fit(data, labels)
+
+
+def pipeline_scores(pipeline, texts, day_of_week, repeat_freq):
+    frame = pd.DataFrame({'combined_with_stopwords': texts, 'day_of_week': day_of_week, 'repeat_freq': repeat_freq})
+    return pipeline.decision_function(frame)
+
+
+def quantization_bound(pipeline, texts, step):
+    '''Largest score error of coefficients each rounded by at most step: step times the l1 norm of each tfidf row'''
+    text_features = pipeline[0].named_transformers_['tfidf'].transform(texts)
+    return step * np.asarray(abs(text_features).sum(axis=1)).ravel() + 1e-9
+
+
+@pytest.mark.parametrize('vectorizer_params', VECTORIZERS, ids=str)
+@pytest.mark.parametrize('model', [LinearSVC(), LogisticRegression()], ids=lambda model: type(model).__name__)
+def test_exports_match_pipeline(fast_model, vectorizer_params, model, tmp_path):
+    pipeline = fit_pipeline(vectorizer_params, model)
+    texts = [fast_model.combine_text('', text) for text in EMAILS + SPAM + HAM]
+    day_of_week = np.arange(len(texts)) % 7
+    repeat_freq = np.arange(len(texts)) % 5 + 1
+    expected = pipeline_scores(pipeline, texts, day_of_week, repeat_freq)
+
+    engine = fast_model.CompiledSpamModel.from_pipeline(pipeline)
+    np.testing.assert_allclose(engine.decision_function(texts, day_of_week, repeat_freq), expected, atol=1e-9)
+    fast_model.check_parity(pipeline, engine, texts)
+
+    engine.export_compact(str(tmp_path / 'float64'))
+    compact = fast_model.CompiledSpamModel.load_compact(str(tmp_path / 'float64'))
+    np.testing.assert_allclose(compact.decision_function(texts, day_of_week, repeat_freq), expected, atol=1e-9)
+
+    max_coef = float(np.abs(engine.text_coef).max())
+    for coef_dtype, step in (('float16', max_coef * 2.0 ** -11), ('int8', max_coef / 127 / 2)):
+        engine.export_compact(str(tmp_path / coef_dtype), coef_dtype=coef_dtype)
+        quantized = fast_model.CompiledSpamModel.load_compact(str(tmp_path / coef_dtype))
+        error = np.abs(quantized.decision_function(texts, day_of_week, repeat_freq) - expected)
+        assert np.all(error <= quantization_bound(pipeline, texts, step)), coef_dtype
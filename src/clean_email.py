@@ -1,24 +1,85 @@
 import string
-stop_words = set(stopwords.words('english'))  
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from nltk.corpus import stopwords
+from nltk.tokenize import word_tokenize
+stop_words = set(stopwords.words('english'))
+
+#deletes every punctuation character in one pass over the string
+punctuation_table = str.maketrans('', '', string.punctuation)
+#once punctuation is gone the only thing word_tokenize still does to ascii text
+#is split these contractions (cannot -> can not, gonna -> gon na ...)
+contractions = re.compile(r'\b(can)(not)\b|\b(gim|lem)(me)\b|\b(gon)(na)\b|\b(got)(ta)\b|\b(wan)(na)(?=\s|$)')
+
+
+def split_contraction(match):
+    return ' '.join(part for part in match.groups() if part)
+
+
+def tokenize(no_punc_text):
+    '''
+    Same tokens as word_tokenize for text without punctuation
+    ascii text uses the precompiled regex and str.split, anything
+    else (unicode quotes, dashes ...) still goes through word_tokenize
+    '''
+    if no_punc_text.isascii():
+        return contractions.sub(split_contraction, no_punc_text).split()
+    return word_tokenize(no_punc_text)
+
 
 def clean_text(email):
     '''
     parameters: an email
-    
+
     function removes:
     Lowercase
     Tokenize
     Remove stopwords (and punctuation)
     returns: string of emails
-   
+
     '''
     #remove punctuations
-    no_punc_text =  ''.join([ch for ch in email.lower() if ch not in set(string.punctuation)])
+    no_punc_text = email.lower().translate(punctuation_table)
 
     #tokenize text returns a list of tokens
-    tokens = word_tokenize(no_punc_text)
-    
+    tokens = tokenize(no_punc_text)
+
     #remove stop words
     new_text = ' '.join([word for word in tokens if word not in stop_words])# returns a series
-    
-    return new_text 
\ No newline at end of file
+
+    return new_text
+
+
+def clean_chunk(emails):
+    '''Cleans a list of emails, runs inside the worker processes of clean_texts'''
+    return [clean_text(email) for email in emails]
+
+
+def clean_texts(emails, n_jobs=1, chunksize=1000):
+    '''
+    parameters: an iterable of emails (a list, a pandas Series, a generator ...)
+        n_jobs: number of worker processes, 1 cleans in this process
+        chunksize: number of emails sent to a worker at a time
+
+    same output as clean_text for every email, yielded in input order
+    the emails are read chunk by chunk so no intermediate list of the
+    whole corpus is built, to get a Series back:
+        pd.Series(clean_texts(X['Message']), index=X.index)
+    '''
+    if n_jobs == 1:
+        for email in emails:
+            yield clean_text(email)
+        return
+
+    emails = iter(emails)
+    chunks = iter(lambda: list(islice(emails, chunksize)), [])
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        #keep a couple of chunks per worker in flight instead of submitting the whole corpus
+        pending = deque(executor.submit(clean_chunk, chunk) for chunk in islice(chunks, 2 * n_jobs))
+        while pending:
+            cleaned = pending.popleft().result()
+            for chunk in islice(chunks, 1):
+                pending.append(executor.submit(clean_chunk, chunk))
+            yield from cleaned
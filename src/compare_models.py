@@ -0,0 +1,235 @@
+'''
+Parallel, resumable model comparison that produces scores_df.csv
+
+Takes a grid of models and max_features values (json, see DEFAULT_GRID)
+and cross validates every (model, max_features) row. The tfidf features
+of every fold are built once (FeatureCache) before the worker processes
+start, the workers inherit them read only and each (row, fold) job only
+scales the engineered features and fits the model. Every finished job is
+appended to a checkpoint file with a hash of the input file and of the job
+(model class and params, scaler, max_features, cv), re-running the same
+command skips them; a job whose data or spec changed is run again.
+
+    python compare_models.py ../data/cleaned_data.csv --grid grid.json --n-jobs 8
+    python compare_models.py ../data/cleaned_data.csv --test-x ../data/X_test.csv --test-y ../data/y_test.csv
+
+The output has the same columns as data/scores_df.csv (mean of the folds),
+with --test-x/--test-y the best row is refit on all the training data with
+model_fit.tfidf and scored on the test set with pred_scorer.evaluate_predictions.
+'''
+import argparse
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from scipy.sparse import hstack
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import StratifiedKFold
+from sklearn.preprocessing import MinMaxScaler, StandardScaler
+
+import model_fit
+import pred_scorer
+import preprocessor
+from feature_cache import FeatureCache, NUMERIC_COLUMNS
+
+#the models compared in 02_model_selection
+DEFAULT_GRID = {
+    'cv': 5,
+    'max_features': [67000],
+    'models': {
+        'mnb': {'class': 'sklearn.naive_bayes.MultinomialNB', 'scaler': 'minmax'},
+        'svc': {'class': 'sklearn.svm.SVC', 'params': {'kernel': 'linear'}},
+        'LR': {'class': 'sklearn.linear_model.LogisticRegression', 'params': {'max_iter': 1000}},
+        'Lscv': {'class': 'sklearn.svm.LinearSVC'},
+    },
+}
+
+SCALERS = {'standard': StandardScaler, 'minmax': MinMaxScaler}
+
+#fold features, filled in before the worker processes are forked so they share them
+shared = {}
+
+
+def build_model(spec):
+    '''Model instance from a grid entry: {"class": "module.Class", "params": {...}}'''
+    module, name = spec['class'].rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)(**spec.get('params', {}))
+
+
+def row_name(name, max_features):
+    '''Row of the scores dataframe, e.g. svc_67000'''
+    return name if max_features is None else f'{name}_{max_features}'
+
+
+def load_training_data(path):
+    '''
+    Cleaned training data with a Label column, either the csv of 01_data_analysis
+    (ham/spam labels, combined_text) or the output of preprocessor_stream.py
+    '''
+    data = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_feather(path) if path.endswith('.feather') else pd.read_csv(path)
+    if data['Label'].dtype == object:
+        data['Label'] = data['Label'].str.strip().map({'ham':0,'spam':1})
+    if 'combined_with_stopwords' not in data.columns:
+        data['combined_with_stopwords'] = data['combined_text'].str.lower().str.strip()
+    return data.reset_index(drop=True)
+
+
+def prepare_folds(data, cv, max_features_list, cache):
+    '''Builds the tfidf features of every fold and max_features once, into shared'''
+    X, y = data.drop(columns=['Label']), data['Label']
+    for fold, (train_index, test_index) in enumerate(StratifiedKFold(n_splits=cv).split(X, y)):
+        X_train, X_test = X.iloc[train_index], X.iloc[test_index]
+        shared[('y', fold)] = y.iloc[train_index].to_numpy(), y.iloc[test_index].to_numpy()
+        shared[('numeric', fold)] = X_train[NUMERIC_COLUMNS].to_numpy(), X_test[NUMERIC_COLUMNS].to_numpy()
+        for max_features in max_features_list:
+            shared[('text', fold, max_features)] = cache.tfidf_features(
+                list(X_train['combined_with_stopwords']), list(X_test['combined_with_stopwords']), max_features)
+
+
+def run_job(row, spec, max_features, fold):
+    '''Fits and scores one model on one fold, same numbers cross_validate reports'''
+    train_text, test_text = shared[('text', fold, max_features)]
+    train_numeric, test_numeric = shared[('numeric', fold)]
+    y_train, y_test = shared[('y', fold)]
+
+    scaler = SCALERS[spec.get('scaler', 'standard')]()
+    train_features = hstack([train_text, scaler.fit_transform(train_numeric)]).tocsr()
+    test_features = hstack([test_text, scaler.transform(test_numeric)]).tocsr()
+
+    start = time.perf_counter()
+    model = build_model(spec).fit(train_features, y_train)
+    fit_time = time.perf_counter() - start
+
+    scorers = {name: get_scorer(s) if isinstance(s, str) else s for name, s in pred_scorer.scorer.items()}
+    start = time.perf_counter()
+    result = {f'test_{name}': s(model, test_features, y_test) for name, s in scorers.items()}
+    score_time = time.perf_counter() - start
+    result.update({f'train_{name}': s(model, train_features, y_train) for name, s in scorers.items()})
+    return {'model': row, 'fold': fold, 'fit_time': fit_time, 'score_time': score_time, **result}
+
+
+def file_hash(path):
+    '''sha256 of a file, read in 1MB blocks'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def job_hash(data_hash, spec, max_features, cv):
+    '''
+    Identifies what a row computes: the input data, the model class and params,
+    the scaler, max_features and the folds (StratifiedKFold without shuffling,
+    so cv alone fixes them)
+    '''
+    job = {'data': data_hash, 'class': spec['class'], 'params': spec.get('params', {}),
+           'scaler': spec.get('scaler', 'standard'), 'max_features': max_features,
+           'folds': f'StratifiedKFold(n_splits={cv})'}
+    return hashlib.sha256(json.dumps(job, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def read_checkpoint(path, job_hashes):
+    '''
+    Finished jobs of an earlier run, keyed on (row, fold)
+    job_hashes maps each row to its job_hash, records of another job (other data,
+    params, ...) or without a hash are not reused
+    '''
+    done = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    if result.get('job') is not None and result.get('job') == job_hashes.get(result['model']):
+                        done[(result['model'], result['fold'])] = result
+    return done
+
+
+def summarize(results, rows):
+    '''Mean of the folds per row, columns in the order of data/scores_df.csv'''
+    columns = ['fit_time', 'score_time']
+    for name in pred_scorer.scorer:
+        columns += [f'test_{name}', f'train_{name}']
+    scores = pd.DataFrame(results).groupby('model')[columns].mean().round(4)
+    return scores.reindex([row for row in rows if row in scores.index])
+
+
+def evaluate_on_test_set(data, spec, max_features, scores_df, test_x, test_y):
+    '''
+    Refits one row on all the training data with model_fit.tfidf and adds its
+    test set scores to the test_ columns of scores_df, like scores_df_test.csv
+    '''
+    X_test, y_test = preprocessor.clean_data(pd.read_csv(test_x), pd.read_csv(test_y))
+    X_test = preprocessor.combine_data(preprocessor.add_new_features(X_test))
+
+    scaler = SCALERS[spec.get('scaler', 'standard')]()
+    pipeline, _, _ = model_fit.tfidf(data.copy(), max_features, build_model(spec), scaler)
+    preds = pipeline.predict(X_test)
+    scores_df_test = scores_df.loc[:, scores_df.columns.str.startswith('test')].copy()
+    if hasattr(pipeline, 'decision_function'):
+        return pred_scorer.evaluate_predictions(scores_df_test, y_test, preds, pred_decision=pipeline.decision_function(X_test))
+    return pred_scorer.evaluate_predictions(scores_df_test, y_test, preds, pred_proba=pipeline.predict_proba(X_test))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cross validate a grid of models and write a scores_df csv')
+    parser.add_argument('train', help='cleaned training data (.csv, .parquet or .feather) with a Label column')
+    parser.add_argument('--grid', help='json file with cv, max_features and models, defaults to the notebook models')
+    parser.add_argument('--n-jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--checkpoint', default='compare_models_checkpoint.jsonl', help='finished jobs, used to resume')
+    parser.add_argument('--output', default='../data/scores_df.csv')
+    parser.add_argument('--cache-dir', default='../data/feature_cache', help='where fold count matrices are cached')
+    parser.add_argument('--test-x', help='raw X_test.csv, scores the best row on the test set')
+    parser.add_argument('--test-y', help='raw y_test.csv')
+    parser.add_argument('--test-output', default='../data/scores_df_test.csv')
+    args = parser.parse_args()
+
+    grid = DEFAULT_GRID
+    if args.grid:
+        with open(args.grid) as f:
+            grid = json.load(f)
+    cv, max_features_list = grid.get('cv', 5), grid.get('max_features', [None])
+    rows = {row_name(name, k): (spec, k) for name, spec in grid['models'].items() for k in max_features_list}
+
+    data_hash = file_hash(args.train)
+    job_hashes = {row: job_hash(data_hash, spec, k, cv) for row, (spec, k) in rows.items()}
+    done = read_checkpoint(args.checkpoint, job_hashes)
+    jobs = [(row, fold) for row in rows for fold in range(cv) if (row, fold) not in done]
+    print(f'{len(done)} jobs already finished, {len(jobs)} to run')
+
+    data = load_training_data(args.train)
+    if jobs:
+        prepare_folds(data, cv, max_features_list, FeatureCache(args.cache_dir))
+        #fork shares the fold features with the workers without copying them
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        n_jobs = args.n_jobs if context is not None else 1
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as executor, open(args.checkpoint, 'a') as checkpoint:
+            futures = [executor.submit(run_job, row, rows[row][0], rows[row][1], fold) for row, fold in jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                result['job'] = job_hashes[result['model']]
+                checkpoint.write(json.dumps(result) + '\n')
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+                done[(result['model'], result['fold'])] = result
+                print(f"{result['model']} fold {result['fold']}: F1 {result['test_F1']:.4f} in {result['fit_time']:.1f}s")
+
+    scores_df = summarize(list(done.values()), rows)
+    scores_df.to_csv(args.output)
+    print(scores_df)
+
+    if args.test_x and args.test_y:
+        best = scores_df['test_F1'].idxmax()
+        print(f'Scoring {best} on the test set')
+        scores_df_test = evaluate_on_test_set(data, *rows[best], scores_df, args.test_x, args.test_y)
+        scores_df_test.to_csv(args.test_output)
+        print(scores_df_test)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+'''
+Pruned and quantized copies of the deployed tfidf + linear model pipeline
+
+Many of the 67000 tfidf terms have a coefficient close to zero, they cost
+vocabulary memory and lookups without changing many predictions. This drops
+the terms whose coefficient magnitude is below --threshold (or keeps only the
+--keep largest ones), optionally rounds the remaining coefficients to the
+float16 or int8 grid, and writes a smaller pipeline that loads like the
+original one. The original and the compressed pipeline are scored on the
+test set with pred_scorer.evaluate_predictions and the F1/AUC delta, the
+artifact sizes and the scoring time are reported.
+
+    python compress_model.py ../spam_detector/models/spam_trained_model.joblib --threshold 0.05 \\
+        --test-x ../data/X_test.csv --test-y ../data/y_test.csv --output models/spam_model_pruned.joblib
+    python compress_model.py ../spam_detector/models/spam_trained_model.joblib --keep 20000 --quantize int8 \\
+        --test-x ../data/X_test.csv --test-y ../data/y_test.csv \\
+        --output models/pruned/spam_trained_model.joblib --compact models/pruned/spam_model_compact
+
+Pruned terms no longer count in the l2 norm of the tfidf vector, so the
+scores of the kept terms change slightly too, the delta includes that.
+With --compact the compressed pipeline is also exported for the fast path
+(fast_model.py), int8/float16 coefficients are stored as such there. The
+output directory is laid out like spam_detector/models/ (keep the joblib
+named spam_trained_model.joblib) so it can be served or published as is.
+'''
+import argparse
+import copy
+import os
+import sys
+import time
+import joblib
+import numpy as np
+import pandas as pd
+
+import pred_scorer
+import preprocessor
+
+SCORE_COLUMNS = ['test_F1', 'test_Precision', 'test_Recall', 'test_Recall_ham', 'test_Accuracy', 'test_AUC']
+
+
+def text_block(pipeline):
+    '''name, fitted TfidfVectorizer and output slice of the text features of the ColumnTransformer'''
+    column_transformer = pipeline[0]
+    for name, transformer, _ in column_transformer.transformers_:
+        if type(transformer).__name__ == 'TfidfVectorizer':
+            return name, transformer, column_transformer.output_indices_[name]
+    raise ValueError('pipeline has no TfidfVectorizer')
+
+
+def quantize(values, kind):
+    '''Rounds values to the float16 or int8 (symmetric, one scale) grid, returns float64'''
+    if kind == 'float16':
+        return values.astype(np.float16).astype(np.float64)
+    if kind == 'int8':
+        step = float(np.abs(values).max()) / 127 if len(values) else 0.0
+        step = step or 1.0
+        return np.round(values / step) * step
+    raise ValueError(f'unknown quantization {kind}')
+
+
+def compress(pipeline, threshold=0.0, keep=None, quantize_to=None):
+    '''
+    Copy of pipeline without the tfidf terms whose coefficient magnitude is below
+    threshold (with keep, only the keep largest terms stay)
+    quantize_to: None, 'float16' or 'int8', rounds the remaining text coefficients
+    returns: compressed pipeline, number of terms kept
+    '''
+    model = pipeline[-1]
+    if not hasattr(model, 'coef_') or model.coef_.shape[0] != 1:
+        raise ValueError(f'{type(model).__name__} is not a binary linear model')
+    name, vectorizer, text_slice = text_block(pipeline)
+    text_coef = model.coef_[0, text_slice]
+    magnitude = np.abs(text_coef)
+    if keep is not None:
+        kept = np.sort(np.argsort(-magnitude, kind='stable')[:keep])
+    else:
+        kept = np.flatnonzero(magnitude >= threshold)
+
+    compressed = copy.deepcopy(pipeline)
+    column_transformer, new_model = compressed[0], compressed[-1]
+    new_vectorizer = column_transformer.named_transformers_[name]
+    #kept terms keep their relative order, so the new index is the rank among the kept ones
+    new_index = np.full(len(text_coef), -1)
+    new_index[kept] = np.arange(len(kept))
+    new_vectorizer.vocabulary_ = {term: int(new_index[index]) for term, index in vectorizer.vocabulary_.items() if new_index[index] >= 0}
+    if getattr(new_vectorizer, 'use_idf', False):
+        new_vectorizer.idf_ = vectorizer.idf_[kept]
+    #the vectorizer's inner TfidfTransformer checks the number of terms it gets
+    inner = getattr(new_vectorizer, '_tfidf', None)
+    if hasattr(inner, 'n_features_in_'):
+        inner.n_features_in_ = len(kept)
+    if hasattr(new_vectorizer, 'stop_words_'):
+        #terms cut by max_features, only kept for introspection
+        new_vectorizer.stop_words_ = set()
+
+    new_text_coef = text_coef[kept]
+    if quantize_to:
+        new_text_coef = quantize(new_text_coef, quantize_to)
+    #the output columns of the ColumnTransformer shift by the number of pruned terms
+    removed = len(text_coef) - len(kept)
+    output_indices = {}
+    for block, block_slice in column_transformer.output_indices_.items():
+        if block == name:
+            output_indices[block] = slice(block_slice.start, block_slice.start + len(kept))
+        elif block_slice.start >= text_slice.stop:
+            output_indices[block] = slice(block_slice.start - removed, block_slice.stop - removed)
+        else:
+            output_indices[block] = block_slice
+    column_transformer.output_indices_ = output_indices
+
+    coef = model.coef_[0]
+    new_model.coef_ = np.concatenate([coef[:text_slice.start], new_text_coef, coef[text_slice.stop:]]).reshape(1, -1)
+    new_model.n_features_in_ = new_model.coef_.shape[1]
+    return compressed, len(kept)
+
+
+def evaluate(pipeline, X_test, y_test):
+    '''test_ scores of evaluate_predictions and the time of predict + decision_function per email'''
+    #warm up so the first model timed does not pay for the imports and caches
+    pipeline.decision_function(X_test.head(10))
+    start = time.perf_counter()
+    preds = pipeline.predict(X_test)
+    decision = pipeline.decision_function(X_test)
+    elapsed = time.perf_counter() - start
+    scores = pred_scorer.evaluate_predictions(pd.DataFrame(columns=SCORE_COLUMNS), y_test, preds, pred_decision=decision)
+    return scores.loc['test_set'], elapsed / len(X_test) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prune and quantize the model, report the F1/AUC delta')
+    parser.add_argument('model', help='spam_trained_model.joblib')
+    parser.add_argument('--threshold', type=float, default=0.0, help='drop terms whose coefficient magnitude is below this')
+    parser.add_argument('--keep', type=int, help='keep only the terms with the largest coefficients, instead of --threshold')
+    parser.add_argument('--quantize', choices=['float16', 'int8'], help='round the remaining text coefficients')
+    parser.add_argument('--test-x', required=True, help='raw X_test.csv')
+    parser.add_argument('--test-y', required=True, help='raw y_test.csv')
+    parser.add_argument('--output', default='models/spam_model_pruned.joblib', help='compressed pipeline')
+    parser.add_argument('--compact', help='also export the compressed pipeline as a compact model to this directory')
+    args = parser.parse_args()
+
+    X_test, y_test = preprocessor.clean_data(pd.read_csv(args.test_x), pd.read_csv(args.test_y))
+    X_test = preprocessor.combine_data(preprocessor.add_new_features(X_test))
+
+    pipeline = joblib.load(args.model)
+    compressed, kept = compress(pipeline, args.threshold, args.keep, args.quantize)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    joblib.dump(compressed, args.output)
+
+    report = {}
+    for name, model, path in (('original', pipeline, args.model), ('compressed', compressed, args.output)):
+        scores, us_per_email = evaluate(model, X_test, y_test)
+        report[name] = {**scores, 'terms': len(text_block(model)[1].vocabulary_),
+                        'size_kb': os.path.getsize(path) / 1024, 'us_per_email': us_per_email}
+    report = pd.DataFrame(report).T
+    report.loc['delta'] = report.loc['compressed'] - report.loc['original']
+    print(f'Kept {kept} of {len(text_block(pipeline)[1].vocabulary_)} terms'
+          f'{f", {args.quantize} coefficients" if args.quantize else ""}, saved {args.output}')
+    print(report.round(4).to_string())
+
+    if args.compact:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'spam_detector'))
+        from fast_model import PARITY_EMAILS, CompiledSpamModel, check_parity, combine_text, file_sha256
+        CompiledSpamModel.from_pipeline(compressed).export_compact(
+            args.compact, source_sha256=file_sha256(args.output), coef_dtype=args.quantize or 'float64')
+        engine = CompiledSpamModel.load_compact(args.compact)
+        check_parity(compressed, engine, [combine_text(subject, message) for subject, message in PARITY_EMAILS])
+        size = sum(os.path.getsize(os.path.join(args.compact, f)) for f in os.listdir(args.compact))
+        print(f'Exported the compact model to {args.compact} ({size / 1024:.0f}KB)')
+
+
+if __name__ == '__main__':
+    main()
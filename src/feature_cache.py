@@ -0,0 +1,134 @@
+'''
+Feature cache for model selection
+
+The GridSearch over max_features in 02_model_selection refits the
+TfidfVectorizer (tokenize + count the whole fold) for every candidate.
+FeatureCache counts each fold once, saves the sparse count matrices to
+disk under a hash of the fold content, and builds the features of any
+max_features value by slicing the cached counts:
+    TfidfVectorizer(max_features=k) keeps the k terms with the highest
+    total count in the training fold, then applies idf and l2 norm
+so the result is the same matrix the ColumnTransformer in model_fit.tfidf
+gives, and a search over max_features only pays for the model fits.
+'''
+import hashlib
+import os
+import time
+import numpy as np
+import pandas as pd
+from scipy.sparse import hstack, load_npz, save_npz
+from sklearn.base import clone
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import StratifiedKFold
+from sklearn.preprocessing import StandardScaler
+
+from pred_scorer import scorer
+
+#engineered features scaled next to the tfidf columns, same as model_fit.tfidf
+NUMERIC_COLUMNS = ['day_of_week', 'repeat_freq']
+
+
+class FeatureCache:
+    '''
+    Cache of per fold count matrices
+        cache_dir: directory for the .npz files, None keeps them in memory only
+        count_params: CountVectorizer parameters (must match the TfidfVectorizer that is replaced)
+    '''
+    def __init__(self, cache_dir='../data/feature_cache', **count_params):
+        self.cache_dir = cache_dir
+        self.count_params = count_params
+        self.memory = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def fold_key(self, train_texts, test_texts):
+        '''Content hash of the fold and the vectorizer parameters'''
+        digest = hashlib.sha256(repr(sorted(self.count_params.items())).encode())
+        for texts in (train_texts, test_texts):
+            digest.update(b'\1')
+            for text in texts:
+                digest.update(text.encode('utf-8'))
+                digest.update(b'\0')
+        return digest.hexdigest()[:24]
+
+    def fold_counts(self, train_texts, test_texts):
+        '''
+        Count matrices of a fold over the full training vocabulary
+        columns are sorted by term like CountVectorizer.vocabulary_
+        returns: train counts, test counts, total count of each term in the training fold
+        '''
+        key = self.fold_key(train_texts, test_texts)
+        if key in self.memory:
+            return self.memory[key]
+
+        paths = [os.path.join(self.cache_dir, f'{key}_{part}.npz') for part in ('train', 'test')] if self.cache_dir else None
+        if paths and all(os.path.exists(path) for path in paths):
+            train_counts, test_counts = (load_npz(path) for path in paths)
+        else:
+            print('Counting terms of a new fold')
+            vectorizer = CountVectorizer(**self.count_params)
+            train_counts = vectorizer.fit_transform(train_texts).tocsc()
+            test_counts = vectorizer.transform(test_texts).tocsc()
+            if paths:
+                save_npz(paths[0], train_counts)
+                save_npz(paths[1], test_counts)
+
+        term_counts = np.asarray(train_counts.sum(axis=0)).ravel()
+        self.memory[key] = train_counts, test_counts, term_counts
+        return self.memory[key]
+
+    def tfidf_features(self, train_texts, test_texts, max_features=None):
+        '''
+        Tfidf matrices of a fold as TfidfVectorizer(max_features) would build them
+        returns: train features, test features
+        '''
+        train_counts, test_counts, term_counts = self.fold_counts(train_texts, test_texts)
+        if max_features is not None and max_features < len(term_counts):
+            #same selection (and tie order) as CountVectorizer._limit_features
+            keep = np.sort((-term_counts).argsort()[:max_features])
+            train_counts, test_counts = train_counts[:, keep], test_counts[:, keep]
+
+        tfidf = TfidfTransformer()
+        return tfidf.fit_transform(train_counts), tfidf.transform(test_counts)
+
+    def fold_features(self, X_train, X_test, max_features=None, text_column='combined_with_stopwords', scaler=None):
+        '''
+        Same features as the preprocessor of model_fit.tfidf for one fold:
+        tfidf of the text column followed by the scaled engineered features
+        scaler defaults to StandardScaler, MultinomialNB needs a MinMaxScaler
+        (the scaled columns are refit on every call, only the counts are cached)
+        '''
+        train_text, test_text = self.tfidf_features(list(X_train[text_column]), list(X_test[text_column]), max_features)
+        scaler = clone(scaler) if scaler is not None else StandardScaler()
+        train_numeric = scaler.fit_transform(X_train[NUMERIC_COLUMNS])
+        test_numeric = scaler.transform(X_test[NUMERIC_COLUMNS])
+        return hstack([train_text, train_numeric]).tocsr(), hstack([test_text, test_numeric]).tocsr()
+
+
+def search_max_features(model, X, y, max_features_list, cv=5, scoring=scorer, cache=None, scaler=None):
+    '''
+    Cross validated scores of model for every max_features value, the
+    cached replacement of GridSearchCV over preprocessor__tfidf__max_features
+    each fold is counted once and only the model is refit per candidate
+    scaler is the one of the engineered features, as in model_fit.tfidf
+    returns a dataframe with the mean fit_time, score_time and test scores per max_features
+    '''
+    cache = cache or FeatureCache()
+    scoring = {name: get_scorer(s) if isinstance(s, str) else s for name, s in scoring.items()}
+    results = {max_features: [] for max_features in max_features_list}
+
+    #GridSearchCV(cv=5) on a classifier uses the same unshuffled stratified folds
+    for train_index, test_index in StratifiedKFold(n_splits=cv).split(X, y):
+        X_train, X_test = X.iloc[train_index], X.iloc[test_index]
+        y_train, y_test = y.iloc[train_index], y.iloc[test_index]
+        for max_features in max_features_list:
+            train_features, test_features = cache.fold_features(X_train, X_test, max_features, scaler=scaler)
+            start = time.perf_counter()
+            fitted = clone(model).fit(train_features, y_train)
+            fit_time = time.perf_counter() - start
+            start = time.perf_counter()
+            scores = {f'test_{name}': s(fitted, test_features, y_test) for name, s in scoring.items()}
+            results[max_features].append({'fit_time': fit_time, 'score_time': time.perf_counter() - start, **scores})
+
+    return pd.DataFrame({max_features: pd.DataFrame(folds).mean() for max_features, folds in results.items()}).T.round(4)
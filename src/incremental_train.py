@@ -0,0 +1,202 @@
+'''
+Out of core training with hashing features and partial_fit
+
+model_fit.tfidf needs the whole training set in memory and refits from
+scratch. This trains the same kind of pipeline on mini-batches streamed
+from disk instead:
+    HashingVectorizer  stateless, no vocabulary to fit or keep in memory
+    StandardScaler     day_of_week and repeat_freq, fitted on every email in a
+                       first pass over the stream and then kept as it is
+    SGDClassifier      linear model updated with partial_fit (hinge loss is a linear svm)
+so memory is bounded by the batch size and not by the size of the archive.
+The scaler is not updated while the model trains: weights learned on the
+first batches would otherwise be applied to features scaled another way.
+With --update the scaler of the artifact is kept as it was fitted.
+
+The artifact is a Pipeline([ColumnTransformer, model]) saved with joblib,
+the Flask app loads it like spam_trained_model.joblib. With --update an
+existing artifact is loaded and the new emails are folded in, e.g. daily:
+
+    python incremental_train.py ../data/cleaned_data.parquet models/spam_sgd_model.joblib --epochs 3
+    python incremental_train.py ../data/labeled_2026-10-18.csv models/spam_sgd_model.joblib --update
+
+The input is cleaned data with a Label column (output of preprocessor_stream.py,
+or a csv with combined_text / combined_with_stopwords, day_of_week and repeat_freq).
+'''
+import argparse
+import os
+import time
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.compose import ColumnTransformer
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+from feature_cache import NUMERIC_COLUMNS
+
+CLASSES = np.array([0, 1])
+
+
+def new_pipeline(n_features=2**20, loss='hinge', alpha=1e-5, average=False, random_state=0):
+    '''Unfitted hashing + scaled features + SGD pipeline'''
+    preprocessor = ColumnTransformer([
+                            #no vocabulary: terms are hashed into n_features columns, l2 normalized like tfidf
+                            ('hashing', HashingVectorizer(n_features=n_features, alternate_sign=False), 'combined_with_stopwords'),
+                            ('scaled_features', StandardScaler(), NUMERIC_COLUMNS)
+                                ])
+    model = SGDClassifier(loss=loss, alpha=alpha, average=average, random_state=random_state)
+    return Pipeline([
+                ('preprocessor', preprocessor),
+                ('model', model)
+            ])
+
+
+def read_batches(path, batch_size):
+    '''
+    Yields the emails of a parquet, feather or csv file as dataframes
+    of at most batch_size rows, the file is never loaded whole
+    '''
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield batch.to_pandas()
+    elif path.endswith('.feather') or path.endswith('.arrow'):
+        import pyarrow as pa
+        import pyarrow.ipc as ipc
+        reader = ipc.open_file(pa.memory_map(path))
+        for i in range(reader.num_record_batches):
+            #record batches are as large as the chunks they were written with
+            for batch in pa.Table.from_batches([reader.get_batch(i)]).to_batches(max_chunksize=batch_size):
+                yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=batch_size)
+
+
+def prepare_batch(X):
+    '''Label as 0/1 and the combined text column the pipeline reads'''
+    if X['Label'].dtype == object:
+        X['Label'] = X['Label'].str.strip().map({'ham':0,'spam':1})
+    if 'combined_with_stopwords' not in X.columns:
+        X['combined_with_stopwords'] = X['combined_text'].str.lower().str.strip()
+    X['combined_with_stopwords'] = X['combined_with_stopwords'].fillna('')
+    return X
+
+
+def labeled_batches(path, batch_size):
+    '''Batches of read_batches with their labels as 0/1, rows without a label are dropped'''
+    for X in read_batches(path, batch_size):
+        X = prepare_batch(X)
+        X = X[X['Label'].notna()]
+        if len(X):
+            yield X
+
+
+def fit_preprocessor(path, pipeline, batch_size=10000):
+    '''
+    First pass over the stream for a new pipeline: fits the (stateless) vectorizer
+    and fits the scaler on every email, before the model sees any of them
+    '''
+    preprocessor, scaler, start = pipeline[0], None, time.perf_counter()
+    for X in labeled_batches(path, batch_size):
+        if scaler is None:
+            preprocessor.fit(X)
+            scaler = preprocessor.named_transformers_['scaled_features']
+        else:
+            scaler.partial_fit(X[NUMERIC_COLUMNS])
+    if scaler is None:
+        raise ValueError(f'no labeled emails in {path}')
+    print(f'Scaler fitted on {scaler.n_samples_seen_} emails in {time.perf_counter() - start:.1f}s')
+    return pipeline
+
+
+def partial_fit(pipeline, X, y):
+    '''Updates the model with one batch, the vectorizer and the scaler stay as fitted'''
+    preprocessor, model = pipeline[0], pipeline[-1]
+    model.partial_fit(preprocessor.transform(X), y, classes=CLASSES)
+    return pipeline
+
+
+class ProgressiveScore:
+    '''
+    Scores every batch with the model before it trains on it, so the
+    numbers are on unseen emails without keeping a hold-out set around
+    '''
+    def __init__(self):
+        self.counts = {'tp': 0, 'fp': 0, 'fn': 0, 'correct': 0, 'total': 0}
+
+    def update(self, y, preds):
+        self.counts['tp'] += int(((preds == 1) & (y == 1)).sum())
+        self.counts['fp'] += int(((preds == 1) & (y == 0)).sum())
+        self.counts['fn'] += int(((preds == 0) & (y == 1)).sum())
+        self.counts['correct'] += int((preds == y).sum())
+        self.counts['total'] += len(y)
+
+    def report(self):
+        c = self.counts
+        f1 = 2 * c['tp'] / max(2 * c['tp'] + c['fp'] + c['fn'], 1)
+        accuracy = c['correct'] / max(c['total'], 1)
+        return f'F1 {f1:.4f}, Accuracy {accuracy:.4f} on {c["total"]} unseen emails'
+
+
+def train(path, pipeline, batch_size=10000, epochs=1, log_every=10, random_state=0):
+    '''
+    Streams the emails at path through partial_fit epochs times
+    a new pipeline first gets its scaler from fit_preprocessor,
+    rows are shuffled within each batch, returns the updated pipeline
+    '''
+    if not hasattr(pipeline[0], 'transformers_'):
+        fit_preprocessor(path, pipeline, batch_size)
+    rng = np.random.default_rng(random_state)
+    for epoch in range(epochs):
+        score, n_batches, start = ProgressiveScore(), 0, time.perf_counter()
+        for X in labeled_batches(path, batch_size):
+            X = X.iloc[rng.permutation(len(X))]
+            y = X.pop('Label').to_numpy(dtype=int)
+            if hasattr(pipeline[-1], 'coef_'):
+                score.update(y, pipeline.predict(X))
+            partial_fit(pipeline, X, y)
+            n_batches += 1
+            if n_batches % log_every == 0:
+                print(f'epoch {epoch + 1} batch {n_batches}: {score.report()}')
+        print(f'epoch {epoch + 1} done in {time.perf_counter() - start:.1f}s: {score.report()}')
+    return pipeline
+
+
+def save_artifact(pipeline, path):
+    '''Writes the joblib file atomically so a running app never reads half of it'''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    joblib.dump(pipeline, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental training of a hashing + SGD spam model')
+    parser.add_argument('data', help='cleaned labeled emails (.parquet, .feather or .csv)')
+    parser.add_argument('artifact', help='joblib file to write (and read with --update)')
+    parser.add_argument('--update', action='store_true', help='fold the emails into the existing artifact')
+    parser.add_argument('--batch-size', type=int, default=10000, help='emails in memory at a time')
+    parser.add_argument('--epochs', type=int, default=1, help='passes over the data')
+    parser.add_argument('--n-features', type=int, default=2**20, help='hashing vectorizer columns')
+    parser.add_argument('--loss', default='hinge', help='SGDClassifier loss, hinge is a linear svm')
+    parser.add_argument('--alpha', type=float, default=1e-5, help='SGDClassifier regularization')
+    parser.add_argument('--average', action='store_true', help='averaged SGD, steadier across daily updates')
+    parser.add_argument('--log-every', type=int, default=10, help='batches between progress lines')
+    args = parser.parse_args()
+
+    if args.update and os.path.exists(args.artifact):
+        pipeline = joblib.load(args.artifact)
+        print(f'Updating {args.artifact}')
+    else:
+        pipeline = new_pipeline(args.n_features, args.loss, args.alpha, args.average)
+
+    train(args.data, pipeline, args.batch_size, args.epochs, args.log_every)
+    save_artifact(pipeline, args.artifact)
+    print(f'Saved {args.artifact}')
+
+
+if __name__ == '__main__':
+    main()
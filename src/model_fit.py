@@ -1,17 +1,25 @@
 from scipy.sparse import hstack
 from sklearn.compose import ColumnTransformer
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 
 
-def tfidf(data, best_param, model):
-    data['Label'] = y
-    X = data.drop(columns=['Label'], axis=1)
+def tfidf(data, best_param, model, scaler=None):
+    '''
+    Fits the tfidf + scaled features + model pipeline on data
+    data has a Label column, scaler defaults to StandardScaler
+    (MultinomialNB needs a MinMaxScaler because it cannot take negative values)
+    returns: fitted pipeline, X, y
+    '''
+    y = data['Label']
+    X = data.drop(columns=['Label'])
 
     preprocessor = ColumnTransformer([
                             #name, transformation, columns to transform
                             ('tfidf',TfidfVectorizer(max_features=best_param), 'combined_with_stopwords'),
                             #scale engineered features
-                            ('scaled_features', StandardScaler(),['day_of_week', 'repeat_freq'])
+                            ('scaled_features', scaler if scaler is not None else StandardScaler(),['day_of_week', 'repeat_freq'])
                                 ])
    
 
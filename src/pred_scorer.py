@@ -1,4 +1,13 @@
-from sklearn.metrics import accuracy_score, confusion_matrix, precision_score, f1_score, recall_score, roc_auc_score
+from sklearn.metrics import make_scorer, accuracy_score, confusion_matrix, precision_score, f1_score, recall_score, roc_auc_score
+
+#cross validation scorers, the same ones 02_model_selection uses
+scorer = {'F1': make_scorer(f1_score, pos_label=1),
+          'Precision':make_scorer(precision_score),
+          'Recall':make_scorer(recall_score),
+          'Recall_ham':make_scorer(recall_score,pos_label=0),
+          'Accuracy':'accuracy',#accuracy is built in
+          'AUC':make_scorer(roc_auc_score)
+          }
 
 def evaluate_predictions(scores_df, y_true, y_pred, pred_proba=[],pred_decision = []):
     '''
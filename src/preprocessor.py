@@ -1,6 +1,9 @@
 import pandas as pd
 import numpy as np
 
+#subject given to emails without one, bulk_score.py fills missing subjects the same way
+NO_SUBJECT = '[no subject]'
+
 
 def clean_data(X, y):
     '''
@@ -20,7 +23,7 @@ def clean_data(X, y):
     #drop emails missing a message
     X = X.dropna(subset=['Message'], how='all')
     #fill emails with missing subject with the words 'no subject'
-    X['Subject'] = X['Subject'].fillna('[no subject]')
+    X['Subject'] = X['Subject'].fillna(NO_SUBJECT)
     #drop duplicates
     X = X.drop_duplicates(subset=['Subject','Message','Date'],keep='first')
     #change date type
@@ -28,7 +31,7 @@ def clean_data(X, y):
 
     #For y: rename column spam/ham to label
     y= X['Label']
-    X = X.drop(columns=['Label'],axis=1)
+    X = X.drop(columns=['Label'])
    
     #make sure that the label does not have extra spaces by using strip
     #y['Label'] = y['Label'].str.strip()
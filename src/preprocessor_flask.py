@@ -1,19 +1,28 @@
 import pandas as pd
 import numpy as np
-import datetime 
+from datetime import datetime
 
-def combine_data(subject, message):
+#day_of_week of emails without a usable date, the most common day of the
+#training data (tuesday, see notebooks/01_data_analysis.ipynb)
+DEFAULT_DAY = 1
+
+def combine_data(subject, message, date=None, default_day=DEFAULT_DAY):
     '''
     Receives a subject and message
     subject is optional it can be left blank
     combines subject and message
+    date is the optional Date of the email, day_of_week is read
+    from it like in training, default_day when it is missing or invalid
+    (not today's date, the same email always gets the same features)
     ===============
     returns a dataframe with new columns:
         'combined_with_stopwords, day_of_week, repeat_freq
     '''
-    current_date = datetime.now()
+    email_date = pd.to_datetime(date, errors='coerce') if isinstance(date, (str, datetime)) else pd.NaT
+    day_of_week = default_day if pd.isna(email_date) else email_date.dayofweek
     df = pd.DataFrame({
         'combined_with_stopwords': [f'{subject.strip()} {message.strip()}'],
-        'day_of_week':[current_date.weekday()],#today's date 
+        'day_of_week':[day_of_week],
         'repeat_freq': [1] #frequency is 1
-    })
\ No newline at end of file
+    })
+    return df
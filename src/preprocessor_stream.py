@@ -0,0 +1,136 @@
+'''
+Chunked version of clean_data, add_new_features and combine_data
+
+Reads the raw email csv (Subject, Message, Date, Spam/Ham columns) in chunks
+instead of loading it whole, so memory does not grow with the corpus:
+    pass 1: drop missing messages, deduplicate on Subject + Message + Date
+            with a set of row hashes and count each Subject + Message
+    pass 2: same cleaning again, day_of_week and the combined text are
+            computed per chunk in worker processes and repeat_freq comes
+            from the counts of pass 1, chunks are appended to a parquet
+            or feather file
+
+    python preprocessor_stream.py "../data/enron_spam_data.csv" ../data/cleaned_data.parquet --n-jobs 4
+'''
+import argparse
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import pandas as pd
+import numpy as np
+
+from preprocessor import NO_SUBJECT, combine_data
+
+
+def row_hashes(X, columns):
+    '''64 bit hash of each row over the given columns'''
+    return pd.util.hash_pandas_object(X[columns], index=False).to_numpy()
+
+
+def clean_chunk(X, seen):
+    '''
+    Same cleaning as clean_data for one chunk of the raw csv
+    seen is the set of row hashes kept so far, it replaces drop_duplicates
+    returns the cleaned chunk with a Label column (ham 0, spam 1)
+    '''
+    X['Label'] = X.pop('Spam/Ham').str.strip().map({'ham':0,'spam':1})
+    #drop emails missing a message (this also covers missing subject and message)
+    X = X[X['Message'].notna()]
+    #fill emails with missing subject with the words 'no subject'
+    X = X.assign(Subject=X['Subject'].fillna(NO_SUBJECT))
+
+    #drop duplicates, keeping the first one seen in the file
+    keep = np.zeros(len(X), dtype=bool)
+    for i, row_hash in enumerate(row_hashes(X, ['Subject','Message','Date'])):
+        if row_hash not in seen:
+            seen.add(row_hash)
+            keep[i] = True
+    return X[keep]
+
+
+#Subject + Message hash -> number of rows in the whole corpus, set once per worker
+repeat_counts = {}
+
+
+def set_repeat_counts(counts):
+    '''Worker initializer, the counts are sent to each worker once instead of with every chunk'''
+    repeat_counts.update(counts)
+
+
+def add_features(X):
+    '''
+    Adds day_of_week, repeat_freq and the combined text to a cleaned chunk
+    runs in the worker processes
+    '''
+    X['Date'] = pd.to_datetime(X['Date'])
+    X['day_of_week'] = X['Date'].dt.dayofweek
+    X['repeat_freq'] = [repeat_counts[pair] for pair in row_hashes(X, ['Subject','Message'])]
+    return combine_data(X)
+
+
+def count_repeats(path, chunksize):
+    '''Pass 1: number of kept rows of every Subject + Message in the csv'''
+    seen, counts = set(), {}
+    for X in pd.read_csv(path, chunksize=chunksize, dtype=str):
+        X = clean_chunk(X, seen)
+        for pair in row_hashes(X, ['Subject','Message']):
+            counts[pair] = counts.get(pair, 0) + 1
+    return counts
+
+
+def open_writer(path, schema):
+    '''Parquet writer for .parquet files, arrow ipc (feather v2) for anything else'''
+    import pyarrow.parquet as pq
+    import pyarrow.ipc as ipc
+    if path.endswith('.parquet'):
+        return pq.ParquetWriter(path, schema)
+    return ipc.new_file(path, schema)
+
+
+def preprocess_csv(path, output, chunksize=50000, n_jobs=1):
+    '''
+    Streams the raw csv at path through the cleaning and feature steps
+    and writes the result to output, returns the number of rows written
+    '''
+    import pyarrow as pa
+    counts = count_repeats(path, chunksize)
+
+    seen = set()
+    chunks = (clean_chunk(X, seen) for X in pd.read_csv(path, chunksize=chunksize, dtype=str))
+    writer, n_rows = None, 0
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=set_repeat_counts, initargs=(counts,)) as executor:
+        #a couple of chunks per worker in flight keeps memory bounded
+        pending = deque(executor.submit(add_features, X) for X in islice(chunks, 2 * n_jobs))
+        while pending:
+            X = pending.popleft().result()
+            for next_chunk in islice(chunks, 1):
+                pending.append(executor.submit(add_features, next_chunk))
+
+            table = pa.Table.from_pandas(X, preserve_index=False)
+            if writer is None:
+                #the first chunk sets the schema, later chunks are cast to it
+                schema = table.schema
+                writer = open_writer(output, schema)
+            writer.write_table(table if table.schema == schema else table.cast(schema))
+            n_rows += len(X)
+    if writer is not None:
+        writer.close()
+    return n_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chunked preprocessing of the raw spam csv')
+    parser.add_argument('csv', help='raw csv with Subject, Message, Date and Spam/Ham columns')
+    parser.add_argument('output', help='.parquet or .feather file to write')
+    parser.add_argument('--chunksize', type=int, default=50000, help='rows read at a time')
+    parser.add_argument('--n-jobs', type=int, default=1, help='worker processes for the feature step')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    n_rows = preprocess_csv(args.csv, args.output, args.chunksize, args.n_jobs)
+    print(f'Wrote {n_rows} emails to {args.output} in {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()